@@ -0,0 +1,79 @@
+"""Compare the installed JSON codecs (see terragen_rpc.codec) on
+requests and replies shaped like those of children() and param_names(),
+with the str-based encoding used by terragen_rpc 0.9.x as a baseline.
+Requests are also built with each codec's transport, which uses request
+templates for the json codec (see terragen_rpc.impl.RequestTemplates).
+
+Doesn't need Terragen:
+
+    python codec_benchmark.py
+"""
+
+import json
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import terragen_rpc.codec as codec
+import terragen_rpc.impl as impl
+
+
+REPEATS = 5
+
+
+def reply(result, id = 1):
+    return json.dumps({'jsonrpc': '2.0', 'result': result, 'id': id}).encode()
+
+PAYLOADS = {
+    # children() of a large group of populations or objects
+    'children(), 10000 nodes': bytearray(reply([str(i) for i in range(1000, 11000)])),
+    # param_names() of a planet or a heavily-connected shader
+    'param_names(), 300 params': bytearray(reply(['param_name_{:03}'.format(i) for i in range(300)])),
+    # a typical small reply, e.g. get_param_as_string()
+    'get_param_as_string()': bytearray(reply('-1205.5 87.25 3301')),
+}
+
+REQUEST = {
+    'jsonrpc': '2.0',
+    'method': 'set_param_from_string',
+    'params': ['1234', 'translate', '-1205.5 87.25 3301'],
+    'id': 123456,
+}
+
+
+def best_time(statement, number):
+    return min(timeit.repeat(statement, number = number, repeat = REPEATS)) / number
+
+
+def main():
+    print("{:<28} {:<9} {:>12}".format("payload", "codec", "us/call"))
+
+    number = 100000
+    t = best_time(lambda: json.dumps(REQUEST).encode(), number)
+    print("{:<28} {:<9} {:>12.2f}".format("encode request", "0.9.2", 1e6 * t))
+    for name in codec.available_codecs():
+        c = codec.get_codec(name)
+        t = best_time(lambda: c.encode(REQUEST), number)
+        print("{:<28} {:<9} {:>12.2f}".format("encode request", name, 1e6 * t))
+    for name in codec.available_codecs():
+        transport = impl.Transport(codec = name)
+        method, params = REQUEST['method'], REQUEST['params']
+        t = best_time(lambda: transport.generate_query_bytes_and_id(method, params), number)
+        print("{:<28} {:<9} {:>12.2f}".format("Transport request", name, 1e6 * t))
+
+    for label, payload in PAYLOADS.items():
+        number = max(10, 1000000 // len(payload))
+        # 0.9.2 decoded a bytes object joined from the received chunks
+        data = bytes(payload)
+        t = best_time(lambda: json.loads(data), number)
+        print("{:<28} {:<9} {:>12.2f}".format(label, "0.9.2", 1e6 * t))
+        for name in codec.available_codecs():
+            c = codec.get_codec(name)
+            assert c.decode(payload) == json.loads(data)
+            t = best_time(lambda: c.decode(payload), number)
+            print("{:<28} {:<9} {:>12.2f}".format(label, name, 1e6 * t))
+
+if __name__ == '__main__':
+    main()
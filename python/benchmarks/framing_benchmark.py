@@ -0,0 +1,149 @@
+"""Compare the socket framing used by terragen_rpc 0.9.x with the
+current impl.Connection, counting socket calls and measuring the memory
+allocated while receiving replies of various sizes.
+
+Runs a local server in a thread, so Terragen is not needed:
+
+    python framing_benchmark.py
+"""
+
+import os
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import terragen_rpc.impl as impl
+
+
+REPLY_SIZES = [200, 20000, 2000000]    # e.g. name(), param_names(), children() of a big group
+REPEATS = 20
+
+
+class CountingSocket:
+    """Wraps a socket and counts calls which send or receive data."""
+
+    counted = ('send', 'sendall', 'sendmsg', 'recv', 'recv_into')
+
+    def __init__(self, sock):
+        self._sock = sock
+        self.calls = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._sock, name)
+        if name in self.counted:
+            def counting(*args, **kwargs):
+                self.calls += 1
+                return attr(*args, **kwargs)
+            return counting
+        return attr
+
+
+def serve(listener, framed, replies):
+    while True:
+        conn, _ = listener.accept()
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        threading.Thread(target=serve_connection, args=(conn, framed, replies), daemon=True).start()
+
+def serve_connection(conn, framed, replies):
+    with conn:
+        while True:
+            header = conn.recv(4, socket.MSG_WAITALL)
+            if len(header) < 4:
+                return
+            request = conn.recv(int.from_bytes(header, 'little'), socket.MSG_WAITALL)
+            reply = replies[int(request)]
+            if framed:
+                conn.sendall(len(reply).to_bytes(4, 'little'))
+                conn.sendall(reply)
+            else:
+                conn.sendall(reply)
+                return
+
+def start_server(framed, replies):
+    listener = socket.socket()
+    listener.bind(('localhost', 0))
+    listener.listen(16)
+    threading.Thread(target=serve, args=(listener, framed, replies), daemon=True).start()
+    return listener.getsockname()
+
+
+def legacy_exchange(address, msg_bytes):
+    # impl.send_bytes_with_length_info() as it was in terragen_rpc 0.9.2
+    s = CountingSocket(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+    s.settimeout(10)
+    s.connect(address)
+    try:
+        length = len(msg_bytes)
+        length_info = length.to_bytes(4, byteorder='little')
+        s.send(length_info)
+        s.send(msg_bytes)
+        chunks = []
+        chunk = s.recv(1024)
+        chunks.append(chunk)
+        while chunk:
+            chunk = s.recv(1024)
+            chunks.append(chunk)
+        return b''.join(chunks), s.calls
+    finally:
+        s.close()
+
+class CountingConnection(impl.Connection):
+
+    calls = 0
+
+    def _connect(self):
+        super()._connect()
+        self._sock = CountingSocket(self._sock)
+
+    def close(self):
+        if self._sock is not None:
+            self.calls += self._sock.calls
+        super().close()
+
+def connection_exchange(connection, msg_bytes):
+    before = connection.calls + (connection._sock.calls if connection._sock is not None else 0)
+    reply = connection.exchange(msg_bytes)
+    after = connection.calls + (connection._sock.calls if connection._sock is not None else 0)
+    return reply, after - before
+
+
+def measure(label, size, exchange):
+    calls = 0
+    tracemalloc.start()
+    start = time.perf_counter()
+    for i in range(REPEATS):
+        reply, n = exchange()
+        assert len(reply) == size
+        calls += n
+        del reply
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("{:<28} {:>10} {:>12.1f} {:>14.1f} {:>12.2f}".format(
+        label, size, calls / REPEATS, peak / size, 1000 * elapsed / REPEATS))
+
+
+def main():
+    replies = [b'"' + b'x' * (size - 2) + b'"' for size in REPLY_SIZES]
+    unframed_address = start_server(False, replies)
+    framed_address = start_server(True, replies)
+
+    print("{:<28} {:>10} {:>12} {:>14} {:>12}".format(
+        "client", "reply size", "socket calls", "peak alloc/size", "ms/call"))
+    for i, size in enumerate(REPLY_SIZES):
+        msg = str(i).encode()
+        measure("0.9.2, close per reply", size, lambda: legacy_exchange(unframed_address, msg))
+
+        connection = CountingConnection(unframed_address, 10)
+        measure("Connection, close per reply", size, lambda: connection_exchange(connection, msg))
+
+        connection = CountingConnection(framed_address, 10)
+        measure("Connection, keep-alive", size, lambda: connection_exchange(connection, msg))
+        connection.close()
+
+if __name__ == '__main__':
+    main()
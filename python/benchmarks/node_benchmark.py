@@ -0,0 +1,94 @@
+"""Compare the Node class of terragen_rpc 0.9.x with the current
+high.Node, measuring the memory allocated and the time taken to turn a
+list of 100000 node IDs into Node objects, as children() does, and to
+use the nodes as set members.
+
+No server is needed:
+
+    python node_benchmark.py
+"""
+
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import terragen_rpc as tg
+import terragen_rpc.high as high
+
+
+NODE_COUNT = 100000
+REPEATS = 5
+
+
+class LegacyNode:
+    # high.Node as it was in terragen_rpc 0.9.2
+    id = None
+
+    def __init__(self, id):
+        self.id = id
+
+    def __eq__(self, other):
+        return isinstance(other, self.__class__) and self.id == other.id
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __bool__(self):
+        return bool(self.id)
+
+def legacy_nodes_from_ids(id_strings):
+    return [LegacyNode(i) for i in id_strings]
+
+
+def measure_memory(build, ids):
+    # Memory still allocated after building the list.
+    gc.collect()
+    tracemalloc.start()
+    nodes = build(ids)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return nodes, current
+
+def measure_time(build, ids):
+    best = None
+    for i in range(REPEATS):
+        start = time.perf_counter()
+        nodes = build(ids)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return nodes, best
+
+def report(label, memory, elapsed):
+    print("{:<36} {:>14.1f} {:>12.1f}".format(label, memory / 1e6, 1000 * elapsed))
+
+
+def main():
+    ids = [str(i) for i in range(1, NODE_COUNT + 1)]
+    client = tg.Client()
+
+    print("{:<36} {:>14} {:>12}".format("{} nodes".format(NODE_COUNT), "allocated MB", "ms"))
+
+    nodes, memory = measure_memory(legacy_nodes_from_ids, ids)
+    del nodes
+    nodes, elapsed = measure_time(legacy_nodes_from_ids, ids)
+    del nodes
+    report("0.9.2 Node", memory, elapsed)
+
+    build = lambda ids: high._nodes_from_ids(ids, client)
+    nodes, memory = measure_memory(build, ids)
+    del nodes
+    nodes, elapsed = measure_time(build, ids)
+    report("Node", memory, elapsed)
+
+    start = time.perf_counter()
+    members = set(nodes)
+    elapsed = time.perf_counter() - start
+    assert len(members) == NODE_COUNT
+    print("{:<36} {:>14} {:>12.1f}".format("set() of the nodes", "", 1000 * elapsed))
+
+if __name__ == '__main__':
+    main()
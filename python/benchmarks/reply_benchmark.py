@@ -0,0 +1,97 @@
+"""Compare the Reply class of terragen_rpc 0.9.x with the current
+jsonrpc.Reply, with the LeanReply returned when lean replies are
+enabled, and with call_value(), which doesn't create a reply,
+measuring the memory still allocated while a list of 100000 results is
+kept, as a cache or a bulk script would keep them, and the time taken
+to handle the replies.
+
+Each reply is created from new bytes, as if it had just been received,
+and all variants decode with the same codec. No server is needed:
+
+    python reply_benchmark.py
+"""
+
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import terragen_rpc.impl as impl
+import terragen_rpc.jsonrpc as jr
+
+
+REPLY_COUNT = 100000
+REPEATS = 5
+
+
+class LegacyReply:
+    # jsonrpc.Reply as it was in terragen_rpc 0.9.2, without the error
+    # handling, which isn't reached by these replies.
+    ok = False
+    value = None
+    raw_bytes = None
+    raw_dict = None
+    more_error_info = None
+
+    def __init__(self, reply_bytes, method, params, codec):
+        self.raw_bytes = reply_bytes
+        self._method = method
+        self._params = params
+        self.raw_dict = codec.decode(reply_bytes)
+        self.ok = True
+        self.value = self.raw_dict['result']
+
+
+def reply_bytes(i):
+    return b'{"jsonrpc": "2.0", "result": "0 10 -30", "id": %d}' % i
+
+def legacy_replies(codec):
+    return [LegacyReply(reply_bytes(i), 'get_param_as_string', ['2', 'position'], codec)
+        for i in range(REPLY_COUNT)]
+
+def replies(codec):
+    return [jr.Reply(reply_bytes(i), 'get_param_as_string', ['2', 'position'], id = i, codec = codec)
+        for i in range(REPLY_COUNT)]
+
+def lean_replies(codec):
+    return [jr._lean_reply(reply_bytes(i), 'get_param_as_string', ['2', 'position'], id = i, codec = codec)
+        for i in range(REPLY_COUNT)]
+
+def values(codec):
+    return [jr._value_from_reply_bytes(reply_bytes(i), 'get_param_as_string', ['2', 'position'], i, codec)
+        for i in range(REPLY_COUNT)]
+
+
+def measure(label, handle, codec):
+    gc.collect()
+    tracemalloc.start()
+    results = handle(codec)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del results
+
+    best = None
+    for i in range(REPEATS):
+        start = time.perf_counter()
+        results = handle(codec)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        del results
+
+    print("{:<32} {:>14.1f} {:>12.1f}".format(label, current / 1e6, 1000 * best))
+
+
+def main():
+    codec = impl.CODEC
+    print("{} replies, codec {}".format(REPLY_COUNT, codec.name))
+    print("{:<32} {:>14} {:>12}".format("", "kept MB", "ms"))
+    measure("0.9.2 Reply", legacy_replies, codec)
+    measure("Reply", replies, codec)
+    measure("LeanReply", lean_replies, codec)
+    measure("call_value()", values, codec)
+
+if __name__ == '__main__':
+    main()
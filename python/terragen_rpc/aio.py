@@ -0,0 +1,583 @@
+# MIT License
+#
+# Copyright (c) 2022 Planetside Software
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+"""An asyncio version of the high level API, for use from coroutines.
+
+The functions and ``Node`` methods in this module are coroutines which
+correspond to the functions and ``Node`` methods of the same name in
+``terragen_rpc``. They raise the same exceptions, including
+``StaleNodeError`` for nodes known to have been deleted or to belong to
+a closed project. Like those, they use the default client unless they
+are given a ``client`` argument or a node bound to another
+``terragen_rpc.Client``, whose address, timeout, codec and caches are
+used.
+
+Up to ``MAX_CONCURRENCY`` calls are sent to the server at once, so a
+large number of independent calls can be issued together with
+``asyncio.gather``:
+
+.. code-block:: python
+
+    import asyncio
+    import terragen_rpc.aio as tga
+
+    async def main():
+        project = await tga.root()
+        children = await project.children()
+        paths = await asyncio.gather(*(c.path() for c in children))
+        print(paths)
+
+    asyncio.run(main())
+
+Each call is made on a new connection, unless the client has persistent
+connection enabled (see ``terragen_rpc.set_persistent_connection``).
+Then each event loop keeps up to the pool's ``max_size`` idle
+connections of the client for reuse (see
+``terragen_rpc.jsonrpc.configure_connection_pool``), until they have
+been idle for ``idle_timeout`` or the client is closed. Close the client
+(or call ``terragen_rpc.jsonrpc.close_persistent_connection`` for the
+default client) before the event loop is closed, so that its
+connections are closed cleanly.
+"""
+
+
+import asyncio
+import threading
+import time
+import weakref
+
+import terragen_rpc.impl as impl
+import terragen_rpc.high as high
+
+from terragen_rpc.jsonrpc import IDEMPOTENT_METHODS
+
+
+MAX_CONCURRENCY = 16    # can be set with terragen_rpc.aio.set_max_concurrency()
+
+# The semaphore of each event loop. Loops may run in several threads.
+_loop_states = weakref.WeakKeyDictionary()
+_loop_states_lock = threading.Lock()
+
+
+class _LoopState:
+
+    def __init__(self):
+        self.semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+        self.max_concurrency = MAX_CONCURRENCY
+
+
+class _ConnectionPool:
+    # The idle connections of one transport in one event loop, since
+    # streams can't be shared between loops. Kept by the transport (see
+    # Transport.get_async_pool), which closes them when it is closed.
+    # Only close() may be called from another thread.
+
+    def __init__(self, loop):
+        self._loop = weakref.ref(loop)
+        self._idle = []     # (reader, writer, address, last_used), oldest first
+        self._closed = False
+
+    def acquire(self, address, idle_timeout):
+        now = time.monotonic()
+        while self._idle and now - self._idle[0][3] >= idle_timeout:
+            self._idle.pop(0)[1].close()
+        while self._idle:
+            reader, writer, idle_address, last_used = self._idle.pop()
+            if idle_address == address and not reader.at_eof():
+                return reader, writer
+            writer.close()
+        return None, None
+
+    def release(self, reader, writer, address, max_size):
+        if self._closed or len(self._idle) >= max_size:
+            writer.close()
+        else:
+            self._idle.append((reader, writer, address, time.monotonic()))
+
+    def close(self):
+        self._closed = True
+        idle, self._idle = self._idle, []
+        loop = self._loop()
+        if loop is None or loop.is_closed():
+            # Nothing can close the streams of a closed loop any more.
+            return
+        for reader, writer, address, last_used in idle:
+            loop.call_soon_threadsafe(writer.close)
+
+
+def settimeout(timeout_in_seconds):
+    high.settimeout(timeout_in_seconds)
+
+def set_max_concurrency(max_calls):
+    """Set the maximum number of calls that may be waiting for the server
+    at once in each event loop. Further calls wait until one of these has
+    completed. Defaults to 16.
+
+    Parameters
+    ----------
+    max_calls : int
+    """
+    global MAX_CONCURRENCY
+    MAX_CONCURRENCY = max_calls     # each loop makes a new semaphore on its next call
+
+
+# Low level functions
+
+async def call(method, params = [], client = None):
+    """Send an RPC request to the Terragen RPC server and return a
+    ``Reply`` object, or a ``LeanReply`` if the client has lean replies
+    enabled. This is the asyncio version of
+    ``terragen_rpc.jsonrpc.call``.
+
+    Parameters
+    ----------
+    method : str
+    params : list
+    client : Client, optional
+        The client whose server, timeout, codec and caches to use.
+        Defaults to the default client.
+
+    Raises
+    ------
+    ConnectionError
+        Raised by asyncio if a connection error occurs.
+    TimeoutError
+        Raised if the server doesn't reply within the socket timeout.
+    ReplyError
+        Raised if the response from the server cannot be decoded and
+        parsed.
+    ApiError (subclass thererof)
+        Raised if the reply from the server contains an error code that
+        suggests an API mismatch between client and server or an
+        incorrect use of the API.
+    LowLevelError (subclass thereof)
+        Raised if the reply from the server contains an error code that
+        suggests a problem with its implementation, or if this module
+        encounters an internal error.
+    """
+    client = high._client_or_default(client)
+    transport = client.transport
+    msg_bytes, id = transport.generate_query_bytes_and_id(method, params)
+    try:
+        reply_bytes = await send_bytes_with_length_info(msg_bytes, method in IDEMPOTENT_METHODS, client)
+    finally:
+        client._observe(method, params)
+    reply = client._reply_factory()(reply_bytes, method, params, id = id, codec = transport.codec)
+    client._observe_result(method, params, reply.value)
+    return reply
+
+async def send_bytes_with_length_info(msg_bytes, retry = False, client = None):
+    """
+    Raises
+    ------
+    ConnectionError
+    TimeoutError
+    """
+    transport = high._client_or_default(client).transport
+    loop = asyncio.get_running_loop()
+    state = _get_loop_state(loop)
+    pool = transport.get_async_pool(loop, _ConnectionPool)
+    async with state.semaphore:
+        try:
+            return await asyncio.wait_for(_exchange(pool, transport, msg_bytes, retry), transport.timeout)
+        except asyncio.TimeoutError as e:
+            # asyncio.TimeoutError is only an alias for TimeoutError
+            # since Python 3.11.
+            raise TimeoutError(e)
+
+def _get_loop_state(loop):
+    with _loop_states_lock:
+        state = _loop_states.get(loop)
+        if state is None or state.max_concurrency != MAX_CONCURRENCY:
+            state = _loop_states[loop] = _LoopState()
+    return state
+
+async def _exchange(pool, transport, msg_bytes, retry):
+    # Connections are only reused if the transport is persistent, like
+    # the connections of the synchronous API.
+    address = transport.address
+    persistent = transport.persistent
+    reader = writer = None
+    if persistent:
+        reader, writer = pool.acquire(address, transport.pool_idle_timeout)
+    reused = reader is not None
+    if not reused:
+        reader, writer = await asyncio.open_connection(*address)
+
+    try:
+        sent = True
+        try:
+            await _send(writer, msg_bytes)
+        except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+            if not reused:
+                raise
+            sent = False
+        header = await _read_header(reader) if sent else b''
+        if not header and reused:
+            # The server closed the idle connection. If the request
+            # couldn't be sent, or is safe to repeat, try again on a new
+            # connection. Otherwise the server may already have handled
+            # it, so the failure is raised.
+            if sent and not retry:
+                raise ConnectionError("Terragen RPC server closed the connection without replying. The request may have been handled, so it wasn't sent again.")
+            writer.close()
+            reader, writer = await asyncio.open_connection(*address)
+            await _send(writer, msg_bytes)
+            header = await _read_header(reader)
+
+        # Only connections to a server which keeps them alive are reused,
+        # so their replies are framed and aren't checked.
+        if reused or impl._is_length_header(header):
+            if len(header) < 4:
+                raise ConnectionError("Terragen RPC server closed the connection before the reply was complete.")
+            length = int.from_bytes(header, byteorder='little')
+            try:
+                reply_bytes = await reader.readexactly(length)
+            except asyncio.IncompleteReadError:
+                raise ConnectionError("Terragen RPC server closed the connection before the reply was complete.")
+            if persistent:
+                pool.release(reader, writer, address, transport.pool_max_size)
+            else:
+                writer.close()
+            return reply_bytes
+        else:
+            reply_bytes = header + await reader.read()
+            writer.close()
+            return reply_bytes
+
+    except:
+        writer.close()
+        raise
+
+async def _send(writer, msg_bytes):
+    length_info = len(msg_bytes).to_bytes(4, byteorder='little')
+    writer.write(length_info + msg_bytes)
+    await writer.drain()
+
+async def _read_header(reader):
+    try:
+        return await reader.readexactly(4)
+    except asyncio.IncompleteReadError as e:
+        return e.partial
+
+
+# Internal utility functions
+
+def _node_or_none(id_string, client = None):
+    if id_string:
+        return Node(id_string, client)
+    else:
+        return None
+
+def _nodes_from_ids(id_strings, client = None):
+    return [Node(i, client) for i in id_strings]
+
+def _client_of(node_or_nodes):
+    if type(node_or_nodes) is list:
+        return node_or_nodes[0].client if node_or_nodes else None
+    else:
+        return node_or_nodes.client
+
+def _ids(node_or_nodes):
+    if type(node_or_nodes) is list:
+        return [node.id for node in node_or_nodes]
+    else:
+        return node_or_nodes.id
+
+
+# Public functions:
+
+async def project_filepath(client = None):
+    """See ``terragen_rpc.project_filepath``.
+    """
+    return (await call('project_filepath', [], client)).value
+
+async def root(client = None):
+    """See ``terragen_rpc.root``.
+    """
+    reply = await call('root', [], client)
+    return _node_or_none(high._convert_value_0_or_empty_to_none(reply).value, client)
+
+async def node_by_path(path, client = None):
+    """See ``terragen_rpc.node_by_path``.
+    """
+    c = high._client_or_default(client)
+    index = c.path_index
+    if index is None:
+        reply = await call('node_by_path', [path], c)
+        return _node_or_none(high._convert_value_0_or_empty_to_none(reply).value, client)
+    id = index.lookup(path)
+    if id is None:
+        generation = index.generation
+        id = high._convert_value_0_or_empty_to_none(await call('node_by_path', [path], c)).value
+        if id is not None:
+            index.store(path, id, generation)
+    return _node_or_none(id, client)
+
+async def create_child(of_node, class_name):
+    """See ``terragen_rpc.create_child``.
+    """
+    c = of_node._live_client()
+    reply = await call('create_child', [of_node.id, class_name], c)
+    node = _node_or_none(high._convert_value_0_or_empty_to_none(reply).value, of_node.client)
+    if node is not None and c.schema_cache is not None:
+        c.schema_cache.note_class(node.id, class_name)
+    return node
+
+async def delete(node_or_nodes):
+    """See ``terragen_rpc.delete``.
+    """
+    await call('delete', [_ids(node_or_nodes)], high._live_client(node_or_nodes))
+
+async def current_selection(client = None):
+    """See ``terragen_rpc.current_selection``.
+    """
+    reply = await call('current_selection', [], client)
+    return _nodes_from_ids(reply.value, client)
+
+async def select_just(node_or_nodes):
+    """See ``terragen_rpc.select_just``.
+    """
+    await select_none(_client_of(node_or_nodes))
+    await select_more(node_or_nodes)
+
+async def select_more(node_or_nodes):
+    """See ``terragen_rpc.select_more``.
+    """
+    # Uses the server-side methods which work with server versions
+    # 0.7.x and 0.8.x, like terragen_rpc.select_more.
+    client = high._live_client(node_or_nodes)
+    if type(node_or_nodes) is list:
+        await call('select_more_as_array', [_ids(node_or_nodes)], client)
+    else:
+        await call('select_one_more', [node_or_nodes.id], client)
+
+async def select_none(client = None):
+    """See ``terragen_rpc.select_none``.
+    """
+    await call('select_none', [], client)
+
+async def new_project(client = None):
+    """See ``terragen_rpc.new_project``.
+    """
+    await call('new_project', [], client)
+
+async def open_project(filename, client = None):
+    """See ``terragen_rpc.open_project``.
+    """
+    return (await call('open_project', [filename], client)).value
+
+async def save_project(filename, client = None):
+    """See ``terragen_rpc.save_project``.
+    """
+    return (await call('save_project', [filename], client)).value
+
+async def insert_clip_file(filename, client = None):
+    """See ``terragen_rpc.insert_clip_file``.
+    """
+    return (await call('insert_clip_file', [filename], client)).value
+
+async def insert_clip_file_after(filename, input_node):
+    """See ``terragen_rpc.insert_clip_file_after``.
+    """
+    return (await call('insert_clip_file_after', [filename, input_node.id], input_node._live_client())).value
+
+async def insert_clip_file_before(filename, output_node, output_param = 'input_node'):
+    """See ``terragen_rpc.insert_clip_file_before``.
+    """
+    return (await call('insert_clip_file_before', [filename, output_node.id, output_param], output_node._live_client())).value
+
+
+
+
+class Node:
+    """A node ID whose methods are coroutines. See ``terragen_rpc.Node``.
+
+    Parameters
+    ----------
+    id : str
+    client : Client, optional
+        The client used by this node's methods, and by the nodes they
+        return. Defaults to the default client.
+
+    Like ``terragen_rpc.Node``, methods raise ``StaleNodeError`` without
+    contacting Terragen if the node is known to no longer exist, and use
+    the client's caches.
+    """
+    id = None
+    client = None
+    epoch = None
+
+    def __init__(self, id, client = None):
+        self.id = id
+        self.client = client
+        self.epoch = high._client_or_default(client).epoch
+
+    def __eq__(self, other):
+        return (isinstance(other, self.__class__) and self.id == other.id
+            and high._client_or_default(self.client) is high._client_or_default(other.client))
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __bool__(self):
+        return bool(self.id)
+
+    def _live_client(self):
+        client = high._client_or_default(self.client)
+        client.check_node(self.id, self.epoch)
+        return client
+
+    async def _call(self, method, params):
+        return (await call(method, params, self._live_client())).value
+
+    async def _cached_call(self, method):
+        client = self._live_client()
+        cache = client.metadata_cache
+        if cache is None:
+            return (await call(method, [self.id], client)).value
+        found, value_or_generation = cache.lookup(method, self.id)
+        if found:
+            return value_or_generation
+        value = (await call(method, [self.id], client)).value
+        cache.store(method, self.id, value, value_or_generation)
+        return value
+
+
+    async def name(self):
+        """See ``terragen_rpc.Node.name``.
+        """
+        return await self._cached_call('name')
+
+    async def path(self):
+        """See ``terragen_rpc.Node.path``.
+        """
+        index = self._live_client().path_index
+        if index is not None:
+            generation = index.generation
+        # Uses the deprecated server-side method which works with server
+        # versions 0.7.x, 0.8.x and 0.9.x, like terragen_rpc.Node.path.
+        path = await self._cached_call('name_and_path')
+        if index is not None:
+            index.store(path, self.id, generation)
+        return path
+
+    async def parent_path(self):
+        """See ``terragen_rpc.Node.parent_path``.
+        """
+        return await self._cached_call('parent_path')
+
+    async def parent(self):
+        """See ``terragen_rpc.Node.parent``.
+        """
+        return _node_or_none(high._none_if_0_or_empty(await self._cached_call('parent')), self.client)
+
+    async def children(self):
+        """See ``terragen_rpc.Node.children``.
+        """
+        return _nodes_from_ids(await self._cached_call('children'), self.client)
+
+    async def children_filtered_by_class(self, class_name):
+        """See ``terragen_rpc.Node.children_filtered_by_class``.
+        """
+        ids = await self._call('children_filtered_by_class', [self.id, class_name])
+        schema_cache = self._live_client().schema_cache
+        if schema_cache is not None:
+            for id in ids:
+                schema_cache.note_class(id, class_name)
+        return _nodes_from_ids(ids, self.client)
+
+    async def param_names(self):
+        """See ``terragen_rpc.Node.param_names``.
+        """
+        schema_cache = self._live_client().schema_cache
+        if schema_cache is None:
+            return await self._call('param_names', [self.id])
+        names = schema_cache.param_names(self.id)
+        if names is None:
+            names = await self._call('param_names', [self.id])
+            schema_cache.store_param_names(self.id, names)
+        return names
+
+    async def get_param(self, param_name):
+        """See ``terragen_rpc.Node.get_param``.
+        """
+        return await self.get_param_as_string(param_name)
+
+    async def get_param_as_string(self, param_name):
+        """See ``terragen_rpc.Node.get_param_as_string``.
+        """
+        client = self._live_client()
+        param_cache = client.param_cache
+        if param_cache is not None:
+            found, value_or_generation = param_cache.lookup(self.id, param_name)
+            if found:
+                return value_or_generation
+        value = (await call('get_param_as_string', [self.id, param_name], client)).value
+        if param_cache is not None:
+            param_cache.store(self.id, param_name, value, value_or_generation)
+        if client.schema_cache is not None:
+            client.schema_cache.note_value(self.id, param_name, value)
+        return value
+
+    async def get_param_as_int(self, param_name):
+        """See ``terragen_rpc.Node.get_param_as_int``.
+        """
+        rawstring = await self.get_param_as_string(param_name)
+        return high._int_from_param_string(rawstring)
+
+    async def get_param_as_float(self, param_name):
+        """See ``terragen_rpc.Node.get_param_as_float``.
+        """
+        rawstring = await self.get_param_as_string(param_name)
+        return high._float_from_param_string(rawstring)
+
+    async def get_param_as_tuple(self, param_name):
+        """See ``terragen_rpc.Node.get_param_as_tuple``.
+        """
+        rawstring = await self.get_param_as_string(param_name)
+        return tuple(high._floats_from_param_string(rawstring))
+
+    async def get_param_as_list(self, param_name):
+        """See ``terragen_rpc.Node.get_param_as_list``.
+        """
+        rawstring = await self.get_param_as_string(param_name)
+        return high._floats_from_param_string(rawstring)
+
+    async def set_param(self, param_name, values):
+        """See ``terragen_rpc.Node.set_param``.
+        """
+        string = high._param_string_from_values(values)
+        await self.set_param_from_string(param_name, string)
+
+    async def set_param_from_string(self, param_name, value_string):
+        """See ``terragen_rpc.Node.set_param_from_string``.
+        """
+        client = self._live_client()
+        await call('set_param_from_string', [self.id, param_name, value_string], client)
+        if client.param_cache is not None:
+            client.param_cache.update(self.id, param_name, value_string)
@@ -0,0 +1,587 @@
+# MIT License
+#
+# Copyright (c) 2022 Planetside Software
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+"""Client-side caches of results from the Terragen RPC server.
+
+Caches are owned by a ``terragen_rpc.jsonrpc.Client`` and are disabled by
+default. The client tells its caches about every call it makes, and each
+cache drops whatever the call may have changed, so results stay correct
+as long as the project is only changed through this client. Call
+``Client.invalidate`` after changing the project in any other way, e.g.
+in Terragen's UI or from another process.
+"""
+
+
+import threading
+import time
+
+from collections import OrderedDict
+
+
+# Calls which don't change the hierarchy or any node's name. Any other
+# call, including methods this module doesn't know, clears the metadata
+# cache unless handled specially in MetadataCache.observe().
+_METADATA_PRESERVING_METHODS = frozenset([
+    'root', 'name', 'name_and_path', 'path', 'parent_path', 'parent',
+    'children', 'children_filtered_by_class', 'param_names',
+    'get_param_as_string', 'node_by_path', 'project_filepath',
+    'save_project', 'current_selection', 'select_just', 'select_more',
+    'select_none', 'select_one_more', 'select_more_as_array',
+    'toggle_enable_node',
+])
+
+_PATH_METHODS = ('name_and_path', 'path', 'parent_path')
+
+# Calls which don't change any param values. As above, any other call
+# clears the param value cache unless handled in ParamValueCache.observe().
+_PARAMS_PRESERVING_METHODS = frozenset([
+    'root', 'name', 'name_and_path', 'path', 'parent_path', 'parent',
+    'children', 'children_filtered_by_class', 'param_names',
+    'get_param_as_string', 'node_by_path', 'project_filepath',
+    'save_project', 'current_selection', 'select_just', 'select_more',
+    'select_none', 'select_one_more', 'select_more_as_array',
+    'create_child',
+])
+
+
+class MetadataCache:
+    """Caches the results of the methods which describe a node's place
+    in the hierarchy: 'name', 'name_and_path', 'path', 'parent_path',
+    'parent' and 'children'.
+
+    The cache is cleared by calls which may change the hierarchy, such
+    as 'delete', 'new_project', 'open_project' and 'insert_clip_file'.
+    'create_child' only drops the cached children of the new node's
+    parent, and setting a node's 'name' param drops its name and all
+    cached paths.
+
+    Attributes
+    ----------
+    hits : int
+        The number of lookups which found a result.
+    misses : int
+        The number of lookups which didn't.
+    """
+
+    METHODS = frozenset(['name', 'name_and_path', 'path', 'parent_path', 'parent', 'children'])
+
+    def __init__(self):
+        self._values = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._values)
+
+    def stats(self):
+        """Return a dict with the keys 'hits', 'misses' and 'size'."""
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._values)}
+
+    def lookup(self, method, node_id):
+        """Return ``(True, value)`` if the result of calling method for
+        the node is cached, otherwise ``(False, generation)`` where
+        generation must be passed to `store` along with the result.
+        """
+        key = (method, node_id)
+        with self._lock:
+            if key in self._values:
+                self.hits += 1
+                return True, self._values[key]
+            self.misses += 1
+            return False, self._generation
+
+    def store(self, method, node_id, value, generation):
+        """Cache a result, unless the cache has been invalidated since
+        the `lookup` which returned generation, in which case the result
+        may be out of date.
+        """
+        with self._lock:
+            if generation == self._generation:
+                self._values[(method, node_id)] = value
+
+    def export(self):
+        """Return the cached results as a list of
+        ``[method, node_id, value]`` lists.
+        """
+        with self._lock:
+            return [[method, node_id, value] for (method, node_id), value in self._values.items()]
+
+    def load(self, entries):
+        """Add results given as returned by `export`."""
+        with self._lock:
+            for method, node_id, value in entries:
+                if method in self.METHODS:
+                    self._values[(method, node_id)] = value
+
+    def invalidate(self, node_id = None):
+        """Drop the cached results for one node, or for all nodes if
+        node_id is `None`.
+        """
+        with self._lock:
+            self._generation += 1
+            if node_id is None:
+                self._values.clear()
+            else:
+                for method in self.METHODS:
+                    self._values.pop((method, node_id), None)
+
+    def observe(self, method, params):
+        """Drop whatever a call to the server may have changed. Called by
+        the client after each call.
+        """
+        if method in _METADATA_PRESERVING_METHODS:
+            return
+        if method == 'set_param_from_string' and len(params) >= 2 and params[1] != 'name':
+            return
+        with self._lock:
+            self._generation += 1
+            if method == 'create_child' and params:
+                self._values.pop(('children', params[0]), None)
+            elif method == 'set_param_from_string' and params:
+                self._values.pop(('name', params[0]), None)
+                for key in [k for k in self._values if k[0] in _PATH_METHODS]:
+                    del self._values[key]
+            else:
+                self._values.clear()
+
+
+def infer_shape(value_string):
+    """Return the shape of a parameter value given as a string:
+    'scalar', '2-vector' or '3-vector' if the string has one, two or
+    three numbers, otherwise 'string'.
+    """
+    words = value_string.split()
+    if 1 <= len(words) <= 3:
+        try:
+            for word in words:
+                float(word)
+        except ValueError:
+            return 'string'
+        return ('scalar', '2-vector', '3-vector')[len(words) - 1]
+    return 'string'
+
+
+class ParamSchemaCache:
+    """Caches the param names of each node class, and the shape of each
+    param's value (see `infer_shape`), on the assumption that all nodes
+    of a class have the same params.
+
+    The RPC server doesn't report the class of a node, so the cache
+    remembers the classes of nodes made by 'create_child' and of nodes
+    returned by 'children_filtered_by_class'. The param names of nodes
+    whose class isn't known are not cached.
+
+    The names for a class are filled from the first node of the class
+    whose param names are requested. Shapes are filled from the values
+    of params as they are read.
+
+    Attributes
+    ----------
+    hits : int
+        The number of param names lookups which found the class's names.
+    misses : int
+        The number of lookups which didn't, including lookups for nodes
+        whose class isn't known.
+    """
+
+    def __init__(self):
+        self._classes = {}  # node id -> class name
+        self._schemas = {}  # class name -> {param name: shape or None}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """Return a dict with the keys 'hits', 'misses', 'classes' (the
+        number of classes with cached param names) and 'nodes' (the
+        number of nodes whose class is known).
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+            'classes': len(self._schemas), 'nodes': len(self._classes)}
+
+    def note_class(self, node_id, class_name):
+        """Remember the class of a node."""
+        with self._lock:
+            self._classes[node_id] = class_name
+
+    def class_of(self, node_id):
+        """Return the class of a node, or `None` if it isn't known."""
+        return self._classes.get(node_id)
+
+    def param_names(self, node_id):
+        """Return the param names of the node's class as a new list, or
+        `None` if they aren't cached.
+        """
+        with self._lock:
+            schema = self._schemas.get(self._classes.get(node_id))
+            if schema is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return list(schema)
+
+    def store_param_names(self, node_id, names):
+        """Cache the param names of the node's class, if it's known."""
+        with self._lock:
+            class_name = self._classes.get(node_id)
+            if class_name is not None and class_name not in self._schemas:
+                self._schemas[class_name] = dict.fromkeys(names)
+
+    def export_schemas(self):
+        """Return the cached param names and shapes of all classes as a
+        dict of dicts, like `schema`.
+        """
+        with self._lock:
+            return {c: dict(schema) for c, schema in self._schemas.items()}
+
+    def export_classes(self):
+        """Return the known classes of nodes as a dict of node ids to
+        class names.
+        """
+        with self._lock:
+            return dict(self._classes)
+
+    def load_schemas(self, schemas):
+        """Add the param names and shapes of classes, given as returned by
+        `export_schemas`. Classes which are already cached are kept.
+        """
+        with self._lock:
+            for class_name, schema in schemas.items():
+                self._schemas.setdefault(class_name, dict(schema))
+
+    def schema(self, class_name):
+        """Return a dict of the param names of a class and their shapes,
+        which are `None` for params that haven't been read yet, or `None`
+        if the class's param names aren't cached.
+        """
+        with self._lock:
+            schema = self._schemas.get(class_name)
+            return dict(schema) if schema is not None else None
+
+    def shape(self, node_id, param_name):
+        """Return the shape of a param of the node's class, or `None` if
+        it isn't known.
+        """
+        schema = self._schemas.get(self._classes.get(node_id))
+        return schema.get(param_name) if schema is not None else None
+
+    def note_value(self, node_id, param_name, value_string):
+        """Infer the shape of a param from a value read from the node,
+        if the shape isn't already known. Empty values are ignored.
+        """
+        schema = self._schemas.get(self._classes.get(node_id))
+        if schema is not None and schema.get(param_name, '') is None and value_string:
+            with self._lock:
+                schema[param_name] = infer_shape(value_string)
+
+    def invalidate(self, node_id = None):
+        """Forget the class of one node, or the classes of all nodes and
+        all cached param names if node_id is `None`.
+        """
+        with self._lock:
+            if node_id is None:
+                self._classes.clear()
+                self._schemas.clear()
+            else:
+                self._classes.pop(node_id, None)
+
+    def observe(self, method, params):
+        """Forget the classes of all nodes after a call which may have
+        deleted nodes, including their descendants, so that their ids
+        can't be confused with new nodes. Param names are kept, because
+        the params of a class don't change.
+        """
+        if method in _METADATA_PRESERVING_METHODS or method in ('create_child', 'set_param_from_string'):
+            return
+        with self._lock:
+            self._classes.clear()
+
+
+class ParamValueCache:
+    """Caches param values as read by 'get_param_as_string', keyed by
+    node id and param name. The least recently used values are dropped
+    when the cache is full, and values older than the time to live are
+    read again.
+
+    Values set through the client replace the cached values once the
+    server has replied that the write succeeded, so reads see the
+    client's own writes. A write which is buffered by ``deferred`` or
+    sent without waiting only drops the cached value, because the
+    server may still reject it. The value is cached as it was written,
+    so a read returns e.g. '0.50' where Terragen would return '0.5'.
+    A 'toggle_enable_node' call drops the node's values, and calls
+    which may change any node, such as 'delete', 'new_project',
+    'open_project' and 'insert_clip_file', clear the cache.
+
+    Parameters
+    ----------
+    max_size : int
+        The maximum number of values to keep.
+    ttl : float or None
+        The number of seconds to keep each value, or `None` to keep
+        values until they are dropped for another reason.
+
+    Attributes
+    ----------
+    hits : int
+    misses : int
+        Lookups which didn't find a value, including expired values.
+    evictions : int
+        Values dropped because the cache was full.
+    expirations : int
+        Values dropped because they were older than the time to live.
+    """
+
+    def __init__(self, max_size = 4096, ttl = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._values = OrderedDict()    # (node id, param name) -> (value, expiry time)
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._values)
+
+    def configure(self, max_size = None, ttl = None):
+        """Change the size or time to live. Arguments which are `None`
+        are left unchanged.
+        """
+        with self._lock:
+            if max_size is not None:
+                self.max_size = max_size
+                self._evict()
+            if ttl is not None:
+                self.ttl = ttl
+
+    def stats(self):
+        """Return a dict with the keys 'hits', 'misses', 'hit_rate',
+        'evictions', 'expirations', 'size' and 'max_size'.
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions, 'expirations': self.expirations,
+            'size': len(self._values), 'max_size': self.max_size}
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def lookup(self, node_id, param_name):
+        """Return ``(True, value)`` if the param's value is cached,
+        otherwise ``(False, generation)`` where generation must be
+        passed to `store` along with the value.
+        """
+        key = (node_id, param_name)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is not None:
+                if entry[1] is None or entry[1] > time.monotonic():
+                    self._values.move_to_end(key)
+                    self.hits += 1
+                    return True, entry[0]
+                del self._values[key]
+                self.expirations += 1
+            self.misses += 1
+            return False, self._generation
+
+    def store(self, node_id, param_name, value, generation):
+        """Cache a value read from the server, unless the cache has been
+        changed since the `lookup` which returned generation, in which
+        case the value may be out of date.
+        """
+        with self._lock:
+            if generation == self._generation:
+                self._put((node_id, param_name), value)
+
+    def update(self, node_id, param_name, value):
+        """Cache a value written to the server."""
+        with self._lock:
+            self._generation += 1
+            self._put((node_id, param_name), value)
+
+    def _put(self, key, value):
+        expiry = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._values[key] = (value, expiry)
+        self._values.move_to_end(key)
+        self._evict()
+
+    def _evict(self):
+        while len(self._values) > self.max_size:
+            self._values.popitem(last = False)
+            self.evictions += 1
+
+    def invalidate(self, node_id = None):
+        """Drop the cached values of one node, or of all nodes if node_id
+        is `None`.
+        """
+        with self._lock:
+            self._generation += 1
+            if node_id is None:
+                self._values.clear()
+            else:
+                for key in [k for k in self._values if k[0] == node_id]:
+                    del self._values[key]
+
+    def observe(self, method, params):
+        """Drop whatever a call to the server may have changed. Called by
+        the client after each call. A value which is set is dropped here,
+        and cached again by `update` once the call has succeeded.
+        """
+        if method in _PARAMS_PRESERVING_METHODS:
+            return
+        if method == 'set_param_from_string' and len(params) >= 2:
+            with self._lock:
+                self._generation += 1
+                self._values.pop((params[0], params[1]), None)
+        elif method == 'toggle_enable_node' and params:
+            self.invalidate(params[0])
+        else:
+            self.invalidate()
+
+
+class PathIndex:
+    """Maps node paths to node ids, so that 'node_by_path' is only sent
+    once per path. Filled from the results of 'node_by_path' and of
+    'name_and_path'/'path' (``Node.path``), or all at once by walking the
+    hierarchy (``terragen_rpc.preload_path_index``). Only paths which
+    begin with a forward slash are indexed, and paths which weren't
+    found are not remembered.
+
+    Deleting or renaming a node drops its path and the paths of all its
+    descendants. If the path of the node isn't known, all paths are
+    dropped. Calls which may change the hierarchy in other ways, such
+    as 'new_project', 'open_project' and 'insert_clip_file', drop all
+    paths.
+
+    Attributes
+    ----------
+    generation : int
+        Incremented whenever paths are dropped. Pass the value from
+        before a call to `store` along with the call's result.
+    hits : int
+    misses : int
+    """
+
+    def __init__(self):
+        self._ids = {}      # path -> node id
+        self._paths = {}    # node id -> path
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._ids)
+
+    def stats(self):
+        """Return a dict with the keys 'hits', 'misses' and 'size'."""
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._ids)}
+
+    def lookup(self, path):
+        """Return the id of the node at path, or `None` if it isn't
+        indexed.
+        """
+        with self._lock:
+            node_id = self._ids.get(path)
+            if node_id is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return node_id
+
+    def path_of(self, node_id):
+        """Return the indexed path of a node, or `None`."""
+        return self._paths.get(node_id)
+
+    def export(self):
+        """Return the index as a dict of paths to node ids."""
+        with self._lock:
+            return dict(self._ids)
+
+    def store(self, path, node_id, generation):
+        """Index a node's path, unless paths have been dropped since
+        generation was read, in which case the path may be out of date.
+        """
+        if not path.startswith('/') or not node_id or node_id == '0':
+            return
+        with self._lock:
+            if generation == self.generation:
+                old_path = self._paths.pop(node_id, None)
+                if old_path is not None:
+                    self._ids.pop(old_path, None)
+                old_id = self._ids.get(path)
+                if old_id is not None:
+                    self._paths.pop(old_id, None)
+                self._ids[path] = node_id
+                self._paths[node_id] = path
+
+    def invalidate(self, node_id = None):
+        """Drop the paths of a node and its descendants, or all paths if
+        node_id is `None` or the node's path isn't known.
+        """
+        with self._lock:
+            self.generation += 1
+            path = self._paths.get(node_id) if node_id is not None else None
+            if path is None:
+                self._ids.clear()
+                self._paths.clear()
+            else:
+                self._drop_subtree(path)
+
+    def _drop_subtree(self, path):
+        prefix = path + '/'
+        for p in [p for p in self._ids if p == path or p.startswith(prefix)]:
+            del self._paths[self._ids.pop(p)]
+
+    def observe(self, method, params):
+        """Drop the paths which a call to the server may have changed.
+        Called by the client after each call.
+        """
+        if method in _METADATA_PRESERVING_METHODS or method == 'create_child':
+            return
+        if method == 'set_param_from_string' and len(params) >= 2:
+            if params[1] == 'name':
+                self.invalidate(params[0])
+        elif method == 'delete' and params:
+            ids = params[0] if isinstance(params[0], list) else [params[0]]
+            with self._lock:
+                self.generation += 1
+                paths = [self._paths.get(node_id) for node_id in ids]
+                if None in paths:
+                    self._ids.clear()
+                    self._paths.clear()
+                else:
+                    for path in paths:
+                        self._drop_subtree(path)
+        else:
+            self.invalidate()
@@ -0,0 +1,183 @@
+# MIT License
+#
+# Copyright (c) 2022 Planetside Software
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+"""JSON encoders and decoders for RPC requests and replies.
+
+The fastest installed library is used by default, in the order orjson,
+msgspec, ujson, then Python's own json module. A codec can also be
+chosen by name, for the default client with
+``terragen_rpc.jsonrpc.set_codec`` or for another client with the
+``codec`` argument of ``Client``.
+
+Codecs encode to bytes and decode from bytes, bytearray or memoryview,
+so requests and replies are never copied to and from str.
+"""
+
+
+import json
+
+
+class Codec:
+    """Encodes requests with Python's json module and decodes replies
+    with it. The base class of the other codecs.
+
+    Attributes
+    ----------
+    name : str
+        The name used to choose the codec, e.g. with `get_codec`.
+    use_request_templates : bool
+        Whether requests are built from cached templates (see
+        ``terragen_rpc.impl.RequestTemplates``) rather than encoded by
+        the codec. True for codecs whose encoder is slower than the
+        templates.
+    """
+
+    name = 'json'
+    use_request_templates = True
+
+    def encode(self, obj):
+        """Return the JSON representation of obj as UTF-8 bytes."""
+        return json.dumps(obj).encode()
+
+    def decode(self, data):
+        """Return the object represented by JSON data, which may be
+        bytes, bytearray or memoryview.
+
+        Raises
+        ------
+        ValueError
+            Raised if the data is not valid JSON.
+        """
+        if isinstance(data, memoryview):
+            data = bytes(data)  # json only reads str, bytes and bytearray
+        return json.loads(data)
+
+    def __repr__(self):
+        return '<{} codec>'.format(self.name)
+
+
+class OrjsonCodec(Codec):
+    """Uses orjson (https://github.com/ijl/orjson)."""
+
+    name = 'orjson'
+    use_request_templates = False
+
+    def __init__(self):
+        import orjson
+        self.encode = orjson.dumps
+        self.decode = orjson.loads
+
+
+class MsgspecCodec(Codec):
+    """Uses msgspec (https://github.com/jcrist/msgspec)."""
+
+    name = 'msgspec'
+    use_request_templates = False
+
+    def __init__(self):
+        import msgspec
+        self.encode = msgspec.json.Encoder().encode
+        self.decode = msgspec.json.Decoder().decode
+
+
+class UjsonCodec(Codec):
+    """Uses ujson (https://github.com/ultrajson/ultrajson)."""
+
+    name = 'ujson'
+    use_request_templates = False
+
+    def __init__(self):
+        import ujson
+        self._ujson = ujson
+
+    def encode(self, obj):
+        return self._ujson.dumps(obj, ensure_ascii = False, escape_forward_slashes = False).encode()
+
+    def decode(self, data):
+        # ujson only reads bytes and str.
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        return self._ujson.loads(data)
+
+
+CODECS = {
+    'orjson': OrjsonCodec,
+    'msgspec': MsgspecCodec,
+    'ujson': UjsonCodec,
+    'json': Codec,
+}   # in order of preference
+
+_available = None
+
+
+def available_codecs():
+    """Return the names of the codecs whose libraries are installed, in
+    order of preference.
+
+    Returns
+    -------
+    list of str
+    """
+    global _available
+    if _available is None:
+        available = {}
+        for name, codec_class in CODECS.items():
+            try:
+                available[name] = codec_class()
+            except ImportError:
+                pass
+        _available = available
+    return list(_available)
+
+def get_codec(codec = None):
+    """Return a codec.
+
+    Parameters
+    ----------
+    codec : str or Codec, optional
+        The name of a codec in `CODECS`, or a codec object which is
+        returned unchanged. If `None`, the fastest installed codec is
+        returned.
+
+    Returns
+    -------
+    Codec
+
+    Raises
+    ------
+    ValueError
+        Raised if the name is not the name of a codec.
+    ImportError
+        Raised if the codec's library is not installed.
+    """
+    if codec is not None and not isinstance(codec, str):
+        return codec
+    available_codecs()
+    if codec is None:
+        return next(iter(_available.values()))
+    if codec not in CODECS:
+        raise ValueError("Unknown codec {!r}. Choose one of {}.".format(codec, ', '.join(CODECS)))
+    if codec not in _available:
+        raise ImportError("The {} codec needs the {} package, which is not installed.".format(codec, codec))
+    return _available[codec]
@@ -0,0 +1,190 @@
+# MIT License
+#
+# Copyright (c) 2022 Planetside Software
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+"""A cache of project metadata in an SQLite file, so that short-lived
+scripts don't have to fetch it again each time they run.
+
+Two kinds of metadata are saved:
+
+- The param names and shapes of node classes (see
+  ``terragen_rpc.cache.ParamSchemaCache``), which are the same for
+  every project. They are keyed by the server's address and by a
+  server version which the caller may supply, because the RPC server
+  doesn't report its version.
+- The path of each node (see ``terragen_rpc.cache.PathIndex``) and the
+  classes of nodes, which are keyed by the project's file path and
+  modification time as well. Node ids are only meaningful to the
+  Terragen session that made them, so these are only loaded if a
+  sample of the saved paths still leads to the saved ids.
+
+Example:
+
+.. code-block:: python
+
+    import terragen_rpc as tg
+
+    tg.load_disk_cache('metadata.sqlite')
+    ...
+    tg.save_disk_cache('metadata.sqlite')
+"""
+
+
+import json
+import os
+import random
+
+
+FORMAT_VERSION = 1
+VALIDATION_SAMPLE_SIZE = 8
+
+
+class DiskCache:
+    """An SQLite file which stores metadata from one or more clients.
+
+    Parameters
+    ----------
+    filename : str
+        The file is created if it doesn't exist.
+    server_version : str, optional
+        Included in the key of everything saved, so that metadata from
+        other versions of Terragen is not used. Recommended if more than
+        one version of Terragen is used with the same address.
+    """
+
+    def __init__(self, filename, server_version = None):
+        import sqlite3  # not available in every Python build
+        self.filename = os.path.expanduser(filename)
+        self.server_version = server_version
+        self._db = sqlite3.connect(self.filename, timeout = 10)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'format'").fetchone()
+            if row is not None and row[0] != str(FORMAT_VERSION):
+                self._db.execute('DROP TABLE IF EXISTS schemas')
+                self._db.execute('DROP TABLE IF EXISTS nodes')
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('format', ?)", (str(FORMAT_VERSION),))
+            self._db.execute('CREATE TABLE IF NOT EXISTS schemas '
+                '(server TEXT, class_name TEXT, schema TEXT, PRIMARY KEY (server, class_name))')
+            self._db.execute('CREATE TABLE IF NOT EXISTS nodes '
+                '(project TEXT, node_id TEXT, path TEXT, class_name TEXT, PRIMARY KEY (project, node_id))')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def load(self, client):
+        """Fill the client's schema cache and path index from the file,
+        enabling them if necessary.
+
+        Returns
+        -------
+        bool
+            True if the current project's metadata was loaded, or False
+            if it wasn't found or didn't match the project. Class
+            schemas are loaded either way.
+        """
+        client.set_schema_cache(True)
+        client.set_path_index(True)
+        server = self._server_key(client)
+        schemas = {}
+        for class_name, schema in self._db.execute(
+                'SELECT class_name, schema FROM schemas WHERE server = ?', (server,)):
+            schemas[class_name] = dict(json.loads(schema))
+        client.schema_cache.load_schemas(schemas)
+
+        project = self._project_key(client, server)
+        if project is None:
+            return False
+        generation = client.path_index.generation
+        rows = self._db.execute(
+            'SELECT node_id, path, class_name FROM nodes WHERE project = ?', (project,)).fetchall()
+        if not rows or not self._rows_match_server(client, rows):
+            return False
+        for node_id, path, class_name in rows:
+            if path is not None:
+                client.path_index.store(path, node_id, generation)
+            if class_name is not None:
+                client.schema_cache.note_class(node_id, class_name)
+        return True
+
+    def save(self, client):
+        """Save the contents of the client's schema cache and path index
+        to the file, replacing what was saved for the current project.
+        A client with neither leaves the file unchanged.
+        """
+        schema_cache = client.schema_cache
+        path_index = client.path_index
+        if schema_cache is None and path_index is None:
+            return
+        server = self._server_key(client)
+        project = self._project_key(client, server)
+        with self._db:
+            if schema_cache is not None:
+                self._db.executemany('INSERT OR REPLACE INTO schemas VALUES (?, ?, ?)',
+                    [(server, c, json.dumps(list(schema.items())))
+                        for c, schema in schema_cache.export_schemas().items()])
+            if project is None:
+                return
+            rows = {}
+            if path_index is not None:
+                for path, node_id in path_index.export().items():
+                    rows[node_id] = [path, None]
+            if schema_cache is not None:
+                for node_id, class_name in schema_cache.export_classes().items():
+                    rows.setdefault(node_id, [None, None])[1] = class_name
+            self._db.execute('DELETE FROM nodes WHERE project = ?', (project,))
+            self._db.executemany('INSERT INTO nodes VALUES (?, ?, ?, ?)',
+                [(project, node_id, path, class_name) for node_id, (path, class_name) in rows.items()])
+
+    def _server_key(self, client):
+        host, port = client.address
+        return '{}:{}|{}'.format(host, port, self.server_version or '')
+
+    def _project_key(self, client, server):
+        # Only projects saved to a file which this process can see have
+        # a key, because unsaved projects can't be told apart.
+        filepath = client.call('project_filepath').value
+        if not filepath:
+            return None
+        try:
+            mtime = os.stat(filepath).st_mtime_ns
+        except OSError:
+            return None
+        return '{}|{}|{}'.format(server, filepath, mtime)
+
+    def _rows_match_server(self, client, rows):
+        # Check that some of the saved paths still lead to the saved ids,
+        # with one batch request.
+        with_paths = [row for row in rows if row[1] is not None]
+        if not with_paths:
+            return False
+        sample = random.sample(with_paths, min(VALIDATION_SAMPLE_SIZE, len(with_paths)))
+        replies = client.call_batch([('node_by_path', [path]) for node_id, path, class_name in sample])
+        return all(reply.ok and reply.value == node_id
+            for reply, (node_id, path, class_name) in zip(replies, sample))
@@ -25,6 +25,34 @@
 
 Changes
 -------
+- Unreleased:
+
+  - added ``set_persistent_connection``.
+  - added module ``terragen_rpc.aio``, an asyncio version of this API.
+  - added class ``Client``. Nodes can be bound to a client, and
+    functions which don't take a node accept a ``client`` argument.
+  - added ``wait`` argument to ``Node.set_param``,
+    ``Node.set_param_from_string``, ``select_none`` and
+    ``toggle_enable_node``, and added ``flush``.
+  - requests and replies are encoded with orjson, msgspec or ujson if
+    one is installed (see ``terragen_rpc.codec``).
+  - added ``set_metadata_cache``, ``invalidate_cache`` and
+    ``Node.invalidate_cache``.
+  - calls on nodes which were deleted with ``delete``, or which belong
+    to a project closed by ``new_project`` or ``open_project``, raise
+    ``StaleNodeError`` without contacting Terragen.
+  - added ``set_schema_cache``, ``set_param_cache``,
+    ``param_cache_stats``, ``set_path_index``,
+    ``preload_path_index``, ``load_disk_cache``,
+    ``save_disk_cache``, ``publish_shared_cache`` and
+    ``refresh_shared_cache``.
+  - ``Node`` is hashable, uses ``__slots__`` and can be weakly
+    referenced. A pickled ``Node`` keeps only its id.
+  - added ``get_params`` and ``Node.get_params``.
+  - added ``get_param_array`` and ``set_param_array``, which need
+    numpy.
+  - added ``deferred``.
+
 - 0.9.0:
 
   - class ``Node`` replaces ``str`` for node IDs.
@@ -83,7 +111,8 @@ Changes
 
 TODO
 ----
-- Make operations safe on invalid and deleted node ids.
+- Make operations safe on invalid node ids, and on nodes deleted other
+  than by ``delete``.
 - Perhaps(?) accept nodepaths anywhere a node id is accepted.
 - More functions that take lists as parameters, avoiding loops of RPC calls.
 - Functions that return more info about node parameters, such as type,
@@ -91,16 +120,361 @@ TODO
 """
 
 
+import collections
+
 import terragen_rpc.jsonrpc as jr
+import terragen_rpc.disk_cache as disk_cache
+import terragen_rpc.shared_cache as shared_cache
+
+from terragen_rpc.jsonrpc import Reply, Client
+from terragen_rpc.jsonrpc import Error, ReplyError, ApiError, LowLevelError, StaleNodeError
 
-from terragen_rpc.jsonrpc import Reply
-from terragen_rpc.jsonrpc import Error, ReplyError, ApiError, LowLevelError
 
+# The most calls that get_param_array, set_param_array and get_params
+# send in one call_batch. Larger batches are sent in chunks of this size,
+# so neither side has to hold one huge request or reply.
+BATCH_CHUNK_SIZE = 1000
 
 
 def settimeout(timeout_in_seconds):
     jr.settimeout(timeout_in_seconds)
 
+def flush(client = None):
+    """Wait until Terragen has handled all the calls that were made with
+    ``wait=False``.
+
+    Calls made with ``wait=False`` are sent as JSON-RPC notifications,
+    which Terragen doesn't reply to. This makes them much faster, but
+    any errors are not reported. Calls are only sent without waiting
+    when persistent connection is enabled (see
+    ``set_persistent_connection``) and Terragen keeps connections alive.
+    Otherwise they wait as usual.
+
+    Parameters
+    ----------
+    client : Client, optional
+        The client to flush. Defaults to the default client.
+
+    Also sends the calls buffered by ``deferred``.
+
+    Raises
+    ------
+    ConnectionError
+        Raised if a connection was closed before Terragen confirmed it had
+        handled the calls made on it.
+    """
+    _client_or_default(client).flush()
+
+def deferred(client = None):
+    """Return a context manager inside which ``Node.set_param``,
+    ``Node.set_param_from_string``, ``select_just``, ``select_more``,
+    ``select_none`` and ``toggle_enable_node`` calls are buffered, and
+    then sent with one batch when the context exits. Repeated sets of the
+    same param of the same node only send the last value. Use
+    ``flush`` or the ``flush`` method of the context's value to send the
+    buffered calls sooner.
+
+    Any other call made through the client by the same thread sends the
+    buffered calls first, so reads see the buffered writes. See
+    ``terragen_rpc.jsonrpc.deferred`` for details.
+
+    Example:
+
+    .. code-block:: python
+
+        with tg.deferred():
+            for frame in range(100):
+                height = compute(height)
+                node.set_param('height', height)    # only the last is sent
+
+    Parameters
+    ----------
+    client : Client, optional
+        The client whose calls are buffered. Defaults to the default
+        client.
+
+    Returns
+    -------
+    context manager
+        Its value is a ``terragen_rpc.jsonrpc.DeferredWrites`` object.
+
+    Raises
+    ------
+    ApiError (subclass thererof)
+        Raised when the buffered calls are sent, if one of them fails.
+    """
+    return _client_or_default(client).deferred()
+
+def set_persistent_connection(enabled, client = None):
+    """Enable or disable keeping one connection to Terragen open and
+    reusing it for subsequent calls, instead of connecting for each call.
+    Disabled by default.
+
+    This can make scripts that make many calls much faster. If Terragen
+    closes the connection after each call, this falls back to making a
+    new connection for each call.
+
+    Parameters
+    ----------
+    enabled : bool
+    client : Client, optional
+        The client whose connections to keep open or not. Defaults to
+        the default client.
+    """
+    _client_or_default(client).set_persistent_connection(enabled)
+
+def set_metadata_cache(enabled, client = None):
+    """Enable or disable caching the results of ``Node.name``,
+    ``Node.path``, ``Node.parent_path``, ``Node.parent`` and
+    ``Node.children``. Disabled by default.
+
+    This makes repeated walks of the hierarchy much faster. The cache is
+    updated by calls that change the hierarchy or rename nodes, such as
+    ``create_child``, ``delete``, ``insert_clip_file``,
+    ``new_project``, ``open_project`` and setting a node's 'name' param.
+    If the project is changed in any other way, for example by the user,
+    call ``invalidate_cache``.
+
+    Parameters
+    ----------
+    enabled : bool
+    client : Client, optional
+        The client whose cache to enable or disable. Defaults to the
+        default client.
+    """
+    _client_or_default(client).set_metadata_cache(enabled)
+
+def set_schema_cache(enabled, client = None):
+    """Enable or disable caching the param names of each node class, so
+    that ``Node.param_names`` only asks Terragen once per class. Disabled
+    by default.
+
+    Terragen doesn't report the class of a node, so this only works for
+    nodes whose class is known because they were made with
+    ``create_child`` or found with ``Node.children_filtered_by_class``.
+    It assumes that all nodes of a class have the same params.
+
+    Parameters
+    ----------
+    enabled : bool
+    client : Client, optional
+        The client whose cache to enable or disable. Defaults to the
+        default client.
+    """
+    _client_or_default(client).set_schema_cache(enabled)
+
+def set_param_cache(enabled, max_size = None, ttl = None, client = None):
+    """Enable or disable caching param values read with
+    ``Node.get_param_as_string`` and the other ``get_param`` methods, or
+    change the size and time to live of the cache. Disabled by default.
+
+    Values set with ``Node.set_param`` or ``Node.set_param_from_string``
+    replace the cached values, so reads return what was written, as it
+    was written. Calls that may change other params, such as
+    ``delete``, ``new_project``, ``open_project`` and
+    ``insert_clip_file``, clear the cache. If params are changed in any
+    other way, for example by the user, call ``invalidate_cache`` or set
+    a time to live.
+
+    Parameters
+    ----------
+    enabled : bool
+    max_size : int, optional
+        The maximum number of values to cache. The least recently used
+        values are dropped first. Defaults to 4096.
+    ttl : float, optional
+        The number of seconds to keep each value. By default values are
+        kept until they are dropped for another reason.
+    client : Client, optional
+        The client whose cache to configure. Defaults to the default
+        client.
+
+    See also
+    --------
+    ``param_cache_stats``
+    """
+    _client_or_default(client).set_param_cache(enabled, max_size, ttl)
+
+def param_cache_stats(client = None):
+    """Get the hit rate and other statistics of the param value cache,
+    to help choose its size. See ``set_param_cache``.
+
+    Parameters
+    ----------
+    client : Client, optional
+        Defaults to the default client.
+
+    Returns
+    -------
+    dict | None
+        A dict with the keys 'hits', 'misses', 'hit_rate', 'evictions',
+        'expirations', 'size' and 'max_size', or None if the cache is
+        disabled.
+    """
+    cache = _client_or_default(client).param_cache
+    return cache.stats() if cache is not None else None
+
+def set_path_index(enabled, client = None):
+    """Enable or disable remembering the node at each path, so that
+    ``node_by_path`` only asks Terragen once per path. Disabled by
+    default.
+
+    Paths are remembered as they are looked up with ``node_by_path`` or
+    ``Node.path``, or all at once with ``preload_path_index``. Deleting
+    or renaming a node forgets its path and the paths of its
+    descendants, and calls such as ``new_project``, ``open_project``
+    and ``insert_clip_file`` forget all paths. If the hierarchy is
+    changed in any other way, for example by the user, call
+    ``invalidate_cache``.
+
+    Parameters
+    ----------
+    enabled : bool
+    client : Client, optional
+        The client whose index to enable or disable. Defaults to the
+        default client.
+    """
+    _client_or_default(client).set_path_index(enabled)
+
+def preload_path_index(from_node = None, client = None):
+    """Walk the hierarchy and remember the path of every node, so that
+    later calls to ``node_by_path`` don't ask Terragen. Each level of
+    the hierarchy is fetched with one ``call_batch``. Enables the path
+    index if it isn't enabled.
+
+    Parameters
+    ----------
+    from_node : Node, optional
+        The node to start from. Defaults to the root node.
+    client : Client, optional
+        The client to use if from_node is not given. Defaults to the
+        default client.
+
+    Returns
+    -------
+    int
+        The number of paths indexed.
+    """
+    if from_node is not None:
+        client = from_node.client
+    c = _client_or_default(client)
+    c.set_path_index(True)
+    index = c.path_index
+    level = [from_node.id] if from_node is not None else [root(client).id]
+    count = 0
+    while level:
+        generation = index.generation
+        calls = [('name_and_path', [id]) for id in level] + [('children', [id]) for id in level]
+        replies = c.call_batch(calls)
+        next_level = []
+        for id, path_reply, children_reply in zip(level, replies, replies[len(level):]):
+            if path_reply.ok and path_reply.value.startswith('/'):
+                index.store(path_reply.value, id, generation)
+                count += 1
+            if children_reply.ok:
+                next_level.extend(children_reply.value)
+        level = next_level
+    return count
+
+def load_disk_cache(filename, server_version = None, client = None):
+    """Load class param names, node paths and node classes saved by
+    ``save_disk_cache``, so that a script doesn't have to fetch them
+    again from Terragen. Enables the schema cache and path index (see
+    ``set_schema_cache`` and ``set_path_index``).
+
+    Class param names are loaded if they were saved from the same
+    address and server_version. Paths and classes of nodes are only
+    loaded if they were saved for the same project file with the same
+    modification time, and a sample of the paths still lead to the same
+    nodes. The project file must be readable by this process.
+
+    Parameters
+    ----------
+    filename : str
+        An SQLite file.
+    server_version : str, optional
+        Any string which identifies the version of Terragen, to avoid
+        loading metadata saved from other versions.
+    client : Client, optional
+        Defaults to the default client.
+
+    Returns
+    -------
+    bool
+        True if metadata for the current project was loaded.
+    """
+    with disk_cache.DiskCache(filename, server_version) as cache:
+        return cache.load(_client_or_default(client))
+
+def save_disk_cache(filename, server_version = None, client = None):
+    """Save the contents of the schema cache and path index to a file,
+    to be loaded by ``load_disk_cache`` in later runs. Use
+    ``preload_path_index`` first to save the paths of all nodes.
+
+    Parameters
+    ----------
+    filename : str
+        An SQLite file, which is created if it doesn't exist.
+    server_version : str, optional
+        See ``load_disk_cache``.
+    client : Client, optional
+        Defaults to the default client.
+    """
+    with disk_cache.DiskCache(filename, server_version) as cache:
+        cache.save(_client_or_default(client))
+
+def publish_shared_cache(filename, client = None):
+    """Write the contents of the metadata cache, schema cache and path
+    index to a file, so that other processes on this computer can load
+    them with ``refresh_shared_cache``. See ``terragen_rpc.shared_cache``.
+
+    Parameters
+    ----------
+    filename : str
+    client : Client, optional
+        Defaults to the default client.
+    """
+    _shared_cache(filename, client).publish(_client_or_default(client))
+
+def refresh_shared_cache(filename, client = None):
+    """Replace what the client has cached with metadata published by
+    another process with ``publish_shared_cache``, if it has been
+    published since this was last called. Enables the metadata cache,
+    schema cache and path index. If the publisher has opened another
+    project since the metadata loaded before, the client's nodes become
+    stale, as if it had opened the project itself.
+
+    Parameters
+    ----------
+    filename : str
+    client : Client, optional
+        Defaults to the default client.
+
+    Returns
+    -------
+    bool
+        True if metadata was loaded.
+    """
+    return _shared_cache(filename, client).refresh(_client_or_default(client))
+
+def _shared_cache(filename, client):
+    # Kept by the client, so that it's freed along with the client.
+    shared_caches = _client_or_default(client).shared_caches
+    if filename not in shared_caches:
+        shared_caches[filename] = shared_cache.SharedCache(filename)
+    return shared_caches[filename]
+
+def invalidate_cache(client = None):
+    """Forget everything cached about the project, so the next calls get
+    their results from Terragen. See ``set_metadata_cache``.
+
+    Parameters
+    ----------
+    client : Client, optional
+        The client whose cache to clear. Defaults to the default client.
+    """
+    _client_or_default(client).invalidate()
+
 
 # Internal utility functions
 
@@ -110,54 +484,150 @@ def _convert_value_0_or_empty_to_none(reply):
         mod.value = None
     return mod
 
-def _node_or_none(id_string):
+def _none_if_0_or_empty(value):
+    if value == '0' or value == 0 or value == '':
+        return None
+    return value
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("This function needs the numpy package, which is not installed.") from None
+    return numpy
+
+def _client_or_default(client):
+    if client is None:
+        return jr.default_client()
+    else:
+        return client
+
+def _client_of(node_or_nodes):
+    if type(node_or_nodes) is list:
+        return node_or_nodes[0].client if node_or_nodes else None
+    else:
+        return node_or_nodes.client
+
+def _live_client(node_or_nodes):
+    # Returns the client of the node(s), after checking they aren't stale.
+    if type(node_or_nodes) is list:
+        client = _client_or_default(_client_of(node_or_nodes))
+        for node in node_or_nodes:
+            client.check_node(node.id, node.epoch)
+        return client
+    return node_or_nodes._live_client()
+
+def _node_or_none(id_string, client = None):
     if id_string:
-        return Node(id_string)
+        return Node(id_string, client)
     else:
         return None
 
-def _nodes_from_ids(id_strings):
-    return [Node(i) for i in id_strings]
+def _nodes_from_ids(id_strings, client = None):
+    # Like [Node(i, client) for i in id_strings], without calling
+    # __init__ for each node, since listings can be long.
+    epoch = _client_or_default(client).epoch
+    new = object.__new__
+    nodes = []
+    append = nodes.append
+    for i in id_strings:
+        node = new(Node)
+        node.id = i
+        node.client = client
+        node.epoch = epoch
+        append(node)
+    return nodes
+
+def _int_from_param_string(rawstring):
+    words = rawstring.split()
+    if len(words) > 0:
+        return int(words[0])
+    else:
+        return 0
+
+def _float_from_param_string(rawstring):
+    words = rawstring.split()
+    if len(words) > 0:
+        return float(words[0])
+    else:
+        return 0.0
+
+def _floats_from_param_string(rawstring):
+    words = rawstring.split()
+    return [float(w) for w in words]
+
+def _param_string_from_values(values):
+    if type(values) is tuple:
+        strings = (str(i) for i in values)
+        string = ' '.join(strings)
+    elif type(values) is list:
+        strings = [str(i) for i in values]
+        string = ' '.join(strings)
+    else:
+        string = str(values)
+    return string
 
 
 
 # Public functions:
 
-def project_filepath():
+def project_filepath(client = None):
     """Get the file path and filename of the current project.
 
+    Parameters
+    ----------
+    client : Client, optional
+        The client to make the call with. Defaults to the default client.
+
     Returns
     -------
     str
         A string which is a file path.
     """
-    return jr.call('project_filepath').value
+    return _client_or_default(client).call_value('project_filepath')
 
-def root():
+def root(client = None):
     """Get the root node of the current project.
 
+    Parameters
+    ----------
+    client : Client, optional
+        The client to make the call with. Defaults to the default client.
+
     Returns
     -------
     Node | None
     """
-    reply = jr.call('root')
-    return _node_or_none(_convert_value_0_or_empty_to_none(reply).value)
+    value = _client_or_default(client).call_value('root')
+    return _node_or_none(_none_if_0_or_empty(value), client)
 
-def node_by_path(path):
+def node_by_path(path, client = None):
     """Find a node by its path in the hierarchy.
 
     Parameters
     ----------
     path : str
         Should begin with a forward slash.
+    client : Client, optional
+        The client to make the call with. Defaults to the default client.
     
     Returns
     -------
     Node | None
         A node ID if it was found, or None if it was not found.
     """
-    reply = jr.call('node_by_path', [path])
-    return _node_or_none(_convert_value_0_or_empty_to_none(reply).value)
+    c = _client_or_default(client)
+    index = c.path_index
+    if index is None:
+        value = c.call_value('node_by_path', [path])
+        return _node_or_none(_none_if_0_or_empty(value), client)
+    id = index.lookup(path)
+    if id is None:
+        generation = index.generation
+        id = _none_if_0_or_empty(c.call_value('node_by_path', [path]))
+        if id is not None:
+            index.store(path, id, generation)
+    return _node_or_none(id, client)
 
 def create_child(of_node, class_name):
     """Attempt to create a node as a child of an existing node.
@@ -193,8 +663,13 @@ def create_child(of_node, class_name):
         The ID of the new node if it was successfully created,
         otherwise None.
     """
-    reply = jr.call('create_child', [of_node.id, class_name])
-    return _node_or_none(_convert_value_0_or_empty_to_none(reply).value)
+    client = of_node.client
+    value = _live_client(of_node).call_value('create_child', [of_node.id, class_name])
+    node = _node_or_none(_none_if_0_or_empty(value), client)
+    schema_cache = _client_or_default(client).schema_cache
+    if node is not None and schema_cache is not None:
+        schema_cache.note_class(node.id, class_name)
+    return node
 
 def delete(node_or_nodes):
     """Delete node(s).
@@ -202,16 +677,287 @@ def delete(node_or_nodes):
     Parameters
     ----------
     node_or_nodes : Node | list of Node
+
+    Raises
+    ------
+    StaleNodeError
+        Raised if a node is known to have been deleted already.
     """
+    client = _live_client(node_or_nodes)
     if type(node_or_nodes) is list:
         ids = [node.id for node in node_or_nodes]
-        jr.call('delete', [ids])
+        client.call_value('delete', [ids])
     else:
-        jr.call('delete', [node_or_nodes.id])
+        client.call_value('delete', [node_or_nodes.id])
 
-def current_selection():
+def get_params(node_or_nodes, names = None):
+    """Get the string representations of many param values of one or
+    more nodes, with one ``call_batch`` for the values, and one more for
+    the param names if they are needed and not cached. Batches of more
+    than ``BATCH_CHUNK_SIZE`` calls are sent in chunks. Values are the
+    same as ``Node.get_param_as_string`` would return, and are read
+    from and stored in the param value cache if it is enabled.
+
+    Parameters
+    ----------
+    node_or_nodes : Node | list of Node
+    names : list of str, optional
+        The param names to get, for every node. Defaults to all the
+        params of each node (see ``Node.param_names``).
+
+    Returns
+    -------
+    dict | list of dict
+        A dict of param values by name if a node is given, or a list of
+        them in the same order as the nodes if a list is given.
+
+    Raises
+    ------
+    StaleNodeError
+        Raised if a node is known to no longer exist.
+    ApiError (subclass thererof)
+        Raised if a call fails, e.g. because of an invalid node or param
+        name.
+    """
+    if type(node_or_nodes) is not list:
+        return _get_params([node_or_nodes], names)[0]
+    return _get_params(node_or_nodes, names)
+
+def _get_params(nodes, names):
+    if not nodes:
+        return []
+    client = _live_client(nodes)
+    schema_cache = client.schema_cache
+
+    if names is not None:
+        names_by_node = [names] * len(nodes)
+    else:
+        names_by_node = [schema_cache.param_names(node.id) if schema_cache is not None else None
+            for node in nodes]
+        missing = [i for i, node_names in enumerate(names_by_node) if node_names is None]
+        if missing:
+            replies = _call_batch_in_chunks(client, [('param_names', [nodes[i].id]) for i in missing])
+            for i, reply in zip(missing, replies):
+                if reply.error is not None:
+                    raise reply.error
+                names_by_node[i] = reply.value
+                if schema_cache is not None:
+                    schema_cache.store_param_names(nodes[i].id, reply.value)
+
+    requests = [(node.id, name) for node, node_names in zip(nodes, names_by_node) for name in node_names]
+    values = iter(_read_param_strings(client, requests))
+    results = []
+    for node_names in names_by_node:
+        result = {}
+        for name in node_names:
+            value = next(values)
+            if isinstance(value, Exception):
+                raise value
+            result[name] = value
+        results.append(result)
+    return results
+
+def _call_batch_in_chunks(client, calls):
+    # Like client.call_batch(calls), but sends at most BATCH_CHUNK_SIZE
+    # calls per batch.
+    if len(calls) <= BATCH_CHUNK_SIZE:
+        return client.call_batch(calls)
+    replies = []
+    for start in range(0, len(calls), BATCH_CHUNK_SIZE):
+        replies.extend(client.call_batch(calls[start:start + BATCH_CHUNK_SIZE]))
+    return replies
+
+def _read_param_strings(client, requests):
+    # Reads (node_id, param_name) pairs with call_batch, through the
+    # param value cache. Returns a list of values, with the exception of
+    # each failed call in its place.
+    schema_cache = client.schema_cache
+    param_cache = client.param_cache
+    values = [None] * len(requests)
+    calls = []
+    wanted = []
+    for i, (node_id, name) in enumerate(requests):
+        generation = None
+        if param_cache is not None:
+            found, value_or_generation = param_cache.lookup(node_id, name)
+            if found:
+                values[i] = value_or_generation
+                continue
+            generation = value_or_generation
+        calls.append(('get_param_as_string', [node_id, name]))
+        wanted.append((i, generation))
+
+    for (i, generation), reply in zip(wanted, _call_batch_in_chunks(client, calls)):
+        if reply.error is not None:
+            values[i] = reply.error
+            continue
+        node_id, name = requests[i]
+        values[i] = reply.value
+        if param_cache is not None:
+            param_cache.store(node_id, name, reply.value, generation)
+        if schema_cache is not None:
+            schema_cache.note_value(node_id, name, reply.value)
+    return values
+
+def get_param_array(nodes, param_name, width = None):
+    """Get a param of many nodes as a NumPy masked array of floats, with
+    ``call_batch`` in chunks of ``BATCH_CHUNK_SIZE`` calls. Needs the
+    numpy package.
+
+    Row i of the array holds the components of the param of nodes[i],
+    e.g. x, y and z of 'translate'. The row is masked if the node is
+    known to no longer exist, the call failed, or the value doesn't have
+    ``width`` numbers.
+
+    Parameters
+    ----------
+    nodes : list of Node
+    param_name : str
+    width : int, optional
+        The number of components of the param. Defaults to the most
+        common number of components of the values read.
+
+    Returns
+    -------
+    numpy.ma.MaskedArray
+        An array of shape (len(nodes), width).
+
+    Raises
+    ------
+    ImportError
+        Raised if numpy is not installed.
+    """
+    np = _numpy()
+    client = _client_or_default(_client_of(nodes))
+    live = []
+    for i, node in enumerate(nodes):
+        try:
+            client.check_node(node.id, node.epoch)
+        except StaleNodeError:
+            continue
+        live.append(i)
+    values = _read_param_strings(client, [(nodes[i].id, param_name) for i in live])
+
+    rows = [None] * len(nodes)
+    for i, value in zip(live, values):
+        if isinstance(value, str):
+            rows[i] = value.split()
+    if width is None:
+        counts = collections.Counter(len(row) for row in rows if row)
+        width = counts.most_common(1)[0][0] if counts else 1
+
+    data = np.zeros((len(nodes), width))
+    mask = np.ones((len(nodes), width), dtype = bool)
+    valid = [i for i, row in enumerate(rows) if row is not None and len(row) == width]
+    if valid:
+        try:
+            # numpy parses all the numbers at once.
+            data[valid] = np.array([rows[i] for i in valid], dtype = np.float64)
+        except ValueError:
+            # Some value isn't numbers. Parse each row to find which.
+            parsed = []
+            for i in valid:
+                try:
+                    data[i] = np.array(rows[i], dtype = np.float64)
+                except ValueError:
+                    continue
+                parsed.append(i)
+            valid = parsed
+        mask[valid] = False
+    return np.ma.MaskedArray(data, mask)
+
+def set_param_array(nodes, param_name, array):
+    """Set a param of many nodes from the rows of a NumPy array, with
+    ``call_batch`` in chunks of ``BATCH_CHUNK_SIZE`` calls. Needs the
+    numpy package.
+
+    Row i of the array is formatted like ``Node.set_param`` formats a
+    list, and sets the param of nodes[i]. Each float is written with the
+    shortest representation which reads back as the same value of the
+    array's dtype, so a float32 0.1 is written as 0.1, and bools are
+    written as 1 and 0. Masked rows of a masked array are skipped. A
+    failed row doesn't stop the other rows from being set.
+
+    Parameters
+    ----------
+    nodes : list of Node
+    param_name : str
+    array : array_like
+        An array of shape (len(nodes), components), or (len(nodes),) for
+        a param with one component.
+
+    Returns
+    -------
+    list of Error | None
+        For each row, the exception raised setting the param, or `None`
+        if it was set or the row is masked. ``StaleNodeError`` is given
+        for nodes known to no longer exist, without calling Terragen.
+
+    Raises
+    ------
+    ImportError
+        Raised if numpy is not installed.
+    ValueError
+        Raised if the array doesn't have one row for each node, or an
+        unmasked row contains NaN or infinity, which Terragen can't set.
+    """
+    np = _numpy()
+    array = np.ma.asarray(array)
+    if array.ndim == 1:
+        array = array.reshape(-1, 1)
+    if array.ndim != 2 or len(array) != len(nodes):
+        raise ValueError("The array must have one row for each of the {} nodes.".format(len(nodes)))
+    masked = np.ma.getmaskarray(array).any(axis = 1).tolist()
+    data = array.filled(0)
+    if data.dtype.kind == 'b':
+        data = data.astype(np.int8)     # Terragen reads 1 and 0, not True and False
+    elif data.dtype.kind == 'f':
+        finite = np.isfinite(data).all(axis = 1).tolist()
+        for i, (ok, skip) in enumerate(zip(finite, masked)):
+            if not ok and not skip:
+                raise ValueError("Row {} of the array contains NaN or infinity.".format(i))
+    if data.dtype.kind == 'f' and data.dtype.itemsize < 8:
+        # str() of a numpy float32 is the shortest representation that
+        # reads back as the same float32, where a Python float would
+        # carry float64 digits, e.g. 1.100000023841858.
+        rows = [list(row) for row in data]
+    else:
+        # tolist() converts to Python numbers, whose str() is the
+        # shortest representation that reads back the same.
+        rows = data.tolist()
+
+    client = _client_or_default(_client_of(nodes))
+    errors = [None] * len(nodes)
+    calls = []
+    wanted = []
+    for i, (node, row, skip) in enumerate(zip(nodes, rows, masked)):
+        if skip:
+            continue
+        try:
+            client.check_node(node.id, node.epoch)
+        except StaleNodeError as e:
+            errors[i] = e
+            continue
+        value_string = ' '.join(map(str, row))
+        calls.append(('set_param_from_string', [node.id, param_name, value_string]))
+        wanted.append((i, node.id, value_string))
+
+    param_cache = client.param_cache
+    for (i, node_id, value_string), reply in zip(wanted, _call_batch_in_chunks(client, calls)):
+        if reply.error is not None:
+            errors[i] = reply.error
+        elif param_cache is not None:
+            param_cache.update(node_id, param_name, value_string)
+    return errors
+
+def current_selection(client = None):
     """Get a list of the nodes that are currently selected in the UI.
 
+    Parameters
+    ----------
+    client : Client, optional
+        The client to make the call with. Defaults to the default client.
+
     Returns
     -------
     list of Node
@@ -219,8 +965,8 @@ def current_selection():
         expect the order to correspond to the order in which the nodes
         were selected.
     """
-    reply = jr.call('current_selection')
-    return _nodes_from_ids(reply.value)
+    ids = _client_or_default(client).call_value('current_selection')
+    return _nodes_from_ids(ids, client)
 
 def select_just(node_or_nodes):
     """Select node(s) in the UI by path, replacing the initial
@@ -231,7 +977,7 @@ def select_just(node_or_nodes):
     node_or_nodes : Node | list of Node
         A node ID or a list of node IDs
     """
-    select_none()
+    select_none(_client_of(node_or_nodes))
     select_more(node_or_nodes)
 
 def select_more(node_or_nodes):
@@ -243,41 +989,57 @@ def select_more(node_or_nodes):
     node_or_nodes : Node | list of Node
         A node ID or a list of node IDs
     """
+    client = _live_client(node_or_nodes)
     if True:
         # The following works with server versions 0.7.x and 0.8.x,
         # but is deprecated:
 
         if type(node_or_nodes) is list:
             ids = [node.id for node in node_or_nodes]
-            jr.call('select_more_as_array', [ids])
+            client.write('select_more_as_array', [ids])
         else:
-            jr.call('select_one_more', [node_or_nodes.id])
+            client.write('select_one_more', [node_or_nodes.id])
     else:
         # The following works with server versions 0.8.0+,
         # and we'll start using this soon:
 
         if type(node_or_nodes) is list:
             ids = [node.id for node in node_or_nodes]
-            jr.call('select_more', [ids])
+            client.write('select_more', [ids])
         else:
-            jr.call('select_more', [node_or_nodes.id])
+            client.write('select_more', [node_or_nodes.id])
 
-def select_none():
+def select_none(client = None, wait = True):
     """Clear the node selection state in the UI.
+
+    Parameters
+    ----------
+    client : Client, optional
+        The client to make the call with. Defaults to the default client.
+    wait : bool, optional
+        If `False`, don't wait for the server to handle the call. See
+        ``flush``. Defaults to `True`.
     """
-    jr.call('select_none')
+    _client_or_default(client).write('select_none', [], wait)
 
-def new_project():
+def new_project(client = None):
     """Close the current project without saving, and start a new project.
-        """
-    jr.call('new_project')
 
-def open_project(filename):
+    Parameters
+    ----------
+    client : Client, optional
+        The client to make the call with. Defaults to the default client.
+    """
+    _client_or_default(client).call_value('new_project')
+
+def open_project(filename, client = None):
     """Close the current project without saving, and open a project file.
 
     Parameters
     ----------
     filename : str
+    client : Client, optional
+        The client to make the call with. Defaults to the default client.
     
     Returns
     -------
@@ -290,14 +1052,16 @@ def open_project(filename):
     success can be determined from the return value. Should we raise
     an exception instead of returning False?
     """
-    return jr.call('open_project', [filename]).value
+    return _client_or_default(client).call_value('open_project', [filename])
 
-def save_project(filename):
+def save_project(filename, client = None):
     """Save the project as 'filename'.
 
     Parameters
     ----------
     filename : str
+    client : Client, optional
+        The client to make the call with. Defaults to the default client.
     
     Returns
     -------
@@ -310,9 +1074,9 @@ def save_project(filename):
     success can be determined from the return value. Should we raise
     an exception instead of returning False?
     """
-    return jr.call('save_project', [filename]).value
+    return _client_or_default(client).call_value('save_project', [filename])
 
-def insert_clip_file(filename):
+def insert_clip_file(filename, client = None):
     """Load a clip file into the project. This is similar to choosing
     "Insert Clip File..." from the File menu and clicking "Add", not
     "Insert".
@@ -324,6 +1088,8 @@ def insert_clip_file(filename):
     Parameters
     ----------
     filename : str
+    client : Client, optional
+        The client to make the call with. Defaults to the default client.
     
     Returns
     -------
@@ -346,7 +1112,7 @@ def insert_clip_file(filename):
     --------
     ``insert_clip_file_after``, ``insert_clip_file_before``
     """
-    return jr.call('insert_clip_file', [filename]).value
+    return _client_or_default(client).call_value('insert_clip_file', [filename])
 
 def insert_clip_file_after(filename, input_node):
     """Load a clip file into the project, and connect it into the
@@ -387,7 +1153,8 @@ def insert_clip_file_after(filename, input_node):
     --------
     ``insert_clip_file``, ``insert_clip_file_before``
     """
-    return jr.call('insert_clip_file_after', [filename, input_node.id]).value
+    client = _live_client(input_node)
+    return client.call_value('insert_clip_file_after', [filename, input_node.id])
 
 def insert_clip_file_before(filename, output_node, output_param = 'input_node'):
     """Load a clip file into the project, and connect it into the node
@@ -435,28 +1202,84 @@ def insert_clip_file_before(filename, output_node, output_param = 'input_node'):
     --------
     ``insert_clip_file``, ``insert_clip_file_after``
     """
-    return jr.call('insert_clip_file_before', [filename, output_node.id, output_param]).value
+    client = _live_client(output_node)
+    return client.call_value('insert_clip_file_before', [filename, output_node.id, output_param])
 
 
 
 
 class Node:
     """A node ID.
+
+    Parameters
+    ----------
+    id : str
+    client : Client, optional
+        The client used by this node's methods, and by the nodes they
+        return. Defaults to the default client.
+
+    Methods raise ``StaleNodeError`` without contacting Terragen if the
+    node is known to no longer exist, because it was deleted with
+    ``delete`` or the project was closed by ``new_project`` or
+    ``open_project`` after the node was created.
+
+    Nodes with the same id and client are equal, and are hashable, so
+    they can be used in sets and as dict keys. They can also be weakly
+    referenced. A pickled node keeps only its id, and is unpickled as a
+    node of the default client.
     """
-    id = None
+    __slots__ = ('id', 'client', 'epoch', '__weakref__')
 
-    def __init__(self, id):
+    def __init__(self, id, client = None):
         self.id = id
+        self.client = client
+        self.epoch = _client_or_default(client).epoch
+
+    def __reduce__(self):
+        # A client can't be pickled, and the node's epoch only has a
+        # meaning in this process.
+        return (self.__class__, (self.id,))
 
     def __eq__(self, other):
-        return isinstance(other, self.__class__) and self.id == other.id
+        if self is other:
+            return True
+        return (isinstance(other, self.__class__) and self.id == other.id
+            and _client_or_default(self.client) is _client_or_default(other.client))
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    def __hash__(self):
+        return hash(self.id)
+
     def __bool__(self):
         return bool(self.id)
 
+    def _live_client(self):
+        client = _client_or_default(self.client)
+        client.check_node(self.id, self.epoch)
+        return client
+
+    def _call(self, method, params):
+        return self._live_client().call_value(method, params)
+
+    def _cached_call(self, method):
+        client = self._live_client()
+        cache = client.metadata_cache
+        if cache is None:
+            return client.call_value(method, [self.id])
+        found, value_or_generation = cache.lookup(method, self.id)
+        if found:
+            return value_or_generation
+        value = client.call_value(method, [self.id])
+        cache.store(method, self.id, value, value_or_generation)
+        return value
+
+    def invalidate_cache(self):
+        """Forget anything cached about this node, so the next calls get
+        their results from Terragen. See ``set_metadata_cache``.
+        """
+        _client_or_default(self.client).invalidate(self.id)
 
     def name(self):
         """Get the name of the node.
@@ -466,7 +1289,7 @@ class Node:
         str
             The name of the node.
         """
-        return jr.call('name', [self.id]).value
+        return self._cached_call('name')
 
     def path(self):
         """Get the full path in the hierarchy if the node has a parent,
@@ -482,14 +1305,20 @@ class Node:
             root node or an out-of-hierarchy node), the path is just the
             name of the node.
         """
+        index = self._live_client().path_index
+        if index is not None:
+            generation = index.generation
         if True:
             # The following works with server versions 0.7.x, 0.8.x and
             # 0.9.x, but is deprecated:
-            return jr.call('name_and_path', [self.id]).value
+            path = self._cached_call('name_and_path')
         else:
             # The following works with server versions 0.8.0+,
             # and we'll start using this soon:
-            return jr.call('path', [self.id]).value
+            path = self._cached_call('path')
+        if index is not None:
+            index.store(path, self.id, generation)
+        return path
 
     def parent_path(self):
         """Get the path of the node's parent in the hierarchy.
@@ -499,7 +1328,7 @@ class Node:
         str
             A string which is the path of the node's parent
         """
-        return jr.call('parent_path', [self.id]).value
+        return self._cached_call('parent_path')
 
     def parent(self):
         """Get the parent node.
@@ -508,8 +1337,7 @@ class Node:
         -------
         Node | None
         """
-        reply = jr.call('parent', [self.id])
-        return _node_or_none(_convert_value_0_or_empty_to_none(reply).value)
+        return _node_or_none(_none_if_0_or_empty(self._cached_call('parent')), self.client)
 
     def children(self):
         """Get the children as a list of node IDs.
@@ -519,8 +1347,7 @@ class Node:
         list of Node
             A list of IDs of the node's children.
         """
-        reply = jr.call('children', [self.id])
-        return _nodes_from_ids(reply.value)
+        return _nodes_from_ids(self._cached_call('children'), self.client)
 
     def children_filtered_by_class(self, class_name):
         """Get a list of nodes of a particular class.
@@ -539,8 +1366,12 @@ class Node:
         list of Node
             A list of IDs of the node's children that match the class_name.
         """
-        reply = jr.call('children_filtered_by_class', [self.id, class_name])
-        return _nodes_from_ids(reply.value)
+        ids = self._call('children_filtered_by_class', [self.id, class_name])
+        schema_cache = self._live_client().schema_cache
+        if schema_cache is not None:
+            for id in ids:
+                schema_cache.note_class(id, class_name)
+        return _nodes_from_ids(ids, self.client)
     
     def param_names(self):
         """Get a list of the node's parameters.
@@ -550,7 +1381,14 @@ class Node:
         list of str
             A list of names of the node's parameters.
         """
-        return jr.call('param_names', [self.id]).value
+        schema_cache = self._live_client().schema_cache
+        if schema_cache is None:
+            return self._call('param_names', [self.id])
+        names = schema_cache.param_names(self.id)
+        if names is None:
+            names = self._call('param_names', [self.id])
+            schema_cache.store_param_names(self.id, names)
+        return names
 
     def get_param(self, param_name):
         """Get a parameter’s value, which may be a string, number or list of numbers.
@@ -561,6 +1399,23 @@ class Node:
         """
         return self.get_param_as_string(param_name)
 
+    def get_params(self, names = None):
+        """Get the string representations of many param values with one
+        round trip. See the module function ``get_params``, which also
+        accepts a list of nodes.
+
+        Parameters
+        ----------
+        names : list of str, optional
+            The param names to get. Defaults to all the node's params.
+
+        Returns
+        -------
+        dict
+            The param values by name.
+        """
+        return _get_params([self], names)[0]
+
     def get_param_as_string(self, param_name):
         """Get a string representation of a parameter's current value.
 
@@ -580,7 +1435,18 @@ class Node:
         ----
         What if the param_name is invalid?
         """
-        return jr.call('get_param_as_string', [self.id, param_name]).value
+        client = self._live_client()
+        param_cache = client.param_cache
+        if param_cache is not None:
+            found, value_or_generation = param_cache.lookup(self.id, param_name)
+            if found:
+                return value_or_generation
+        value = client.call_value('get_param_as_string', [self.id, param_name])
+        if param_cache is not None:
+            param_cache.store(self.id, param_name, value, value_or_generation)
+        if client.schema_cache is not None:
+            client.schema_cache.note_value(self.id, param_name, value)
+        return value
 
     def get_param_as_int(self, param_name):
         """Get a parameter’s value as an integer.
@@ -599,11 +1465,7 @@ class Node:
         What if the param_name is invalid?
         """
         rawstring = self.get_param_as_string(param_name)
-        words = rawstring.split()
-        if len(words) > 0:
-            return int(words[0])
-        else:
-            return 0
+        return _int_from_param_string(rawstring)
 
     def get_param_as_float(self, param_name):
         """Get a parameter’s value as a float.
@@ -622,11 +1484,7 @@ class Node:
         What if the param_name is invalid?
         """
         rawstring = self.get_param_as_string(param_name)
-        words = rawstring.split()
-        if len(words) > 0:
-            return float(words[0])
-        else:
-            return 0.0
+        return _float_from_param_string(rawstring)
 
     def get_param_as_tuple(self, param_name):
         """Get a parameter’s value as a tuple of 1, 2, or 3 floats.
@@ -646,8 +1504,7 @@ class Node:
         What if the param_name is invalid?
         """
         rawstring = self.get_param_as_string(param_name)
-        words = rawstring.split()
-        return tuple(float(w) for w in words)
+        return tuple(_floats_from_param_string(rawstring))
 
     def get_param_as_list(self, param_name):
         """Get a parameter’s value as a list of 1, 2, or 3 floats.
@@ -667,10 +1524,9 @@ class Node:
         What if the param_name is invalid?
         """
         rawstring = self.get_param_as_string(param_name)
-        words = rawstring.split()
-        return [float(w) for w in words]
+        return _floats_from_param_string(rawstring)
 
-    def set_param(self, param_name, values):
+    def set_param(self, param_name, values, wait = True):
         """Set a parameter’s value using a string, number, tuple of numbers
         or list of numbers.
 
@@ -683,21 +1539,18 @@ class Node:
             representation of the value and ``set_param_from_string`` is
             called. Other types are cast to str using str() and
             ``set_param_from_string`` is called.
+        wait : bool, optional
+            If `False`, don't wait for the server to handle the call. See
+            ``flush``. Defaults to `True`.
+
         TODO
         ----
         What if the param_name is invalid?
         """
-        if type(values) is tuple:
-            strings = (str(i) for i in values)
-            string = ' '.join(strings)
-        elif type(values) is list:
-            strings = [str(i) for i in values]
-            string = ' '.join(strings)
-        else:
-            string = str(values)
-        self.set_param_from_string(param_name, string)
+        string = _param_string_from_values(values)
+        self.set_param_from_string(param_name, string, wait)
 
-    def set_param_from_string(self, param_name, value_string):
+    def set_param_from_string(self, param_name, value_string, wait = True):
         """Set a parameter's value using a string representation which
         follows the same rules used by Terragen XML files.
 
@@ -709,12 +1562,20 @@ class Node:
             A string representation of the parameter value. For 2D vectors,
             3D vectors and colours, the string must contain numbers
             separated by spaces.
+        wait : bool, optional
+            If `False`, don't wait for the server to handle the call. See
+            ``flush``. Defaults to `True`.
 
         TODO
         ----
         What if the param_name is invalid?
         """
-        jr.call('set_param_from_string', [self.id, param_name, value_string])
+        client = self._live_client()
+        # A write which was buffered or not waited for may still be
+        # rejected, so the client has only dropped the cached value.
+        confirmed = client.write('set_param_from_string', [self.id, param_name, value_string], wait)
+        if confirmed and client.param_cache is not None:
+            client.param_cache.update(self.id, param_name, value_string)
 
 
 
@@ -862,13 +1723,16 @@ def set_param_from_string(node, param_name, value_string):
     """
     node.set_param_from_string(param_name, value_string)
 
-def toggle_enable_node(node):
+def toggle_enable_node(node, wait = True):
     """DEPRECATED. Toggle the enabled/disabled parameter of a node if it has one.
 
     Parameters
     ----------
     node : Node
         A node ID
+    wait : bool, optional
+        If `False`, don't wait for the server to handle the call. See
+        ``flush``. Defaults to `True`.
 
     Note
     ----
@@ -877,4 +1741,4 @@ def toggle_enable_node(node):
     node.set_param_from_string('enable', '1') or
     node.set_param_from_string('enable', '0')
     """
-    jr.call('toggle_enable_node', [node.id])
+    _live_client(node).write('toggle_enable_node', [node.id], wait)
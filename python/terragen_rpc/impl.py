@@ -23,88 +23,1212 @@
 
 import json
 import socket
+import threading
+import time
+import weakref
+
+from json.encoder import encode_basestring_ascii
+
+from terragen_rpc.codec import get_codec
 
 TCP_IP = 'localhost'
 TCP_PORT = 36971
 SOCKET_TIMEOUT = 10     # can be set with terragen_rpc.settimeout()
+PERSISTENT_CONNECTION = False   # can be set with terragen_rpc.set_persistent_connection()
+CODEC = get_codec()     # can be set with terragen_rpc.jsonrpc.set_codec()
+
+POOL_MIN_SIZE = 0       # these can be set with terragen_rpc.jsonrpc.configure_connection_pool()
+POOL_MAX_SIZE = 4
+POOL_IDLE_TIMEOUT = 60
+PIPELINE_DEPTH = 64     # maximum number of pipelined requests awaiting replies
+RECV_BUFFER_SIZE = 4096     # initial buffer size for replies whose length isn't known
+
+_MAX_BUFFERS_PER_SEND = 512 # well below IOV_MAX on supported platforms
 
 running_id = 1
+_running_id_lock = threading.Lock()
 
 def settimeout(timeout_in_seconds):
     global SOCKET_TIMEOUT
     SOCKET_TIMEOUT = timeout_in_seconds
 
-def generate_query_string(method, params = []):
+def _next_id():
     global running_id
-    msg = json.dumps(
-        {
-            'jsonrpc': '2.0',
-            'method': method,
-            'params': params,
-            'id': running_id
-        }
-    )
-    running_id += 1
+    with _running_id_lock:
+        id = running_id
+        running_id += 1
+    return id
+
+def generate_query_string(method, params = []):
+    msg, id = generate_query_string_and_id(method, params)
     return msg
 
+def generate_query_string_and_id(method, params = []):
+    return default_transport.generate_query_string_and_id(method, params)
+
+def generate_query_bytes_and_id(method, params = []):
+    return default_transport.generate_query_bytes_and_id(method, params)
+
+def generate_batch_query_string(calls):
+    """Generate a JSON-RPC batch request for a list of (method, params)
+    pairs, and return it along with the list of request ids in the same
+    order.
+    """
+    return default_transport.generate_batch_query_string(calls)
+
 def generate_invalid_query_string(note):
-    global running_id
     msg = json.dumps(
         {
             'note': note
         }
     )
-    running_id += 1
+    _next_id()
     return msg
 
 def generate_notification_string(method, params = []):
-    return json.dumps(
-        {
-            'jsonrpc': '2.0',
-            'method': method,
-            'params': params
-        }
-    )
+    return generate_notification_bytes(method, params).decode()
+
+def generate_notification_bytes(method, params = []):
+    return default_transport.generate_notification_bytes(method, params)
+
+def set_persistent_connection(enabled):
+    default_transport.set_persistent_connection(enabled)
+
+def close_persistent_connection():
+    default_transport.close()
+
+def configure_connection_pool(min_size = None, max_size = None, idle_timeout = None):
+    default_transport.configure_connection_pool(min_size, max_size, idle_timeout)
+
+def set_codec(codec):
+    default_transport.set_codec(codec)
+
+
+class RequestTemplates:
+    """Builds requests by splicing the id and params into a cached
+    template for each method, which is much faster than encoding a new
+    dict with Python's json module. Used by a Transport when its codec's
+    ``use_request_templates`` is True.
+
+    Params given as a list or tuple whose items are str, int, float,
+    bool or None are spliced in. Requests with other params, such as a
+    dict or an item which is a list, are encoded by the codec as usual
+    and counted as misses.
+
+    Attributes
+    ----------
+    hits : int
+        The number of requests built from a template.
+    misses : int
+        The number of requests which had to be encoded by the codec,
+        including the first request for each method.
+    """
+
+    MAX_METHODS = 256   # more than the number of RPC methods
+
+    def __init__(self):
+        self._templates = {}
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """Return the hit and miss counts as a dict with the keys 'hits',
+        'misses' and 'methods' (the number of cached templates).
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'methods': len(self._templates)}
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, method, params, id = None):
+        """Return the request as bytes, or `None` if it can't be built
+        from a template, in which case the caller should encode it.
+        A notification is built if id is `None`.
+        """
+        if type(params) not in (list, tuple):
+            self.misses += 1
+            return None     # e.g. params by name, which the codec encodes as an object
+        template = self._templates.get(method)
+        if template is None:
+            self.misses += 1
+            if len(self._templates) < self.MAX_METHODS and type(method) is str:
+                self._templates[method] = '{"jsonrpc":"2.0","method":' \
+                    + encode_basestring_ascii(method) + ',"params":['
+            return None
+
+        parts = []
+        for value in params:
+            value_type = type(value)
+            if value_type is str:
+                parts.append(encode_basestring_ascii(value))
+            elif value_type is int:
+                parts.append(int.__repr__(value))
+            elif value_type is float and value - value == 0.0:    # not inf or nan
+                parts.append(float.__repr__(value))
+            elif value is None:
+                parts.append('null')
+            elif value is True:
+                parts.append('true')
+            elif value is False:
+                parts.append('false')
+            else:
+                self.misses += 1
+                return None
+        self.hits += 1
+        if id is None:
+            return (template + ','.join(parts) + ']}').encode()
+        return (template + ','.join(parts) + '],"id":' + int.__repr__(id) + '}').encode()
+
+
+class Transport:
+    """The address, timeout, request ids and connections used to make
+    calls to one Terragen RPC server.
+
+    Attributes
+    ----------
+    address : tuple
+        The (host, port) of the server.
+    timeout : float
+        The socket timeout in seconds.
+    persistent : bool
+        Whether connections are pooled and reused, rather than made for
+        each request.
+    codec : terragen_rpc.codec.Codec
+        Encodes requests and decodes replies.
+    request_templates : RequestTemplates
+        Builds requests for codecs which use them.
+    """
+
+    def __init__(self, host = 'localhost', port = 36971, timeout = 10, persistent = False, codec = None):
+        self.address = (host, port)
+        self.timeout = timeout
+        self.persistent = persistent
+        self.codec = get_codec(codec)
+        self.request_templates = RequestTemplates()
+        self.pool_min_size = 0
+        self.pool_max_size = 4
+        self.pool_idle_timeout = 60
+        self._running_id = 1
+        self._running_id_lock = threading.Lock()
+        self._pool = None
+        self._retired_pools = []    # closed pools which may still have lost notifications to report
+        self._pool_lock = threading.Lock()
+        self._async_pools = weakref.WeakKeyDictionary()     # terragen_rpc.aio connections, by event loop
+
+    def next_id(self):
+        with self._running_id_lock:
+            id = self._running_id
+            self._running_id += 1
+        return id
+
+    def settimeout(self, timeout_in_seconds):
+        self.timeout = timeout_in_seconds
+
+    def set_persistent_connection(self, enabled):
+        self.persistent = enabled
+        if not enabled:
+            self.close()
+
+    def configure_connection_pool(self, min_size = None, max_size = None, idle_timeout = None):
+        if min_size is not None:
+            self.pool_min_size = min_size
+        if max_size is not None:
+            self.pool_max_size = max_size
+        if idle_timeout is not None:
+            self.pool_idle_timeout = idle_timeout
+        if max_size is not None and self.pool_min_size > self.pool_max_size:
+            self.pool_min_size = self.pool_max_size
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.configure(self.pool_min_size, self.pool_max_size, self.pool_idle_timeout)
+
+    def set_codec(self, codec):
+        self.codec = get_codec(codec)
+
+    def close(self):
+        """Close pooled connections, including the idle connections of
+        ``terragen_rpc.aio``. Connections are made again as needed.
+        """
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._retired_pools.append(self._pool)
+                self._pool = None
+            async_pools = list(self._async_pools.values())
+            self._async_pools.clear()
+        for pool in async_pools:
+            pool.close()
+
+    def get_async_pool(self, loop, factory):
+        """Get the pool of ``terragen_rpc.aio`` connections used from an
+        event loop, made with ``factory(loop)`` if there isn't one yet.
+        Its ``close()`` is called by `close`, from any thread.
+        """
+        with self._pool_lock:
+            pool = self._async_pools.get(loop)
+            if pool is None:
+                pool = self._async_pools[loop] = factory(loop)
+            return pool
+
+    def generate_query_string_and_id(self, method, params = []):
+        msg_bytes, id = self.generate_query_bytes_and_id(method, params)
+        return msg_bytes.decode(), id
+
+    def generate_query_bytes_and_id(self, method, params = []):
+        id = self.next_id()
+        if self.codec.use_request_templates:
+            msg_bytes = self.request_templates.encode(method, params, id)
+            if msg_bytes is not None:
+                return msg_bytes, id
+        msg_bytes = self.codec.encode(
+            {
+                'jsonrpc': '2.0',
+                'method': method,
+                'params': params,
+                'id': id
+            }
+        )
+        return msg_bytes, id
+
+    def generate_notification_bytes(self, method, params = []):
+        if self.codec.use_request_templates:
+            msg_bytes = self.request_templates.encode(method, params)
+            if msg_bytes is not None:
+                return msg_bytes
+        return self.codec.encode(
+            {
+                'jsonrpc': '2.0',
+                'method': method,
+                'params': params
+            }
+        )
+
+    def generate_batch_query_string(self, calls):
+        msg_bytes, ids = self.generate_batch_query_bytes(calls)
+        return msg_bytes.decode(), ids
+
+    def generate_batch_query_bytes(self, calls):
+        ids = []
+        requests = []
+        for method, params in calls:
+            id = self.next_id()
+            ids.append(id)
+            requests.append(
+                {
+                    'jsonrpc': '2.0',
+                    'method': method,
+                    'params': params,
+                    'id': id
+                }
+            )
+        return self.codec.encode(requests), ids
+
+    def deserialize_reply(self, reply_bytes):
+        return self.codec.decode(reply_bytes)
+
+    def send_bytes_with_length_info(self, msg_bytes, retry = False):
+        """
+        Parameters
+        ----------
+        msg_bytes : bytes
+        retry : bool
+            Whether the request may be sent again if a reused connection
+            is closed after it was sent but before any reply arrived.
+            Only safe for requests which don't change anything. See
+            `Connection.exchange`.
+
+        Raises
+        ------
+        ConnectionError
+        TimeoutError
+        """
+        if self.persistent:
+            return self._get_connection_pool().exchange(msg_bytes, retry)
+
+        connection = Connection(self.address, self.timeout)
+        try:
+            return connection.exchange(msg_bytes, retry)
+        finally:
+            connection.close()
+
+    def send_notification_bytes(self, msg_bytes):
+        """Send a notification without waiting for the server to handle
+        it, if possible. That's only possible with persistent connection
+        enabled, on a connection which the server keeps alive.
+
+        Returns
+        -------
+        bool
+            True if the notification was sent, or False if it wasn't
+            possible, in which case the caller should make a normal call
+            instead.
+
+        Raises
+        ------
+        ConnectionError
+        TimeoutError
+        """
+        if not self.persistent:
+            return False
+        pool = self._get_connection_pool()
+        connection = pool.acquire()
+        try:
+            if not connection.keeps_alive:
+                return False
+            connection.send_notification(msg_bytes)
+            return True
+        finally:
+            pool.release(connection)
+
+    def flush(self, barrier_msg_bytes):
+        """Wait until the server has handled all notifications sent on
+        idle connections, by sending a request on each connection which
+        has unconfirmed notifications and waiting for the reply.
+
+        Returns
+        -------
+        int
+            The number of notifications which may have been lost because
+            their connection was closed before they were confirmed.
+
+        Raises
+        ------
+        ConnectionError
+        TimeoutError
+        """
+        with self._pool_lock:
+            pool = self._pool
+            retired = self._retired_pools
+            # Connections lent out by a closed pool are discarded, and
+            # counted by it, when they are released.
+            self._retired_pools = [p for p in retired if p.size]
+        lost = sum(p.take_lost_notifications() for p in retired)
+        if pool is None:
+            return lost
+        connections = pool.acquire_unconfirmed()
+        try:
+            for connection in connections:
+                if connection.unconfirmed_notifications:
+                    # Sending the barrier again is harmless. Notifications
+                    # lost with the closed socket are counted by it.
+                    connection.exchange(barrier_msg_bytes, retry = True)
+                lost += connection.lost_notifications
+                connection.lost_notifications = 0
+        finally:
+            for connection in connections:
+                pool.release(connection)
+        return lost + pool.take_lost_notifications()
+
+    def send_bytes_pipelined(self, msgs, retry = False):
+        """
+        Raises
+        ------
+        ConnectionError
+        TimeoutError
+        """
+        if self.persistent:
+            return self._get_connection_pool().exchange_many(msgs, retry)
+
+        connection = Connection(self.address, self.timeout)
+        try:
+            return connection.exchange_many(msgs, retry = retry)
+        finally:
+            connection.close()
+
+    def _get_connection_pool(self):
+        address = self.address
+        timeout = self.timeout
+        with self._pool_lock:
+            if self._pool is None or self._pool.address != address:
+                if self._pool is not None:
+                    self._pool.close()
+                    self._retired_pools.append(self._pool)
+                self._pool = ConnectionPool(address, timeout,
+                    self.pool_min_size, self.pool_max_size, self.pool_idle_timeout)
+            elif self._pool.timeout != timeout:
+                self._pool.settimeout(timeout)
+            return self._pool
+
+
+class _DefaultTransport(Transport):
+    """The transport used by the module-level functions. Its settings
+    are kept in this module's globals, so that code which sets TCP_IP,
+    TCP_PORT etc. directly keeps working.
+    """
+
+    def __init__(self):
+        self.request_templates = RequestTemplates()
+        self._pool = None
+        self._retired_pools = []
+        self._pool_lock = threading.Lock()
+        self._async_pools = weakref.WeakKeyDictionary()
+
+    @property
+    def address(self):
+        return (TCP_IP, TCP_PORT)
+
+    @address.setter
+    def address(self, address):
+        global TCP_IP, TCP_PORT
+        TCP_IP, TCP_PORT = address
+
+    @property
+    def timeout(self):
+        return SOCKET_TIMEOUT
+
+    @timeout.setter
+    def timeout(self, timeout):
+        settimeout(timeout)
+
+    @property
+    def persistent(self):
+        return PERSISTENT_CONNECTION
+
+    @persistent.setter
+    def persistent(self, enabled):
+        global PERSISTENT_CONNECTION
+        PERSISTENT_CONNECTION = enabled
+
+    @property
+    def pool_min_size(self):
+        return POOL_MIN_SIZE
+
+    @pool_min_size.setter
+    def pool_min_size(self, size):
+        global POOL_MIN_SIZE
+        POOL_MIN_SIZE = size
+
+    @property
+    def pool_max_size(self):
+        return POOL_MAX_SIZE
+
+    @pool_max_size.setter
+    def pool_max_size(self, size):
+        global POOL_MAX_SIZE
+        POOL_MAX_SIZE = size
+
+    @property
+    def pool_idle_timeout(self):
+        return POOL_IDLE_TIMEOUT
+
+    @pool_idle_timeout.setter
+    def pool_idle_timeout(self, timeout):
+        global POOL_IDLE_TIMEOUT
+        POOL_IDLE_TIMEOUT = timeout
+
+    @property
+    def codec(self):
+        return CODEC
+
+    @codec.setter
+    def codec(self, codec):
+        global CODEC
+        CODEC = codec
+
+    def next_id(self):
+        return _next_id()
+
+
+class Connection:
+    """A TCP connection to the Terragen RPC server which can be reused
+    for more than one request.
 
-def send_bytes_with_length_info(msg_bytes):
+    Requests are always framed with a 4-byte little-endian length. If the
+    server frames its replies the same way, the socket is kept open after
+    each reply and reused by the next request. If the server replies with
+    unframed JSON and closes the socket (as servers up to 0.9.x do), the
+    connection falls back to connecting once per request.
+
+    Attributes
+    ----------
+    keeps_alive : bool or None
+        `True` if the server has been seen to frame its replies and keep
+        the connection open, `False` if it closes the connection after
+        each reply, or `None` if no reply has been received yet.
+    unconfirmed_notifications : int
+        The number of notifications sent since the last reply was
+        received. A server handles the messages on a connection in
+        order, so a reply confirms that earlier notifications were
+        handled.
+    lost_notifications : int
+        The number of notifications which were unconfirmed when the
+        connection was closed, and may not have been handled.
+    """
+
+    keeps_alive = None
+    unconfirmed_notifications = 0
+    lost_notifications = 0
+
+    def __init__(self, address, timeout):
+        self.address = address
+        self.timeout = timeout
+        self.last_used = time.monotonic()
+        self._sock = None
+
+    def _connect(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.settimeout(self.timeout)
+        # Small requests on a reused socket must not wait for the
+        # server's delayed ACK of the previous reply.
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            s.connect(self.address)
+        except:
+            s.close()
+            raise
+        self._sock = s
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+        if self._sock is not None:
+            self._sock.settimeout(timeout)
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        self.lost_notifications += self.unconfirmed_notifications
+        self.unconfirmed_notifications = 0
+
+    def is_healthy(self):
+        """Check that an idle socket hasn't been closed by the server.
+
+        An idle socket should have nothing to read. If it's readable,
+        the server has either closed it or sent something we didn't ask
+        for, and either way it can't be reused.
+        """
+        if self._sock is None:
+            return True
+        # A non-blocking peek works for any file descriptor, unlike
+        # select.select(), which fails for descriptors of 1024 or more.
+        try:
+            self._sock.setblocking(False)
+            try:
+                self._sock.recv(1, socket.MSG_PEEK)
+            finally:
+                self._sock.settimeout(self.timeout)
+        except BlockingIOError:
+            return True     # nothing to read
+        except OSError:
+            return False
+        return False        # data, or b'' because the server closed it
+
+    def exchange(self, msg_bytes, retry = False):
+        """Send a request and return the reply bytes.
+
+        If a reused socket turns out to have been dropped by the server
+        before the request could be sent, we reconnect and send the
+        request once more. If the server closes it after the request was
+        sent but before any part of the reply was received, the server
+        may already have handled the request, so it's only sent again if
+        retry is `True`, and ConnectionError is raised otherwise.
+
+        Raises
+        ------
+        ConnectionError
+        TimeoutError
+        """
+        return self._exchange_frames([msg_bytes], retry)[0]
+
+    def send_notification(self, msg_bytes):
+        """Send a notification, for which the server doesn't reply.
+
+        This may only be used once the server has been seen to keep the
+        connection alive. Otherwise we couldn't tell whether the server
+        closing the connection means it has handled the notification.
+
+        Raises
+        ------
+        ConnectionError
+        TimeoutError
+        """
+        if not self.keeps_alive:
+            raise ConnectionError("Notifications can only be sent on a connection the server keeps alive.")
+        self.last_used = time.monotonic()
+        if self._sock is None:
+            self._connect()
+        try:
+            self._send([msg_bytes])
+        except socket.timeout as e:
+            self.close()
+            raise TimeoutError(e) # in case socket.timeout is not an alias for TimeoutError
+        except:
+            self.close()
+            raise
+        self.unconfirmed_notifications += 1
+
+    def exchange_many(self, msgs, depth = None, retry = False):
+        """Send several requests and return a list of the reply bytes in
+        the order they were received.
+
+        If the server keeps the connection alive, up to ``depth``
+        requests are written back to back before their replies are read.
+        Otherwise the requests are sent one at a time. See `exchange`
+        for retry.
+
+        Raises
+        ------
+        ConnectionError
+        TimeoutError
+        """
+        if depth is None:
+            depth = PIPELINE_DEPTH
+        replies = []
+        start = 0
+        if msgs and not self.keeps_alive:
+            # Find out whether the server keeps connections alive.
+            replies.append(self.exchange(msgs[0], retry))
+            start = 1
+        if not self.keeps_alive:
+            replies.extend(self.exchange(msg, retry) for msg in msgs[start:])
+            return replies
+        for i in range(start, len(msgs), depth):
+            replies.extend(self._exchange_frames(msgs[i:i + depth], retry))
+        return replies
+
+    def _exchange_frames(self, msgs, retry):
+        self.last_used = time.monotonic()
+        reused = self._sock is not None
+        if not reused:
+            self._connect()
+        try:
+            sent = True
+            try:
+                self._send(msgs)
+            except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+                if not reused:
+                    raise
+                sent = False
+            header = self._recv_up_to(4) if sent else b''
+            if not header and reused:
+                # The server closed the idle connection. If the requests
+                # couldn't be sent, or the caller says they are safe to
+                # repeat, try again on a new socket. Otherwise the server
+                # may already have handled them, so the failure is raised.
+                if sent and not retry:
+                    raise ConnectionError("Terragen RPC server closed the connection without replying. The request may have been handled, so it wasn't sent again.")
+                self.close()
+                self._connect()
+                self._send(msgs)
+                header = self._recv_up_to(4)
+            if not self.keeps_alive and not _is_length_header(header):
+                self.keeps_alive = False
+                if len(msgs) > 1:
+                    raise ConnectionError("Terragen RPC server closed the connection after one reply to pipelined requests.")
+                reply_bytes = self._recv_until_closed(header)
+                self.close()
+                return [reply_bytes]
+            if len(header) < 4:
+                raise ConnectionError("Terragen RPC server closed the connection before the reply was complete.")
+
+            # Once the server is known to keep connections alive, every
+            # reply is framed and isn't checked again.
+            self.keeps_alive = True
+            self.unconfirmed_notifications = 0
+            replies = []
+            while True:
+                length = int.from_bytes(header, byteorder='little')
+                replies.append(self._recv_exactly(length))
+                if len(replies) == len(msgs):
+                    return replies
+                header = self._recv_exactly(4)
+
+        except socket.timeout as e:
+            # Note that socket.timeout is an alias for TimeoutError
+            # since Python 3.10, but we catch socket.timeout here
+            # and raise TimeoutError in case we're using an older
+            # version.
+            self.close()
+            raise TimeoutError(e) # in case socket.timeout is not an alias for TimeoutError
+
+        except:
+            # We don't know how much of the reply is left unread,
+            # so the socket can't be reused.
+            self.close()
+            raise
+
+    def _send(self, msgs):
+        buffers = []
+        for msg_bytes in msgs:
+            buffers.append(len(msg_bytes).to_bytes(4, byteorder='little'))
+            buffers.append(msg_bytes)
+        _sendall_buffers(self._sock, buffers)
+
+    def _recv_into(self, view):
+        # Returns the number of bytes received, which is less than
+        # len(view) only if the server closed the connection.
+        received = 0
+        while received < len(view):
+            count = self._sock.recv_into(view[received:])
+            if count == 0:
+                break
+            received += count
+        return received
+
+    def _recv_up_to(self, n):
+        buffer = bytearray(n)
+        with memoryview(buffer) as view:
+            received = self._recv_into(view)
+        del buffer[received:]
+        return buffer
+
+    def _recv_exactly(self, n):
+        buffer = bytearray(n)
+        with memoryview(buffer) as view:
+            received = self._recv_into(view)
+        if received < n:
+            raise ConnectionError("Terragen RPC server closed the connection before the reply was complete.")
+        return buffer
+
+    def _recv_until_closed(self, prefix = b''):
+        # The length of an unframed reply isn't known in advance, so we
+        # receive into a buffer which doubles in size whenever it's full.
+        buffer = bytearray(max(RECV_BUFFER_SIZE, 2 * len(prefix)))
+        buffer[:len(prefix)] = prefix
+        received = len(prefix)
+        while True:
+            if received == len(buffer):
+                buffer.extend(bytes(len(buffer)))
+            with memoryview(buffer) as view:
+                count = self._sock.recv_into(view[received:])
+            if count == 0:
+                break
+            received += count
+        del buffer[received:]
+        return buffer
+
+
+def _sendall_buffers(sock, buffers):
+    # Send all the buffers in as few system calls as possible without
+    # joining them, using scatter-gather I/O if the platform has it.
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(buffers))
+        return
+    views = [memoryview(b) for b in buffers]
+    first = 0
+    while first < len(views):
+        sent = sock.sendmsg(views[first:first + _MAX_BUFFERS_PER_SEND])
+        while first < len(views) and sent >= len(views[first]):
+            sent -= len(views[first])
+            first += 1
+        if sent:
+            views[first] = views[first][sent:]
+
+_JSON_TEXT_STARTS = frozenset(b' \t\r\n{["-0123456789tfn')
+
+def _is_length_header(header):
+    # Tells whether the first reply on a connection is framed. A server
+    # which doesn't keep connections alive replies with JSON text and no
+    # length header, which starts with whitespace or the first character
+    # of a JSON value and is printable ASCII. Anything else is a 4-byte
+    # little-endian length.
+    if len(header) < 4:
+        return False
+    if header[0] not in _JSON_TEXT_STARTS:
+        return True
+    return not all(32 <= byte < 127 or byte in (9, 10, 13) for byte in header)
+
+class ConnectionPool:
+    """A bounded, thread-safe pool of `Connection` objects.
+
+    Threads borrow a connection for each request and give it back
+    afterwards. At most ``max_size`` connections exist at once, so
+    threads wait for a connection to be returned if they are all in use.
+    Idle connections are closed after ``idle_timeout`` seconds, except
+    that up to ``min_size`` idle connections are kept open. An idle
+    connection is checked with `Connection.is_healthy` before it is
+    lent out again.
+
+    Attributes
+    ----------
+    lost_notifications : int
+        The number of notifications which may have been lost because
+        their connection was closed and discarded by the pool before they
+        were confirmed. See `take_lost_notifications`.
+    """
+
+    def __init__(self, address, timeout, min_size = 0, max_size = 4, idle_timeout = 60):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self.address = address
+        self.timeout = timeout
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._idle = []     # most recently used last
+        self._size = 0      # idle connections plus those lent out
+        self._closed = False
+        self.lost_notifications = 0
+        self._condition = threading.Condition()
+
+    def configure(self, min_size, max_size, idle_timeout):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        with self._condition:
+            self.min_size = min_size
+            self.max_size = max_size
+            self.idle_timeout = idle_timeout
+            self._evict_idle()
+            self._condition.notify_all()
+
+    def settimeout(self, timeout):
+        with self._condition:
+            self.timeout = timeout
+            for connection in self._idle:
+                connection.settimeout(timeout)
+
+    def acquire(self):
+        """Borrow a connection, waiting for one to be released if
+        ``max_size`` connections are already lent out.
+
+        Raises
+        ------
+        TimeoutError
+            Raised if no connection becomes available within the socket
+            timeout.
+        """
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self._condition:
+            while True:
+                self._evict_idle()
+                while self._idle:
+                    connection = self._idle.pop()
+                    if connection.is_healthy():
+                        connection.settimeout(self.timeout)
+                        return connection
+                    self._discard(connection)
+                if self._size < self.max_size:
+                    self._size += 1
+                    return Connection(self.address, self.timeout)
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError("Timed out waiting for a connection from the pool.")
+                self._condition.wait(remaining)
+
+    def release(self, connection):
+        """Give back a connection borrowed with `acquire`.
+        """
+        with self._condition:
+            if self._closed or self._size > self.max_size:
+                self._discard(connection)
+            else:
+                self._idle.append(connection)
+            self._condition.notify()
+
+    def exchange(self, msg_bytes, retry = False):
+        """Send a request on a borrowed connection and return the reply
+        bytes. See `Connection.exchange` for retry.
+
+        Raises
+        ------
+        ConnectionError
+        TimeoutError
+        """
+        connection = self.acquire()
+        try:
+            return connection.exchange(msg_bytes, retry)
+        finally:
+            self.release(connection)
+
+    def exchange_many(self, msgs, retry = False):
+        """Pipeline requests on a borrowed connection and return a list of
+        the reply bytes in the order they were received. See
+        `Connection.exchange` for retry.
+
+        Raises
+        ------
+        ConnectionError
+        TimeoutError
+        """
+        connection = self.acquire()
+        try:
+            return connection.exchange_many(msgs, retry = retry)
+        finally:
+            self.release(connection)
+
+    def acquire_unconfirmed(self):
+        """Borrow all the idle connections which have unconfirmed
+        notifications or have lost notifications, and return a list of
+        them. They must be given back with `release`.
+        """
+        with self._condition:
+            connections = [c for c in self._idle if c.unconfirmed_notifications or c.lost_notifications]
+            self._idle = [c for c in self._idle if not (c.unconfirmed_notifications or c.lost_notifications)]
+            return connections
+
+    def take_lost_notifications(self):
+        """Return the number of notifications lost on connections which
+        the pool has discarded since the last call, and reset it.
+        """
+        with self._condition:
+            lost = self.lost_notifications
+            self.lost_notifications = 0
+            return lost
+
+    @property
+    def size(self):
+        """The number of connections, idle or lent out."""
+        return self._size
+
+    def close(self):
+        """Close idle connections now and borrowed ones when they are
+        released.
+        """
+        with self._condition:
+            self._closed = True
+            for connection in self._idle:
+                self._discard(connection)
+            self._idle = []
+            self._condition.notify_all()
+
+    def _discard(self, connection):
+        # Called with self._condition held, for a connection which is
+        # not in self._idle.
+        connection.close()
+        self.lost_notifications += connection.lost_notifications
+        connection.lost_notifications = 0
+        self._size -= 1
+
+    def _evict_idle(self):
+        # Called with self._condition held. The least recently used
+        # connections are at the front of the list.
+        now = time.monotonic()
+        keep_from = 0
+        excess = len(self._idle) - self.min_size
+        while keep_from < excess:
+            connection = self._idle[keep_from]
+            if now - connection.last_used < self.idle_timeout and self._size <= self.max_size:
+                break
+            self._discard(connection)
+            keep_from += 1
+        if keep_from:
+            del self._idle[:keep_from]
+
+
+class SingleFlight:
+    """Lets concurrent identical calls share one request. The first
+    thread to make a call sends it, and threads which make the same
+    call while it's in flight wait for its result instead of sending
+    their own request.
+
+    Parameters
+    ----------
+    methods : iterable of str
+        The methods whose calls may be shared. They should only be
+        methods which don't change anything.
+
+    Attributes
+    ----------
+    calls : int
+        The number of calls which were sent.
+    coalesced : int
+        The number of calls which shared another call's result.
+    """
+
+    class _Flight:
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self, methods):
+        self.methods = frozenset(methods)
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.coalesced = 0
+
+    def stats(self):
+        """Return a dict with the keys 'calls', 'coalesced' and
+        'in_flight'.
+        """
+        return {'calls': self.calls, 'coalesced': self.coalesced, 'in_flight': len(self._flights)}
+
+    def do(self, key, function):
+        """Return function(), or the result of the call of function with
+        the same key which is in flight. An exception raised by function
+        is raised in every thread which shares the call.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = self._Flight()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = function()
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.done.set()
+
+    def forget(self):
+        """Make calls which are in flight unavailable for sharing, so the
+        next calls are sent again. Called after anything is changed, so
+        that later calls see the change.
+        """
+        with self._lock:
+            self._flights.clear()
+
+
+class AutoBatcher:
+    """Collects calls made at the same time by different threads and
+    sends them as one batch, giving each caller its own result.
+
+    The first thread to make a call while no batch is being sent becomes
+    the leader. It waits up to ``window`` seconds for more calls, then
+    sends the calls waiting, up to ``max_size`` of them. Calls made while
+    a batch is in flight wait, and are sent together by the next leader
+    when it returns. So a lone caller is not delayed unless ``window`` is
+    set, and concurrent callers are batched even if it isn't.
+
+    Parameters
+    ----------
+    send : callable
+        Called with a list of (method, params) pairs. Must return a list
+        with the result of each call, or the exception it raised.
+    window : float
+        Seconds for the leader to wait for more calls. Defaults to 0.
+    max_size : int
+        The maximum number of calls in a batch. Defaults to 100.
+
+    Attributes
+    ----------
+    calls : int
+        The number of calls which were made.
+    batches : int
+        The number of batches which were sent.
+    """
+
+    class _Call:
+
+        def __init__(self, method, params):
+            self.method = method
+            self.params = params
+            self.done = False
+            self.result = None
+            self.error = None
+
+    def __init__(self, send, window = 0.0, max_size = 100):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1.")
+        self.send = send
+        self.window = window
+        self.max_size = max_size
+        self.calls = 0
+        self.batches = 0
+        self._sizes = {}    # number of batches by size
+        self._pending = []
+        self._sending = False
+        self._condition = threading.Condition()
+
+    def stats(self):
+        """Return a dict with the keys 'calls', 'batches',
+        'mean_batch_size', 'max_batch_size' and 'batch_sizes', which is a
+        dict of the number of batches sent of each size.
+        """
+        with self._condition:
+            return {
+                'calls': self.calls,
+                'batches': self.batches,
+                'mean_batch_size': sum(size * n for size, n in self._sizes.items()) / self.batches if self.batches else 0.0,
+                'max_batch_size': max(self._sizes) if self._sizes else 0,
+                'batch_sizes': dict(sorted(self._sizes.items())),
+            }
+
+    def call(self, method, params):
+        """Return the result of the call, once it's been sent in a batch,
+        or raise the exception it raised.
+        """
+        call = self._Call(method, params)
+        with self._condition:
+            self.calls += 1
+            self._pending.append(call)
+            if len(self._pending) >= self.max_size:
+                self._condition.notify_all()   # the leader needn't wait any longer
+            while not call.done:
+                if self._sending:
+                    self._condition.wait()
+                    continue
+                self._sending = True
+                try:
+                    if self.window > 0:
+                        deadline = time.monotonic() + self.window
+                        while len(self._pending) < self.max_size:
+                            remaining = deadline - time.monotonic()
+                            if remaining <= 0:
+                                break
+                            self._condition.wait(remaining)
+                    batch = self._pending[:self.max_size]
+                    del self._pending[:self.max_size]
+                    self.batches += 1
+                    self._sizes[len(batch)] = self._sizes.get(len(batch), 0) + 1
+                    self._condition.release()
+                    try:
+                        self._send(batch)
+                    finally:
+                        self._condition.acquire()
+                finally:
+                    self._sending = False
+                    self._condition.notify_all()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _send(self, batch):
+        try:
+            results = self.send([(call.method, call.params) for call in batch])
+        except BaseException as e:
+            results = [e] * len(batch)
+        for call, result in zip(batch, results):
+            if isinstance(result, BaseException):
+                call.error = result
+            else:
+                call.result = result
+            call.done = True
+
+
+
+default_transport = _DefaultTransport()
+
+def send_bytes_with_length_info(msg_bytes, retry = False):
     """
     Raises
     ------
     ConnectionError
     TimeoutError
     """
+    return default_transport.send_bytes_with_length_info(msg_bytes, retry)
+
+def send_strings_pipelined(msg_strings):
+    """Send several requests on one connection without waiting for each
+    reply before sending the next, if the server keeps connections
+    alive. Returns the reply bytes in the order they were received,
+    which is not necessarily the order of the requests.
 
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.settimeout(SOCKET_TIMEOUT)
-    s.connect((TCP_IP, TCP_PORT))
-    
-    try:
-        length = len(msg_bytes)
-        length_info = length.to_bytes(4, byteorder='little')
-        s.send(length_info)
-    
-        s.send(msg_bytes)
-    
-        chunks = []
-        chunk = s.recv(1024)
-        chunks.append(chunk)
-        while chunk:
-            chunk = s.recv(1024)
-            chunks.append(chunk)
-        reply_bytes = b''.join(chunks)
-
-        return reply_bytes
-
-    except socket.timeout as e:
-        # Note that socket.timeout is an alias for TimeoutError
-        # since Python 3.10, but we catch socket.timeout here
-        # and raise TimeoutError in case we're using an older
-        # version.
-        raise TimeoutError(e) # in case socket.timeout is not an alias for TimeoutError
-
-    finally:
-        #s.shutdown(socket.SHUT_RDWR)
-        s.close()
+    Raises
+    ------
+    ConnectionError
+    TimeoutError
+    """
+    msgs = [msg_string.encode() for msg_string in msg_strings]
+    return default_transport.send_bytes_pipelined(msgs)
 
 def send_string(msg_string):
     """
@@ -117,5 +1241,5 @@ def send_string(msg_string):
     return send_bytes_with_length_info(msg_bytes)
 
 def deserialize_reply(reply):
-    return json.loads(reply)
+    return default_transport.deserialize_reply(reply)
 
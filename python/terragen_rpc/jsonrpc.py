@@ -21,8 +21,13 @@
 # SOFTWARE.
 
 
+import contextlib
+import threading
+
 import terragen_rpc.impl as impl
 
+from terragen_rpc.cache import MetadataCache, ParamSchemaCache, ParamValueCache, PathIndex
+
 
 class Error(Exception):
     """Base class for exceptions raised when an RPC call fails after
@@ -41,6 +46,28 @@ class Error(Exception):
         super().__init__(msg)
 
 
+class StaleNodeError(Error):
+    """An exception raised without contacting the server when a call is
+    made on a node which is known to no longer exist, because it was
+    deleted with ``delete`` or belonged to a project which has since
+    been closed by ``new_project`` or ``open_project``. Nodes deleted
+    in other ways, including the descendants of deleted nodes, are not
+    detected.
+
+    A subclass of ``Error``.
+
+    Attributes
+    ----------
+    reply : None
+        Always `None`, because no call was made.
+    node_id : str
+        The ID of the node.
+    """
+    def __init__(self, node_id, msg = "The node no longer exists."):
+        super().__init__(None, msg)
+        self.node_id = node_id
+
+
 class ReplyError(Error):
     """An exception raised when the server responds with data that
     could not be parsed. **We recommend that you catch and handle this
@@ -150,72 +177,953 @@ class Reply:
     more_error_info : str or None
         May be a string with more information about an error,
         or may be None.
-    raw_bytes : byte array
+    error : Error or None
+        For replies returned by `call_batch`, the exception that `call`
+        would have raised for this request, or `None` if the call was
+        successful. Always `None` for replies returned by `call`, which
+        raises the exception instead.
+    raw_bytes : byte array or None
         The byte array returned by the server, which is expected to
         conform to JSON-RPC 2.0 protocol. Not normally needed, but could
         be useful for debugging.
-    raw_dict : dict
+    raw_dict : dict or None
         A dictionary representation of the JSON object returned by the
         server. Not normally needed, but could be useful for debugging.
     """
-    
+
     ok = False
     value = None
     raw_bytes = None
     raw_dict = None
     more_error_info = None
+    error = None
+    error_msg = None
+    _error = None
 
-    def __init__(self, reply_bytes, method, params):
+    def __init__(self, reply_bytes, method, params, raw_dict = None, id = None, codec = None):
         self.raw_bytes = reply_bytes
         self._method = method
         self._params = params
-        try:
-            self.raw_dict = impl.deserialize_reply(reply_bytes)
-        except Exception as e:
-            self.ok = False
+        if raw_dict is None:
+            try:
+                if codec is None:
+                    raw_dict = impl.deserialize_reply(reply_bytes)
+                else:
+                    raw_dict = codec.decode(reply_bytes)
+            except Exception as e:
+                raise ReplyError(self)
+        self.raw_dict = raw_dict
+
+        if not isinstance(raw_dict, dict):
+
             raise ReplyError(self)
-        
-        if 'error' in self.raw_dict:
 
-            self.ok = False
-            self.error_msg = self.raw_dict['error']['message']
+        elif id is not None and raw_dict.get('id') not in (None, id):
+
+            # The server may reply with a null id if it couldn't read the
+            # request's id, but any other id means this is a reply to a
+            # different request.
+            raise ReplyError(self, "Terragen RPC server reply has the wrong id.")
+
+        elif 'error' in raw_dict:
 
-            if 'more_info' in self.raw_dict['error']:
-                self.more_error_info = self.raw_dict['error']['more_info'] 
+            self._error = raw_dict['error']
+            self.error_msg = self._error['message']
+
+            if 'more_info' in self._error:
+                self.more_error_info = self._error['more_info']
 
             raise _create_jsonrpc_error(self)
 
-        elif 'result' not in self.raw_dict:
+        elif 'result' not in raw_dict:
 
-            self.ok = False
             raise ReplyError(self)
 
         else:
 
             self.ok = True
-            self.value = self.raw_dict['result']
-    
+            self.value = raw_dict['result']
+
     @property
     def jsonrpc_error_code(self):
-        if 'error' in self.raw_dict:
-            return self.raw_dict['error']['code']
+        if self._error is not None:
+            return self._error['code']
         else:
             return 0
 
     @property
     def jsonrpc_error_msg(self):
-        if 'error' in self.raw_dict:
-            return self.raw_dict['error']['message']
+        if self._error is not None:
+            return self._error['message']
         else:
             return None
 
 
+class LeanReply:
+    """The reply to a successful call made by a client with lean replies
+    enabled (see `set_lean_replies`), which holds only the value. It has
+    the same attributes as a successful `Reply`, but ``raw_bytes`` and
+    ``raw_dict`` are always `None`, and other attributes can't be added.
+
+    Attributes
+    ----------
+    ok : bool
+        Always `True`.
+    value
+        The main value of interest, whose type depends on the function
+        that was called.
+    jsonrpc_error_code : int
+        Always 0.
+    jsonrpc_error_msg, error_msg, more_error_info, error, raw_bytes, raw_dict
+        Always `None`.
+    """
+
+    __slots__ = ('value',)
+
+    ok = True
+    raw_bytes = None
+    raw_dict = None
+    more_error_info = None
+    error = None
+    error_msg = None
+    jsonrpc_error_code = 0
+    jsonrpc_error_msg = None
+
+    def __init__(self, value):
+        self.value = value
+
+
+def _lean_reply(reply_bytes, method, params, raw_dict = None, id = None, codec = None):
+    # A LeanReply for a successful reply. Anything else is handed to
+    # Reply() to raise the same exception as `call`.
+    if raw_dict is None:
+        try:
+            if codec is None:
+                raw_dict = impl.deserialize_reply(reply_bytes)
+            else:
+                raw_dict = codec.decode(reply_bytes)
+        except Exception as e:
+            raw_dict = None
+    if (type(raw_dict) is dict and 'result' in raw_dict and 'error' not in raw_dict
+            and (id is None or raw_dict.get('id') in (None, id))):
+        return LeanReply(raw_dict['result'])
+    return Reply(reply_bytes, method, params, raw_dict, id, codec)
+
+def _value_from_reply_bytes(reply_bytes, method, params, id, codec):
+    # The value of a successful reply, without creating a Reply. Anything
+    # else is handed to Reply() to raise the same exception as `call`.
+    try:
+        raw_dict = codec.decode(reply_bytes)
+    except Exception as e:
+        raw_dict = None
+    if (type(raw_dict) is dict and 'result' in raw_dict and 'error' not in raw_dict
+            and raw_dict.get('id') in (None, id)):
+        return raw_dict['result']
+    return Reply(reply_bytes, method, params, id = id, codec = codec).value
+
+
+_PROJECT_METHODS = frozenset(['new_project', 'open_project'])
+
+# Methods which return the id of a node, or a list of ids, which exist
+# when the call returns.
+_NODE_ID_METHODS = frozenset(['root', 'node_by_path', 'create_child', 'parent'])
+_NODE_IDS_METHODS = frozenset(['children', 'children_filtered_by_class', 'current_selection'])
+
+# Methods which only read, whose concurrent calls may share one request
+# when single-flight is enabled (see Client.set_single_flight), and
+# whose requests may be sent again if a reused connection was closed
+# before the reply arrived.
+IDEMPOTENT_METHODS = frozenset([
+    'root', 'name', 'name_and_path', 'path', 'parent_path', 'parent',
+    'children', 'children_filtered_by_class', 'param_names',
+    'get_param_as_string', 'node_by_path', 'project_filepath',
+    'current_selection',
+])
+
+
+# Methods which change the project and return nothing, whose calls made
+# with Client.write are buffered inside Client.deferred.
+_SELECTION_METHODS = frozenset(['select_none', 'select_one_more', 'select_more_as_array', 'select_more'])
+
+DEFERRABLE_METHODS = frozenset(['set_param_from_string', 'toggle_enable_node']) | _SELECTION_METHODS
+
+
+class DeferredWrites:
+    """The calls buffered by `Client.deferred`, which are sent with one
+    `Client.call_batch` when they are flushed.
+
+    Buffered calls are coalesced: a 'set_param_from_string' call replaces
+    an earlier one for the same node and param, and moves to the end of
+    the buffer, and a 'select_none' call drops earlier selection calls.
+
+    Attributes
+    ----------
+    client : Client
+    coalesced : int
+        The number of calls which were dropped because a later call
+        made them unnecessary.
+    flushed : int
+        The number of calls which have been sent.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.coalesced = 0
+        self.flushed = 0
+        self._calls = {}    # (method, params) by key, in the order they must be sent
+        self._next_key = 0
+
+    @property
+    def pending(self):
+        """The number of calls waiting to be sent."""
+        return len(self._calls)
+
+    def add(self, method, params):
+        """Buffer a call of one of the `DEFERRABLE_METHODS`."""
+        if method == 'set_param_from_string' and len(params) >= 2:
+            key = (method, params[0], params[1])
+            if self._calls.pop(key, None) is not None:
+                self.coalesced += 1
+        else:
+            if method == 'select_none':
+                dropped = [key for key, (m, p) in self._calls.items() if m in _SELECTION_METHODS]
+                for key in dropped:
+                    del self._calls[key]
+                self.coalesced += len(dropped)
+            key = self._next_key
+            self._next_key += 1
+        self._calls[key] = (method, params)
+
+    def discard(self):
+        """Drop the buffered calls without sending them."""
+        self._calls = {}
+
+    def flush(self):
+        """Send the buffered calls with one `Client.call_batch`.
+
+        Raises
+        ------
+        Error (subclass thereof)
+            The exception of the first call which failed, after all the
+            calls have been sent.
+        """
+        if not self._calls:
+            return
+        calls = list(self._calls.values())
+        self._calls = {}
+        self.flushed += len(calls)
+        for reply in self.client.call_batch(calls):
+            if reply.error is not None:
+                raise reply.error
+
+
+class Client:
+    """A client of one Terragen RPC server, with its own address,
+    timeout, request ids and connections.
+
+    The module-level functions of ``terragen_rpc.jsonrpc`` and
+    ``terragen_rpc`` use a default client (see `default_client`), whose
+    settings are changed with `settimeout` etc. Create other clients to
+    talk to more than one server from the same process, or to use
+    different settings for different kinds of calls. A ``Node`` can be
+    bound to a client, and high level functions accept a ``client``
+    argument.
+
+    Example:
+
+    .. code-block:: python
+
+        import terragen_rpc as tg
+
+        farm_node = tg.Client('render-07', timeout = 60, persistent = True)
+        camera = tg.node_by_path('/Render Camera', client = farm_node)
+        print(camera.get_param_as_string('position'))
+
+    Parameters
+    ----------
+    host : str
+        Defaults to 'localhost'.
+    port : int
+        Defaults to 36971.
+    timeout : float
+        The socket timeout in seconds. Defaults to 10.
+    persistent : bool
+        Whether to keep connections open and reuse them. See
+        `set_persistent_connection`. Defaults to False.
+    codec : str or terragen_rpc.codec.Codec, optional
+        The JSON codec to use. See `set_codec`. Defaults to the fastest
+        installed codec.
+    """
+
+    def __init__(self, host = 'localhost', port = 36971, timeout = 10, persistent = False, transport = None, codec = None):
+        if transport is None:
+            transport = impl.Transport(host, port, timeout, persistent, codec)
+        elif codec is not None:
+            transport.set_codec(codec)
+        self.transport = transport
+        self.metadata_cache = None
+        self.schema_cache = None
+        self.param_cache = None
+        self.path_index = None
+        self.single_flight = None
+        self.auto_batcher = None
+        self.lean_replies = False
+        self.epoch = 0
+        self.shared_caches = {}   # terragen_rpc.shared_cache.SharedCache objects, by filename
+        self._deleted_ids = set()
+        self._caches = []
+        self._local = threading.local()     # the DeferredWrites of each thread
+        self._server_accepts_batches = None  # unknown until the first batch is sent
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def address(self):
+        """The (host, port) of the server."""
+        return self.transport.address
+
+    @property
+    def timeout(self):
+        """The socket timeout in seconds."""
+        return self.transport.timeout
+
+    @property
+    def codec(self):
+        """The codec which encodes requests and decodes replies."""
+        return self.transport.codec
+
+    def settimeout(self, timeout_in_seconds):
+        self.transport.settimeout(timeout_in_seconds)
+
+    def request_template_stats(self):
+        """See `terragen_rpc.jsonrpc.request_template_stats`.
+        """
+        return self.transport.request_templates.stats()
+
+    def set_codec(self, codec):
+        """See `terragen_rpc.jsonrpc.set_codec`.
+        """
+        self.transport.set_codec(codec)
+
+    def set_persistent_connection(self, enabled):
+        """See `terragen_rpc.jsonrpc.set_persistent_connection`.
+        """
+        self.transport.set_persistent_connection(enabled)
+
+    def configure_connection_pool(self, min_size = None, max_size = None, idle_timeout = None):
+        """See `terragen_rpc.jsonrpc.configure_connection_pool`.
+        """
+        self.transport.configure_connection_pool(min_size, max_size, idle_timeout)
+
+    def set_metadata_cache(self, enabled):
+        """Enable or disable caching the names, paths, parents and
+        children of nodes. Disabled by default. See
+        ``terragen_rpc.cache.MetadataCache``.
+
+        Parameters
+        ----------
+        enabled : bool
+        """
+        if enabled and self.metadata_cache is None:
+            self.metadata_cache = MetadataCache()
+            self._caches.append(self.metadata_cache)
+        elif not enabled and self.metadata_cache is not None:
+            self._caches.remove(self.metadata_cache)
+            self.metadata_cache = None
+
+    def set_schema_cache(self, enabled):
+        """Enable or disable caching the param names of each node class.
+        Disabled by default. See ``terragen_rpc.cache.ParamSchemaCache``.
+
+        Parameters
+        ----------
+        enabled : bool
+        """
+        if enabled and self.schema_cache is None:
+            self.schema_cache = ParamSchemaCache()
+            self._caches.append(self.schema_cache)
+        elif not enabled and self.schema_cache is not None:
+            self._caches.remove(self.schema_cache)
+            self.schema_cache = None
+
+    def set_param_cache(self, enabled, max_size = None, ttl = None):
+        """Enable or disable caching param values, or change the size
+        and time to live of the cache. Disabled by default. See
+        ``terragen_rpc.cache.ParamValueCache``.
+
+        Parameters
+        ----------
+        enabled : bool
+        max_size : int, optional
+            The maximum number of values to cache. Defaults to 4096 when
+            the cache is enabled, otherwise it's left unchanged.
+        ttl : float, optional
+            The number of seconds to keep each value. Values are kept
+            until they are dropped for another reason by default.
+        """
+        if enabled and self.param_cache is None:
+            self.param_cache = ParamValueCache(max_size if max_size is not None else 4096, ttl)
+            self._caches.append(self.param_cache)
+        elif enabled:
+            self.param_cache.configure(max_size, ttl)
+        elif self.param_cache is not None:
+            self._caches.remove(self.param_cache)
+            self.param_cache = None
+
+    def set_path_index(self, enabled):
+        """Enable or disable indexing node paths. Disabled by default.
+        See ``terragen_rpc.cache.PathIndex``.
+
+        Parameters
+        ----------
+        enabled : bool
+        """
+        if enabled and self.path_index is None:
+            self.path_index = PathIndex()
+            self._caches.append(self.path_index)
+        elif not enabled and self.path_index is not None:
+            self._caches.remove(self.path_index)
+            self.path_index = None
+
+    def set_single_flight(self, enabled, methods = None):
+        """See `terragen_rpc.jsonrpc.set_single_flight`.
+        """
+        if enabled:
+            if methods is None:
+                methods = self.single_flight.methods if self.single_flight is not None else IDEMPOTENT_METHODS
+            self.single_flight = impl.SingleFlight(methods)
+        else:
+            self.single_flight = None
+
+    def single_flight_stats(self):
+        """See `terragen_rpc.jsonrpc.single_flight_stats`.
+        """
+        return self.single_flight.stats() if self.single_flight is not None else None
+
+    def set_lean_replies(self, enabled):
+        """See `terragen_rpc.jsonrpc.set_lean_replies`.
+        """
+        self.lean_replies = bool(enabled)
+
+    def _reply_factory(self):
+        return _lean_reply if self.lean_replies else Reply
+
+    def set_auto_batch(self, enabled, window = None, max_size = None):
+        """See `terragen_rpc.jsonrpc.set_auto_batch`.
+        """
+        if enabled:
+            old = self.auto_batcher
+            if window is None:
+                window = old.window if old is not None else 0.0
+            if max_size is None:
+                max_size = old.max_size if old is not None else 100
+            self.auto_batcher = impl.AutoBatcher(self._send_auto_batch, window, max_size)
+        else:
+            self.auto_batcher = None
+
+    def auto_batch_stats(self):
+        """See `terragen_rpc.jsonrpc.auto_batch_stats`.
+        """
+        return self.auto_batcher.stats() if self.auto_batcher is not None else None
+
+    def check_node(self, node_id, epoch):
+        """Raise StaleNodeError if the node with node_id, which was found
+        during the given project epoch, is known to no longer exist.
+
+        The epoch starts at 0 and is incremented by each successful call
+        of 'new_project' or 'open_project' made through this client. Ids
+        are known to be deleted after a successful 'delete' call, until
+        a call through this client returns the id again.
+        """
+        if epoch is not None and epoch != self.epoch:
+            raise StaleNodeError(node_id, "The node belongs to a project which has been closed.")
+        if node_id in self._deleted_ids:
+            raise StaleNodeError(node_id, "The node has been deleted.")
+
+    def invalidate(self, node_id = None):
+        """Drop cached results for one node, or for all nodes if node_id
+        is `None`. Needed if the project is changed other than by calls
+        through this client.
+        """
+        for cache in self._caches:
+            cache.invalidate(node_id)
+
+    def _observe(self, method, params):
+        # Called whether or not the call succeeds, so caches forget
+        # anything the call may have changed.
+        for cache in self._caches:
+            cache.observe(method, params)
+
+    def _observe_result(self, method, params, value):
+        # Called only after a successful reply, so that nodes aren't
+        # treated as stale because of a call which failed.
+        if method in _PROJECT_METHODS:
+            if method == 'open_project' and not value:
+                return
+            self._new_epoch()
+        elif method == 'delete' and params:
+            ids = params[0] if isinstance(params[0], list) else [params[0]]
+            self._deleted_ids.update(ids)
+        elif self._deleted_ids:
+            # Terragen may give a new node the id of a deleted one.
+            if method in _NODE_ID_METHODS:
+                self._deleted_ids.discard(value)
+            elif method in _NODE_IDS_METHODS and isinstance(value, list):
+                self._deleted_ids.difference_update(value)
+
+    def _new_epoch(self):
+        # The project was closed, so all nodes found before are stale.
+        self.epoch += 1
+        self._deleted_ids = set()
+
+    def _observe_replies(self, calls, replies):
+        for (method, params), reply in zip(calls, replies):
+            if reply.ok:
+                self._observe_result(method, params, reply.value)
+
+    def _observe_many(self, calls):
+        for method, params in calls:
+            self._observe(method, params)
+        single_flight = self.single_flight
+        if single_flight is not None and any(method not in single_flight.methods for method, params in calls):
+            single_flight.forget()
+
+    def close(self):
+        """Close this client's pooled connections, including the idle
+        connections of ``terragen_rpc.aio``. They will be reopened by the
+        next call if persistent connection is still enabled.
+        """
+        self.transport.close()
+
+    def call(self, method, params = []):
+        """Like `terragen_rpc.jsonrpc.call`, but calls this client's server.
+        """
+        self._flush_deferred()
+        return self._single_flight(self._call, method, params)
+
+    def call_value(self, method, params = []):
+        """Like `terragen_rpc.jsonrpc.call_value`, but calls this client's
+        server.
+        """
+        self._flush_deferred()
+        return self._single_flight(self._call_value, method, params)
+
+    def write(self, method, params = [], wait = True):
+        """Make a call whose result isn't needed. Inside `deferred`, calls
+        of the `DEFERRABLE_METHODS` are buffered. Otherwise the call is
+        made with `call_value`, or with `notify` if wait is `False`.
+
+        Returns
+        -------
+        bool
+            `True` if the server replied that the call succeeded, or
+            `False` if the call was buffered or sent without waiting.
+        """
+        writes = getattr(self._local, 'deferred', None)
+        if writes is not None and method in DEFERRABLE_METHODS:
+            writes.add(method, params)
+            # Caches forget what the call will change now, so that reads
+            # made before the flush ask the server, which flushes first.
+            self._observe_many([(method, params)])
+            return False
+        elif wait:
+            self.call_value(method, params)
+            return True
+        else:
+            self.notify(method, params)
+            return False
+
+    @contextlib.contextmanager
+    def deferred(self):
+        """Like `terragen_rpc.jsonrpc.deferred`, but for this client.
+        """
+        writes = getattr(self._local, 'deferred', None)
+        if writes is not None:
+            yield writes    # nested, flushed by the outermost
+            return
+        writes = DeferredWrites(self)
+        self._local.deferred = writes
+        try:
+            yield writes
+        except BaseException:
+            # Don't apply half-finished edits, and don't let a failed
+            # flush hide the exception.
+            writes.discard()
+            raise
+        finally:
+            self._local.deferred = None
+        writes.flush()
+
+    def _flush_deferred(self):
+        writes = getattr(self._local, 'deferred', None)
+        if writes is not None and writes._calls:
+            writes.flush()
+
+    def _single_flight(self, call, method, params):
+        single_flight = self.single_flight
+        if single_flight is not None:
+            if method in single_flight.methods:
+                try:
+                    key = (method, tuple(params), call.__name__)
+                    hash(key)
+                except TypeError:
+                    pass    # params such as lists can't be compared cheaply
+                else:
+                    return single_flight.do(key, lambda: call(method, params))
+            else:
+                try:
+                    return call(method, params)
+                finally:
+                    single_flight.forget()
+        return call(method, params)
+
+    def _send(self, method, params):
+        msg_bytes, id = self.transport.generate_query_bytes_and_id(method, params)
+        try:
+            reply_bytes = self.transport.send_bytes_with_length_info(msg_bytes, method in IDEMPOTENT_METHODS)
+        finally:
+            self._observe(method, params)
+        return reply_bytes, id
+
+    def _call(self, method, params):
+        auto_batcher = self.auto_batcher
+        if auto_batcher is not None:
+            return auto_batcher.call(method, params)
+        return self._call_unbatched(method, params)
+
+    def _call_value(self, method, params):
+        auto_batcher = self.auto_batcher
+        if auto_batcher is not None:
+            return auto_batcher.call(method, params).value
+        reply_bytes, id = self._send(method, params)
+        value = _value_from_reply_bytes(reply_bytes, method, params, id, self.transport.codec)
+        self._observe_result(method, params, value)
+        return value
+
+    def _call_unbatched(self, method, params):
+        reply_bytes, id = self._send(method, params)
+        reply = self._reply_factory()(reply_bytes, method, params, id = id, codec = self.transport.codec)
+        self._observe_result(method, params, reply.value)
+        return reply
+
+    def _send_auto_batch(self, calls):
+        # Sends calls collected by the auto-batcher. Returns the Reply of
+        # each call, or the exception it raised.
+        if len(calls) == 1:
+            try:
+                return [self._call_unbatched(*calls[0])]
+            except Error as e:
+                return [e]
+        return [reply if reply.error is None else reply.error for reply in self.call_batch(calls)]
+
+    def notify(self, method, params = []):
+        """Like `terragen_rpc.jsonrpc.notify`, but calls this client's
+        server.
+        """
+        self._flush_deferred()
+        msg_bytes = self.transport.generate_notification_bytes(method, params)
+        if not self.transport.send_notification_bytes(msg_bytes):
+            self.call(method, params)
+        else:
+            self._observe(method, params)
+            if self.single_flight is not None:
+                self.single_flight.forget()
+
+    def flush(self):
+        """Like `terragen_rpc.jsonrpc.flush`, but for this client's
+        connections.
+        """
+        self._flush_deferred()
+        msg_bytes, id = self.transport.generate_query_bytes_and_id('project_filepath', [])
+        lost = self.transport.flush(msg_bytes)
+        if lost:
+            raise ConnectionError("{} notification(s) may not have been handled because the connection was closed.".format(lost))
+
+    def call_batch(self, calls):
+        """Like `terragen_rpc.jsonrpc.call_batch`, but calls this client's
+        server.
+        """
+        self._flush_deferred()
+        calls = [_method_and_params(c) for c in calls]
+        if not calls:
+            return []
+
+        if self._server_accepts_batches is False:
+            return self.call_pipelined(calls)
+
+        msg_bytes, ids = self.transport.generate_batch_query_bytes(calls)
+        rejected = False
+        try:
+            reply_bytes = self.transport.send_bytes_with_length_info(msg_bytes, _all_idempotent(calls))
+            try:
+                raw_list = self.transport.deserialize_reply(reply_bytes)
+            except Exception as e:
+                raw_list = None
+            # A server which doesn't understand batches treats the array as
+            # one invalid request and replies with a single error.
+            rejected = isinstance(raw_list, dict) and 'error' in raw_list and raw_list.get('id') is None
+        finally:
+            if not rejected:
+                self._observe_many(calls)
+
+        if rejected:
+            # None of the calls were run, and call_pipelined observes them.
+            self._server_accepts_batches = False
+            return self.call_pipelined(calls)
+        elif not isinstance(raw_list, list):
+            # Reply() raises ReplyError itself if the data can't be parsed.
+            raise ReplyError(Reply(reply_bytes, None, None, codec = self.transport.codec))
+
+        self._server_accepts_batches = True
+        raw_dicts_by_id = {}
+        for raw_dict in raw_list:
+            if isinstance(raw_dict, dict) and 'id' in raw_dict:
+                raw_dicts_by_id[raw_dict['id']] = raw_dict
+
+        reply_factory = self._reply_factory()
+        replies = []
+        for id, (method, params) in zip(ids, calls):
+            # A missing reply is handled like any other unparseable reply.
+            raw_dict = raw_dicts_by_id.get(id, {})
+            replies.append(_reply_or_error(reply_factory, None, method, params, raw_dict, id))
+        self._observe_replies(calls, replies)
+        return replies
+
+    def call_pipelined(self, calls):
+        """Like `terragen_rpc.jsonrpc.call_pipelined`, but calls this
+        client's server.
+        """
+        self._flush_deferred()
+        calls = [_method_and_params(c) for c in calls]
+        msgs = []
+        ids = []
+        for method, params in calls:
+            msg_bytes, id = self.transport.generate_query_bytes_and_id(method, params)
+            msgs.append(msg_bytes)
+            ids.append(id)
+        try:
+            replies_bytes = self.transport.send_bytes_pipelined(msgs, _all_idempotent(calls))
+        finally:
+            self._observe_many(calls)
+
+        raw_by_id = {}
+        unmatched = []
+        for reply_bytes in replies_bytes:
+            try:
+                raw_dict = self.transport.deserialize_reply(reply_bytes)
+            except Exception as e:
+                raw_dict = None
+            if isinstance(raw_dict, dict) and raw_dict.get('id') is not None:
+                raw_by_id[raw_dict['id']] = (reply_bytes, raw_dict)
+            else:
+                unmatched.append(reply_bytes)
+
+        reply_factory = self._reply_factory()
+        replies = []
+        for id, (method, params) in zip(ids, calls):
+            if id in raw_by_id:
+                reply_bytes, raw_dict = raw_by_id[id]
+                replies.append(_reply_or_error(reply_factory, reply_bytes, method, params, raw_dict, id))
+            else:
+                # Reply() raises ReplyError, or a JSON-RPC error if the server
+                # replied with an error and a null id, for a reply we can't match.
+                reply_bytes = unmatched.pop(0) if unmatched else b''
+                replies.append(_reply_or_error(reply_factory, reply_bytes, method, params, None, None, self.transport.codec))
+        self._observe_replies(calls, replies)
+        return replies
+
+
+_default_client = Client(transport = impl.default_transport)
+
+def default_client():
+    """Get the client used by the module-level functions, and by nodes
+    which are not bound to another client.
+
+    Returns
+    -------
+    Client
+    """
+    return _default_client
+
+
 def settimeout(timeout_in_seconds):
     impl.settimeout(timeout_in_seconds)
 
+def set_persistent_connection(enabled):
+    """Enable or disable keeping connections to the server open
+    and reusing them for subsequent calls.
+
+    When enabled, calls borrow a connection from a pool which is safe to
+    use from several threads at once (see `configure_connection_pool`).
+    A dropped connection is reopened automatically. If the server closes
+    the connection after every reply, a new connection is made for each
+    call, just as when this is disabled.
+
+    Parameters
+    ----------
+    enabled : bool
+    """
+    _default_client.set_persistent_connection(enabled)
+
+def close_persistent_connection():
+    """Close the pooled connections. They will be reopened by the next
+    call if persistent connection is still enabled.
+    """
+    _default_client.close()
+
+def configure_connection_pool(min_size = None, max_size = None, idle_timeout = None):
+    """Configure the pool of connections used when persistent connection
+    is enabled. Arguments which are `None` are left unchanged.
+
+    Parameters
+    ----------
+    min_size : int
+        The number of idle connections to keep open however long they
+        are idle. Defaults to 0.
+    max_size : int
+        The maximum number of connections open at once. Threads calling
+        while this many connections are busy will wait for one to become
+        free, or raise TimeoutError if none becomes free within the
+        socket timeout. Defaults to 4.
+    idle_timeout : float
+        Close connections which have been idle for this many seconds.
+        Defaults to 60.
+    """
+    _default_client.configure_connection_pool(min_size, max_size, idle_timeout)
+
+def set_codec(codec):
+    """Choose the JSON codec used to encode requests and decode replies.
+    By default the fastest installed codec is used, in the order
+    'orjson', 'msgspec', 'ujson', then 'json' (Python's json module).
+    See ``terragen_rpc.codec``.
+
+    Parameters
+    ----------
+    codec : str or terragen_rpc.codec.Codec
+        The name of a codec, or a codec object. `None` chooses the
+        fastest installed codec.
+
+    Raises
+    ------
+    ValueError
+        Raised if the name is not the name of a codec.
+    ImportError
+        Raised if the codec's library is not installed.
+    """
+    _default_client.set_codec(codec)
+
+def request_template_stats():
+    """Return how many requests were built from cached per-method
+    templates and how many had to be encoded in full. Templates are only
+    used with the 'json' codec, because the other codecs encode requests
+    faster than templates can be filled in. See
+    ``terragen_rpc.impl.RequestTemplates``.
+
+    Returns
+    -------
+    dict
+        With the keys 'hits', 'misses' and 'methods'.
+    """
+    return _default_client.request_template_stats()
+
+def set_single_flight(enabled, methods = None):
+    """Enable or disable sharing one request between identical calls
+    made at the same time by different threads. Disabled by default.
+
+    When enabled, a call of one of the given methods which is made while
+    a call with the same method and params is waiting for its reply
+    doesn't send a request, but waits for the same reply. Both calls
+    return the same ``Reply`` object, which should not be modified.
+    Any call of another method makes calls which are in flight
+    unavailable for sharing, so that calls made after it see its
+    changes.
+
+    Parameters
+    ----------
+    enabled : bool
+    methods : iterable of str, optional
+        The methods whose calls may be shared, which should only be
+        methods which don't change anything. Defaults to the methods in
+        `IDEMPOTENT_METHODS`, or to the methods already set.
+    """
+    _default_client.set_single_flight(enabled, methods)
+
+def single_flight_stats():
+    """Return how many calls were sent and how many shared another
+    call's request. See `set_single_flight`.
+
+    Returns
+    -------
+    dict | None
+        A dict with the keys 'calls', 'coalesced' and 'in_flight', or
+        None if single-flight is disabled.
+    """
+    return _default_client.single_flight_stats()
+
+def set_lean_replies(enabled):
+    """Enable or disable returning a `LeanReply`, which holds only the
+    value, instead of a `Reply` for each successful call, so that
+    replies kept by the caller use little memory. Failed calls still
+    raise an exception with a full `Reply`, and ``call_batch`` still
+    returns a full `Reply` for each failed call. Disabled by default.
+
+    Use `call_value` instead of `call` to avoid creating a reply at
+    all.
+
+    Parameters
+    ----------
+    enabled : bool
+    """
+    _default_client.set_lean_replies(enabled)
+
+def set_auto_batch(enabled, window = None, max_size = None):
+    """Enable or disable sending calls made at the same time by
+    different threads as one JSON-RPC batch (see `call_batch`), so that
+    code which makes one call at a time from several threads, e.g. with
+    a ``concurrent.futures.ThreadPoolExecutor``, gets most of the
+    benefit of batching without being changed. Disabled by default.
+
+    Each caller still gets its own `Reply`, or its own exception. A
+    call made while no batch is in flight is sent after waiting up to
+    window seconds for other calls to join it, and calls made while a
+    batch is in flight are sent together when it returns. A thread
+    which makes one call at a time on its own is not batched.
+
+    Parameters
+    ----------
+    enabled : bool
+    window : float, optional
+        Seconds to wait for more calls before sending a batch. Defaults
+        to 0, or to the window already set. A longer window makes
+        bigger batches, but delays every call by up to this time.
+    max_size : int, optional
+        The maximum number of calls in a batch. Defaults to 100, or to
+        the size already set.
+    """
+    _default_client.set_auto_batch(enabled, window, max_size)
+
+def auto_batch_stats():
+    """Return how many calls were made and the sizes of the batches they
+    were sent in. See `set_auto_batch`.
+
+    Returns
+    -------
+    dict | None
+        A dict with the keys 'calls', 'batches', 'mean_batch_size',
+        'max_batch_size' and 'batch_sizes', which is a dict of the number
+        of batches sent of each size, or None if auto-batching is
+        disabled.
+    """
+    return _default_client.auto_batch_stats()
+
 def call(method, params = []):
     """Generate an RPC query string, send it to the Terragen RPC server
-    and return a `Reply` object.
+    and return a `Reply` object, or a `LeanReply` if lean replies are
+    enabled (see `set_lean_replies`).
 
     Raises
     ------
@@ -235,9 +1143,164 @@ def call(method, params = []):
         suggests a problem with its implementation, or if this module
         encounters an internal error.
     """
-    msg = impl.generate_query_string(method, params)
-    reply_bytes = impl.send_string(msg)
-    return Reply(reply_bytes, method, params)
+    return _default_client.call(method, params)
+
+def call_value(method, params = []):
+    """Like `call`, but return the result value of the call rather than
+    a `Reply` object. Faster and uses less memory than `call` when only
+    the value is needed, because no `Reply` is created unless the server
+    replies with an error.
+
+    Raises
+    ------
+    The same exceptions as `call`.
+    """
+    return _default_client.call_value(method, params)
+
+def notify(method, params = []):
+    """Send a JSON-RPC notification to the Terragen RPC server, which
+    is a request that the server doesn't reply to, and return without
+    waiting for the server to handle it.
+
+    The server doesn't report errors in notifications, so only use this
+    for calls whose result and errors you don't need, for example to set
+    many parameters quickly. Call `flush` afterwards to wait until the
+    server has handled the notifications.
+
+    Notifications can only be sent without waiting when persistent
+    connection is enabled (see `set_persistent_connection`) and the
+    server keeps connections alive. Otherwise this makes a normal call
+    and waits for the reply, which is ignored.
+
+    Raises
+    ------
+    ConnectionError
+        Raised by socket if a connection error occurs.
+    TimeoutError
+        Raised by impl.send_string() if a socket timeout occurs.
+    """
+    _default_client.notify(method, params)
+
+def flush():
+    """Wait until the server has handled all notifications sent with
+    `notify`. Notifications sent on connections which are in use by
+    other threads are not waited for.
+
+    Also sends the calls buffered by `deferred` in this thread.
+
+    Raises
+    ------
+    ConnectionError
+        Raised by socket if a connection error occurs, or if a connection
+        was closed before the server confirmed that it had handled the
+        notifications sent on it.
+    TimeoutError
+        Raised by impl.send_string() if a socket timeout occurs.
+    """
+    _default_client.flush()
+
+def deferred():
+    """Return a context manager inside which calls made with
+    `Client.write` by this thread, e.g. by ``Node.set_param`` and
+    ``select_none``, are buffered and then sent with one `call_batch`
+    when the context exits. See `DeferredWrites` for how calls are
+    coalesced.
+
+    Any other call made through the same client by the same thread, or
+    `flush`, first sends the buffered calls, so reads see the buffered
+    writes. If the context exits because of an exception, the calls
+    still buffered are discarded without being sent. Nested contexts
+    send their calls when the outermost context exits.
+
+    Example:
+
+    .. code-block:: python
+
+        with tg.deferred() as writes:
+            for i in range(10):
+                node.set_param('translate', (i, 0, 0))   # only the last is sent
+            writes.flush()  # sends the buffered calls now
+
+    Returns
+    -------
+    context manager
+        Its value is the `DeferredWrites` object.
+
+    Raises
+    ------
+    Error (subclass thereof)
+        Raised when calls are sent, with the exception of the first call
+        which failed.
+    """
+    return _default_client.deferred()
+
+def call_batch(calls):
+    """Send several RPC requests to the Terragen RPC server in a single
+    JSON-RPC 2.0 batch, and return a list of `Reply` objects in the same
+    order as ``calls``.
+
+    Unlike `call`, an error reply to one of the requests does not raise
+    an exception. Instead, the `Reply` for that request has ``ok`` set to
+    `False` and its ``error`` attribute set to the exception that `call`
+    would have raised, so the rest of the batch can still be used.
+
+    If the server does not accept batches, the requests are pipelined
+    with `call_pipelined` instead.
+
+    Parameters
+    ----------
+    calls : list of tuple
+        Pairs of (method, params), where params is a list. A method name
+        on its own may be given for methods that take no params.
+
+    Returns
+    -------
+    list of Reply
+
+    Raises
+    ------
+    ConnectionError
+        Raised by socket if a connection error occurs.
+    TimeoutError
+        Raised by impl.send_string() if a socket timeout occurs.
+    ReplyError
+        Raised if the response to the batch as a whole cannot be decoded
+        and parsed.
+    """
+    return _default_client.call_batch(calls)
+
+def call_pipelined(calls):
+    """Send several RPC requests to the Terragen RPC server on one
+    connection, writing each request without waiting for the reply to
+    the previous one, and return a list of `Reply` objects in the same
+    order as ``calls``. Replies are matched to requests by id.
+
+    Errors are handled the same way as by `call_batch`: an error reply
+    to one of the requests does not raise an exception, but is available
+    from the ``error`` attribute of its `Reply`.
+
+    If the server closes the connection after each reply, the requests
+    are sent one at a time instead.
+
+    Parameters
+    ----------
+    calls : list of tuple
+        Pairs of (method, params), where params is a list. A method name
+        on its own may be given for methods that take no params.
+
+    Returns
+    -------
+    list of Reply
+
+    Raises
+    ------
+    ConnectionError
+        Raised by socket if a connection error occurs.
+    TimeoutError
+        Raised by impl.send_string() if a socket timeout occurs.
+    """
+    return _default_client.call_pipelined(calls)
+
 
 def call_with_invalid_json():
     """Test the RPC server with deliberately invalid JSON and attempt
@@ -365,6 +1428,27 @@ class LowLevelServerError(LowLevelError):
         super().__init__(reply)
 
 
+# Batch help functions
+
+def _method_and_params(call):
+    if isinstance(call, str):
+        return call, []
+    elif len(call) == 1:
+        return call[0], []
+    else:
+        return call[0], call[1]
+
+def _all_idempotent(calls):
+    return all(method in IDEMPOTENT_METHODS for method, params in calls)
+
+def _reply_or_error(reply_factory, *args):
+    try:
+        return reply_factory(*args)
+    except Error as e:
+        e.reply.error = e
+        return e.reply
+
+
 # Error creation help function
 
 def _create_jsonrpc_error(reply):
@@ -0,0 +1,168 @@
+# MIT License
+#
+# Copyright (c) 2022 Planetside Software
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+"""A cache of project metadata shared by processes on one host, so that
+worker processes which talk to the same Terragen don't each fetch the
+same metadata.
+
+One process publishes the contents of its client's caches (see
+``terragen_rpc.cache``) to a file, and the other processes refresh their
+clients' caches from it. The file is replaced atomically when it's
+published, and read through mmap, so no locks or server process are
+needed. If several processes publish to the same file, the last one
+wins.
+
+Published metadata is only valid for the project that was open when it
+was published. The publishing process should publish again after it
+opens or starts a project, and other processes must not change the
+hierarchy without publishing. Each publish is a complete snapshot, so
+readers drop everything they had cached before loading a newer one.
+
+Example:
+
+.. code-block:: python
+
+    # in the process which sets up the project
+    tg.open_project(filename)
+    tg.preload_path_index()
+    tg.publish_shared_cache('/tmp/terragen_metadata')
+
+    # in each worker process, e.g. before each job
+    tg.refresh_shared_cache('/tmp/terragen_metadata')
+"""
+
+
+import mmap
+import os
+import time
+import uuid
+
+
+MAGIC = b'TGRPC-SHARED-1\n'
+REPLACE_ATTEMPTS = 50
+
+
+class SharedCache:
+    """A file of metadata shared between processes.
+
+    Parameters
+    ----------
+    filename : str
+        The file to publish to or refresh from.
+
+    Attributes
+    ----------
+    epoch : str or None
+        The project epoch of the metadata last published or loaded by
+        this object.
+    """
+
+    def __init__(self, filename):
+        self.filename = os.path.expanduser(filename)
+        self.epoch = None
+        self._session = uuid.uuid4().hex
+        self._loaded_stat = None
+
+    def publish(self, client):
+        """Write the contents of the client's metadata cache, schema cache
+        and path index to the file, replacing what was there.
+        """
+        metadata = {
+            'address': list(client.address),
+            'epoch': '{}:{}'.format(self._session, client.epoch),
+            'results': client.metadata_cache.export() if client.metadata_cache is not None else [],
+            'schemas': client.schema_cache.export_schemas() if client.schema_cache is not None else {},
+            'classes': client.schema_cache.export_classes() if client.schema_cache is not None else {},
+            'paths': client.path_index.export() if client.path_index is not None else {},
+        }
+        data = client.codec.encode(metadata)
+        temp_filename = '{}.{}.tmp'.format(self.filename, os.getpid())
+        with open(temp_filename, 'wb') as f:
+            f.write(MAGIC)
+            f.write(data)
+        for attempt in range(REPLACE_ATTEMPTS):
+            try:
+                os.replace(temp_filename, self.filename)
+                break
+            except PermissionError:
+                # On Windows a file can't be replaced while a reader has
+                # it open, which is only ever briefly.
+                if attempt == REPLACE_ATTEMPTS - 1:
+                    os.remove(temp_filename)
+                    raise
+                time.sleep(0.01)
+        self.epoch = metadata['epoch']
+
+    def refresh(self, client):
+        """Replace the contents of the client's caches with the file if
+        it has been published since it was last loaded, enabling the
+        caches if necessary.
+        Metadata published from a different address is ignored. If it
+        was published for a different project epoch than the metadata
+        loaded before, the publisher has opened another project, so the
+        client starts a new epoch, and its nodes become stale as if it
+        had opened the project itself.
+
+        Returns
+        -------
+        bool
+            True if metadata was loaded.
+        """
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            return False
+        stat_key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if stat_key == self._loaded_stat:
+            return False
+        if stat.st_size < len(MAGIC):
+            return False    # mmap can't map an empty file, and it isn't ours anyway
+
+        with open(self.filename, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mapped:
+                if mapped[:len(MAGIC)] != MAGIC:
+                    return False
+                with memoryview(mapped) as view, view[len(MAGIC):] as payload:
+                    metadata = client.codec.decode(payload)
+        self._loaded_stat = stat_key
+        if tuple(metadata['address']) != tuple(client.address):
+            return False
+
+        # Entries the publisher has dropped since the last snapshot must
+        # not survive in this client, so start again from the snapshot.
+        client.invalidate()
+        if self.epoch is not None and metadata['epoch'] != self.epoch:
+            client._new_epoch()
+        self.epoch = metadata['epoch']
+        client.set_metadata_cache(True)
+        client.set_schema_cache(True)
+        client.set_path_index(True)
+        client.metadata_cache.load(metadata['results'])
+        client.schema_cache.load_schemas(metadata['schemas'])
+        for node_id, class_name in metadata['classes'].items():
+            client.schema_cache.note_class(node_id, class_name)
+        generation = client.path_index.generation
+        for path, node_id in metadata['paths'].items():
+            client.path_index.store(path, node_id, generation)
+        return True
@@ -38,6 +38,8 @@ sys.path.append(parent_dir)
   
 # Now we can import the module in the parent directory
 import terragen_rpc as tg
+import terragen_rpc.aio as tga
+import terragen_rpc.codec
 
 
 # Test Low Level API
@@ -151,8 +153,591 @@ def test_lowlevel_call_invalid_params():
     assert caught
 
 
+def test_lowlevel_call_value():
+
+    root = tg.jsonrpc.call('root').value
+    root_name = tg.jsonrpc.call('name', [root]).value
+    assert tg.jsonrpc.call_value('root') == root
+    assert tg.jsonrpc.call_value('name', [root]) == root_name
+
+    caught = False
+    try:
+        tg.jsonrpc.call_value('name', [root, 'bad_param'])
+    except tg.jsonrpc.ApiInvalidParams as e:
+        caught = True
+        assert e.reply.jsonrpc_error_code == -32602
+        assert e.reply.raw_bytes is not None
+    assert caught
+
+    reply = tg.jsonrpc.call('name', [root])
+    assert reply.raw_dict['result'] == reply.value
+    assert reply.raw_bytes is not None
+    reply.note = 'callers may add attributes'
+    tg.jsonrpc.set_lean_replies(True)
+    try:
+        reply = tg.jsonrpc.call('name', [root])
+        assert isinstance(reply, tg.jsonrpc.LeanReply)
+        assert reply.ok and reply.value == root_name
+        assert reply.raw_bytes is None and reply.raw_dict is None
+        assert tg.jsonrpc.call_batch([('name', [root])])[0].value == root_name
+    finally:
+        tg.jsonrpc.set_lean_replies(False)
+    assert type(tg.jsonrpc.call('name', [root])) is tg.jsonrpc.Reply
+
+def test_lean_replies_are_per_client():
+
+    with tg.Client() as client:
+        client.set_lean_replies(True)
+        assert client.lean_replies and not tg.jsonrpc.default_client().lean_replies
+        codec = client.codec
+        reply = client._reply_factory()(b'{"jsonrpc":"2.0","result":"a","id":3}', 'name', ['1'], id = 3, codec = codec)
+        assert type(reply) is tg.jsonrpc.LeanReply and reply.value == 'a'
+        assert reply.error is None and reply.jsonrpc_error_code == 0
+        caught = False
+        try:
+            reply.note = 'lean replies have no __dict__'
+        except AttributeError:
+            caught = True
+        assert caught
+        caught = False
+        try:
+            client._reply_factory()(b'{"jsonrpc":"2.0","error":{"code":-32601,"message":"Method not found"},"id":3}',
+                'name', ['1'], id = 3, codec = codec)
+        except tg.jsonrpc.ApiMethodNotFound as e:
+            caught = True
+            assert type(e.reply) is tg.jsonrpc.Reply and e.reply.raw_bytes is not None
+        assert caught
+
+
+def test_lowlevel_call_batch():
+
+    root = tg.jsonrpc.call('root').value
+    root_name = tg.jsonrpc.call('name', [root]).value
+
+    replies = tg.jsonrpc.call_batch([
+        ('root', []),
+        ('nonexistent_method', []),
+        ('name', [root]),
+        ('name', [])
+    ])
+    assert len(replies) == 4
+
+    assert replies[0].ok
+    assert replies[0].value == root
+
+    # An error in one request doesn't stop the others from succeeding.
+    assert not replies[1].ok
+    assert type(replies[1].error) is tg.jsonrpc.ApiMethodNotFound
+    assert replies[1].jsonrpc_error_code == -32601
+
+    assert replies[2].ok
+    assert replies[2].value == root_name
+
+    assert not replies[3].ok
+    assert type(replies[3].error) is tg.jsonrpc.ApiInvalidParams
+
+    assert tg.jsonrpc.call_batch([]) == []
+
+    # Each call is observed once, also when a server which doesn't accept
+    # batches makes the first call_batch fall back to call_pipelined.
+    class CountingClient(tg.Client):
+        observed = 0
+        def _observe(self, method, params):
+            self.observed += 1
+            super()._observe(method, params)
+
+    with CountingClient() as client:
+        client.call_batch([('root', []), ('name', [root])])
+        assert client.observed == 2
+
+def test_lowlevel_call_pipelined():
+
+    root = tg.jsonrpc.call('root').value
+    child_ids = tg.jsonrpc.call('children', [root]).value
+    expected_names = [tg.jsonrpc.call('name', [id]).value for id in child_ids]
+
+    for persistent in [False, True]:
+        tg.jsonrpc.set_persistent_connection(persistent)
+        try:
+            calls = [('name', [id]) for id in child_ids] + [('nonexistent_method', [])]
+            replies = tg.jsonrpc.call_pipelined(calls)
+            assert [r.value for r in replies[:-1]] == expected_names
+            assert type(replies[-1].error) is tg.jsonrpc.ApiMethodNotFound
+        finally:
+            tg.jsonrpc.set_persistent_connection(False)
+
+def test_lowlevel_persistent_connection():
+
+    tg.jsonrpc.set_persistent_connection(True)
+    try:
+        root = tg.jsonrpc.call('root').value
+        for i in range(10):
+            assert tg.jsonrpc.call('root').value == root
+
+        # Close the connection and make sure the next call reconnects.
+        tg.jsonrpc.close_persistent_connection()
+        assert tg.jsonrpc.call('root').value == root
+
+    finally:
+        tg.jsonrpc.set_persistent_connection(False)
+
+    assert tg.jsonrpc.call('root').value == root
+
+def test_lowlevel_framing_detection():
+
+    # The first reply on a connection is unframed only if it starts like
+    # JSON text, so framed replies of any length are recognised.
+    assert not tg.impl._is_length_header(b'{"js')
+    assert not tg.impl._is_length_header(b' \r\n[')
+    assert not tg.impl._is_length_header(b'{}')
+    assert tg.impl._is_length_header((100).to_bytes(4, 'little'))
+    assert tg.impl._is_length_header((0x01010101).to_bytes(4, 'little'))
+    assert tg.impl._is_length_header(b'{\x00\x00\x00')
+    assert not tg.impl._is_length_header(b'"abc')
+    assert not tg.impl._is_length_header(b'-1.5')
+
+def test_lowlevel_no_resend_after_server_closes():
+
+    import socket
+    import threading
+
+    # A server which replies to the first request on each connection,
+    # then reads the second request and closes without replying.
+    received = []
+    listener = socket.socket()
+    listener.bind(('localhost', 0))
+    listener.listen(4)
+
+    def serve():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            with conn:
+                for i in range(2):
+                    header = conn.recv(4, socket.MSG_WAITALL)
+                    if len(header) < 4:
+                        break
+                    request = conn.recv(int.from_bytes(header, 'little'), socket.MSG_WAITALL)
+                    received.append(request)
+                    if i == 0:
+                        reply = b'{"jsonrpc":"2.0","result":"","id":null}'
+                        conn.sendall(len(reply).to_bytes(4, 'little') + reply)
+
+    threading.Thread(target = serve, daemon = True).start()
+    try:
+        with tg.Client(*listener.getsockname(), timeout = 5, persistent = True, codec = 'json') as client:
+            client.call('root')
+            caught = False
+            try:
+                client.call('delete', [['1']])
+            except ConnectionError:
+                caught = True
+            assert caught
+            assert len(received) == 2     # 'delete' wasn't sent again
+
+            # A call which doesn't change anything is sent again.
+            client.call('root')
+            client.call('name', ['1'])
+            assert len(received) == 5
+    finally:
+        listener.close()
+
+def test_lowlevel_connection_pool_with_threads():
+
+    import concurrent.futures
+
+    root = tg.jsonrpc.call('root').value
+
+    tg.jsonrpc.set_persistent_connection(True)
+    tg.jsonrpc.configure_connection_pool(max_size = 2)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers = 8) as executor:
+            results = list(executor.map(lambda i: tg.jsonrpc.call('root').value, range(50)))
+        assert results == [root] * 50
+
+    finally:
+        tg.jsonrpc.configure_connection_pool(max_size = 4)
+        tg.jsonrpc.set_persistent_connection(False)
+
+def test_lowlevel_notify_and_flush():
+
+    root = tg.jsonrpc.call('root').value
+    camera = tg.jsonrpc.call('children_filtered_by_class', [root, 'camera']).value[0]
+    name = tg.jsonrpc.call('name', [camera]).value
+
+    tg.jsonrpc.set_persistent_connection(True)
+    try:
+        for i in range(20):
+            tg.jsonrpc.notify('set_param_from_string', [camera, 'name', 'notified ' + str(i)])
+        tg.jsonrpc.flush()
+        assert tg.jsonrpc.call('name', [camera]).value == 'notified 19'
+
+    finally:
+        tg.jsonrpc.notify('set_param_from_string', [camera, 'name', name])
+        tg.jsonrpc.flush()
+        tg.jsonrpc.set_persistent_connection(False)
+
+    assert tg.jsonrpc.call('name', [camera]).value == name
+
+    # Notifications on connections closed before they were confirmed are
+    # reported by the next flush. If the server doesn't keep connections
+    # alive, notifications are sent as calls and are never unconfirmed.
+    with tg.Client(persistent = True) as client:
+        for i in range(5):
+            client.notify('select_none')
+        pool = client.transport._get_connection_pool()
+        unconfirmed = pool.acquire_unconfirmed()
+        for connection in unconfirmed:
+            pool.release(connection)
+        client.close()
+        caught = False
+        try:
+            client.flush()
+        except ConnectionError:
+            caught = True
+        assert caught == bool(unconfirmed)
+        client.flush()
+
+def test_lowlevel_codecs():
+
+    root = tg.jsonrpc.call('root').value
+    children = tg.jsonrpc.call('children', [root]).value
+
+    for name in tg.codec.available_codecs():
+        with tg.Client(codec = name) as client:
+            assert client.codec.name == name
+            assert client.call('root').value == root
+            assert client.call('children', [root]).value == children
+            replies = client.call_pipelined([('name', [c]) for c in children])
+            assert all(r.ok for r in replies)
+
+    caught = False
+    try:
+        tg.Client(codec = 'not a codec')
+    except ValueError:
+        caught = True
+    assert caught
+
+def test_lowlevel_request_templates():
+
+    with tg.Client(codec = 'json') as client:
+        root = client.call('root').value
+        camera = client.call('children_filtered_by_class', [root, 'camera']).value[0]
+        name = client.call('name', [camera]).value
+        for i in range(10):
+            assert client.call('name', [camera]).value == name
+        stats = client.request_template_stats()
+        assert stats['hits'] == 10
+        assert stats['misses'] == 3     # the first call of each method
+
+def test_lowlevel_request_templates_only_splice_positional_params():
+
+    templates = tg.impl.RequestTemplates()
+    assert templates.encode('name', ['a'], 1) is None   # caches the template
+    assert templates.encode('name', ('a',), 2) == b'{"jsonrpc":"2.0","method":"name","params":["a"],"id":2}'
+    assert templates.encode('name', {'a': 'x'}, 3) is None
+    assert templates.encode('name', 'abc', 4) is None
+    assert templates.stats() == {'hits': 1, 'misses': 3, 'methods': 1}
+
+def test_lowlevel_single_flight():
+
+    import concurrent.futures
+
+    with tg.Client(persistent = True) as client:
+        client.set_single_flight(True)
+        root = client.call('root').value
+        with concurrent.futures.ThreadPoolExecutor(max_workers = 8) as executor:
+            results = list(executor.map(lambda i: client.call('children', [root]).value, range(50)))
+        assert all(r == results[0] for r in results)
+        stats = client.single_flight_stats()
+        assert stats['calls'] + stats['coalesced'] == 51
+        assert stats['in_flight'] == 0
+
+
+def test_lowlevel_auto_batch():
+
+    import concurrent.futures
+
+    with tg.Client(persistent = True) as client:
+        client.set_auto_batch(True, window = 0.01, max_size = 8)
+        root = client.call('root').value
+        names = client.call_value('children', [root])
+
+        def call(i):
+            if i % 10 == 9:
+                try:
+                    client.call('name')
+                except tg.jsonrpc.ApiInvalidParams:
+                    return 'caught'
+                return None
+            return client.call('name', [names[i % len(names)]]).value
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers = 16) as executor:
+            results = list(executor.map(call, range(50)))
+        for i, result in enumerate(results):
+            if i % 10 == 9:
+                assert result == 'caught'
+            else:
+                assert result == client.call_value('name', [names[i % len(names)]])
+
+        stats = client.auto_batch_stats()
+        assert stats['calls'] >= 52
+        assert 1 <= stats['max_batch_size'] <= 8
+        assert stats['batches'] < stats['calls']
+        assert sum(size * n for size, n in stats['batch_sizes'].items()) == stats['calls']
+
+        client.set_auto_batch(False)
+        assert client.auto_batch_stats() is None
+
+
 # Test High Level API
 
+def test_client():
+
+    with tg.Client(timeout = 20, persistent = True) as client:
+        assert client.timeout == 20
+
+        root = tg.root(client = client)
+        assert root.client is client
+        assert root.id == tg.root().id
+
+        # Nodes returned by a bound node are bound to the same client.
+        children = root.children()
+        assert all(c.client is client for c in children)
+        assert [c.path() for c in children] == [c.path() for c in tg.root().children()]
+
+        camera = tg.node_by_path('/Render Camera', client = client)
+        assert camera.parent() == root
+
+        # Nodes with the same id are not equal if they're bound to
+        # different clients.
+        assert root != tg.root()
+
+def test_metadata_cache():
+
+    with tg.Client() as client:
+        client.set_metadata_cache(True)
+        project = tg.root(client)
+        children = project.children()
+        camera = project.children_filtered_by_class('camera')[0]
+        name = camera.name()
+        path = camera.path()
+        for i in range(5):
+            assert project.children() == children
+            assert camera.name() == name
+            assert camera.path() == path
+            assert camera.parent() == project
+        assert client.metadata_cache.hits >= 15
+
+        group = tg.create_child(project, 'group')
+        assert project.children() == children + [group]
+        group.set_param('name', 'cached group')
+        assert group.name() == 'cached group'
+        assert group.path() == '/cached group'
+        tg.delete(group)
+        assert project.children() == children
+
+        client.invalidate()
+        assert len(client.metadata_cache) == 0
+
+def test_schema_cache():
+
+    with tg.Client() as client:
+        client.set_schema_cache(True)
+        project = tg.root(client)
+        cameras = [tg.create_child(project, 'camera') for i in range(3)]
+        try:
+            names = cameras[0].param_names()
+            for camera in cameras[1:]:
+                assert camera.param_names() == names
+            assert client.schema_cache.stats()['hits'] == 2
+
+            camera = project.children_filtered_by_class('camera')[-1]
+            assert camera.param_names() == names
+            assert client.schema_cache.class_of(camera.id) == 'camera'
+
+            for name in names:
+                if camera.get_param_as_string(name):
+                    assert client.schema_cache.shape(camera.id, name) in ('scalar', '2-vector', '3-vector', 'string')
+            assert client.schema_cache.shape(camera.id, 'name') == 'string'
+
+        finally:
+            tg.delete(cameras)
+
+def test_param_cache():
+
+    with tg.Client() as client:
+        client.set_param_cache(True, max_size = 2)
+        camera = tg.node_by_path('/Render Camera', client)
+        position = camera.get_param_as_string('position')
+        for i in range(5):
+            assert camera.get_param_as_string('position') == position
+        assert client.param_cache.hits == 5
+
+        try:
+            camera.set_param('position', (1, 2, 3))
+            assert camera.get_param_as_tuple('position') == (1, 2, 3)
+            assert client.param_cache.hits == 6
+        finally:
+            camera.set_param('position', position)
+        assert camera.get_param_as_string('position') == position
+
+        # Writes which aren't confirmed yet drop the value, not cache it.
+        try:
+            with client.deferred():
+                camera.set_param('position', (4, 5, 6))
+                assert not client.param_cache.lookup(camera.id, 'position')[0]
+            assert not client.param_cache.lookup(camera.id, 'position')[0]
+            assert camera.get_param_as_tuple('position') == (4, 5, 6)
+        finally:
+            camera.set_param('position', position)
+
+        camera.get_param_as_string('name')
+        camera.get_param_as_string('perspective')
+        assert client.param_cache.stats()['evictions'] == 1
+
+        client.invalidate()
+        assert len(client.param_cache) == 0
+
+def test_path_index():
+
+    with tg.Client() as client:
+        client.set_path_index(True)
+        camera = tg.node_by_path('/Render Camera', client)
+        for i in range(5):
+            assert tg.node_by_path('/Render Camera', client) == camera
+        assert client.path_index.hits == 5
+        assert tg.node_by_path('/no such node', client) is None
+
+        group = tg.create_child(tg.root(client), 'group')
+        try:
+            child = tg.create_child(group, 'group')
+            count = tg.preload_path_index(client = client)
+            assert count == len(client.path_index)
+            group_path = group.path()
+            child_path = child.path()
+            assert tg.node_by_path(child_path, client) == child
+
+            group.set_param('name', 'renamed group')
+            assert client.path_index.lookup(child_path) is None
+            assert tg.node_by_path('/renamed group/' + child.name(), client) == child
+            assert tg.node_by_path(group_path, client) is None
+
+        finally:
+            tg.delete(group)
+        assert client.path_index.path_of(child.id) is None
+
+def test_disk_cache():
+
+    cache_filename = os.path.join(unittest_dir, 'temp_saved_by_automated_test_disk_cache.sqlite')
+    if os.path.exists(cache_filename):
+        os.remove(cache_filename)
+    project_filename = os.path.join(unittest_dir, 'temp_saved_by_automated_test_disk_cache.tgd')
+    tg.save_project(project_filename)
+
+    with tg.Client() as client:
+        client.set_schema_cache(True)
+        project = tg.root(client)
+        camera = project.children_filtered_by_class('camera')[0]
+        names = camera.param_names()
+        assert tg.preload_path_index(client = client) > 0
+        tg.save_disk_cache(cache_filename, client = client)
+        paths = client.path_index.export()
+
+    with tg.Client() as client:
+        tg.save_disk_cache(cache_filename, client = client)    # nothing to save, so keeps the file
+
+    with tg.Client() as client:
+        assert tg.load_disk_cache(cache_filename, client = client)
+        assert client.path_index.export() == paths
+        assert client.schema_cache.class_of(camera.id) == 'camera'
+        assert tg.Node(camera.id, client).param_names() == names
+        assert client.schema_cache.hits == 1
+
+    with tg.Client() as client:
+        assert not tg.load_disk_cache(cache_filename, server_version = 'other', client = client)
+        assert len(client.path_index) == 0
+
+    os.remove(cache_filename)
+
+def test_shared_cache():
+
+    shared_filename = os.path.join(unittest_dir, 'temp_saved_by_automated_test_shared_cache')
+
+    with tg.Client() as publisher, tg.Client() as worker:
+        publisher.set_metadata_cache(True)
+        project = tg.root(publisher)
+        children = project.children()
+        tg.preload_path_index(client = publisher)
+        tg.publish_shared_cache(shared_filename, publisher)
+
+        assert tg.refresh_shared_cache(shared_filename, worker)
+        assert not tg.refresh_shared_cache(shared_filename, worker)
+        assert worker.path_index.export() == publisher.path_index.export()
+        assert tg.Node(project.id, worker).children() == [tg.Node(c.id, worker) for c in children]
+        assert worker.metadata_cache.hits == 1
+
+        # A newer snapshot replaces what the worker loaded before.
+        group = tg.create_child(project, 'group')
+        group_path = group.path()
+        tg.preload_path_index(client = publisher)
+        tg.publish_shared_cache(shared_filename, publisher)
+        assert tg.refresh_shared_cache(shared_filename, worker)
+        assert tg.node_by_path(group_path, worker) == tg.Node(group.id, worker)
+        tg.delete(group)
+        tg.preload_path_index(client = publisher)
+        tg.publish_shared_cache(shared_filename, publisher)
+        assert tg.refresh_shared_cache(shared_filename, worker)
+        assert group_path not in worker.path_index.export()
+        assert tg.node_by_path(group_path, worker) is None
+
+    os.remove(shared_filename)
+    open(shared_filename, 'wb').close()
+    with tg.Client() as worker:
+        assert not tg.refresh_shared_cache(shared_filename, worker)
+    os.remove(shared_filename)
+
+def test_shared_cache_epoch_makes_nodes_stale():
+
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        shared_filename = os.path.join(temp_dir, 'shared_cache')
+        with tg.Client() as publisher, tg.Client() as worker:
+            tg.publish_shared_cache(shared_filename, publisher)
+            assert tg.refresh_shared_cache(shared_filename, worker)
+            node = tg.Node('5', worker)
+
+            # Published again for the same project: nodes stay live.
+            tg.publish_shared_cache(shared_filename, publisher)
+            assert tg.refresh_shared_cache(shared_filename, worker)
+            worker.check_node(node.id, node.epoch)
+
+            publisher._observe_result('new_project', [], None)  # as after a successful 'new_project'
+            tg.publish_shared_cache(shared_filename, publisher)
+            assert tg.refresh_shared_cache(shared_filename, worker)
+            caught = False
+            try:
+                worker.check_node(node.id, node.epoch)
+            except tg.StaleNodeError:
+                caught = True
+            assert caught
+            worker.check_node('5', tg.Node('5', worker).epoch)
+
+def test_shared_cache_does_not_keep_client_alive():
+
+    import gc
+    import weakref
+
+    client = tg.Client()
+    assert not tg.refresh_shared_cache(os.path.join(unittest_dir, 'no such file'), client)
+    client_ref = weakref.ref(client)
+    del client
+    gc.collect()
+    assert client_ref() is None
+
 def test_project_filepath():
 
     v = tg.project_filepath()
@@ -376,6 +961,155 @@ def test_get_param_as_list():
     assert type(v) is list
     assert v == [0, 10, -30]
 
+def test_get_params():
+
+    node = tg.node_by_path('Render Camera')
+    params = node.get_params()
+    assert type(params) is dict
+    assert list(params) == node.param_names()
+    assert params['position'] == node.get_param_as_string('position')
+    assert tg.get_params(node, ['position']) == {'position': '0 10 -30'}
+
+    nodes = tg.root().children()
+    params_of_nodes = tg.get_params(nodes)
+    assert len(params_of_nodes) == len(nodes)
+    for n, p in zip(nodes, params_of_nodes):
+        assert p == {name: n.get_param_as_string(name) for name in n.param_names()}
+    assert tg.get_params([]) == []
+
+    tg.set_param_cache(True)
+    try:
+        assert node.get_params() == params
+        assert node.get_params() == params
+        assert tg.param_cache_stats()['hits'] >= len(params)
+    finally:
+        tg.set_param_cache(False)
+
+def test_get_param_array():
+
+    try:
+        tg.high._numpy()
+    except ImportError:
+        return  # get_param_array needs numpy
+
+    camera = tg.node_by_path('Render Camera')
+    nodes = [camera, tg.root(), camera]
+    a = tg.get_param_array(nodes, 'position')
+    assert a.shape == (3, 3)
+    assert list(a[0]) == list(camera.get_param_as_tuple('position'))
+    assert list(a[2]) == list(a[0])
+    assert a.mask[1].all() and not a.mask[0].any()
+
+    a = tg.get_param_array([camera], 'name', width = 1)
+    assert a.shape == (1, 1)
+    assert a.mask.all()
+    assert tg.get_param_array([], 'position').shape[0] == 0
+
+def test_get_param_array_sends_chunks():
+
+    try:
+        tg.high._numpy()
+    except ImportError:
+        return  # get_param_array needs numpy
+
+    class RecordingClient(tg.Client):
+        def call_batch(self, calls):
+            self.sizes.append(len(calls))
+            return [tg.jsonrpc.Reply(b'{"jsonrpc":"2.0","result":"1 2 3","id":null}', m, p) for m, p in calls]
+
+    chunk_size = tg.high.BATCH_CHUNK_SIZE
+    tg.high.BATCH_CHUNK_SIZE = 2
+    try:
+        with RecordingClient() as client:
+            client.sizes = []
+            nodes = [tg.Node(str(i), client) for i in range(1, 6)]
+            a = tg.get_param_array(nodes, 'position')
+            assert client.sizes == [2, 2, 1]
+            assert a.shape == (5, 3) and not a.mask.any()
+    finally:
+        tg.high.BATCH_CHUNK_SIZE = chunk_size
+
+def test_set_param_array():
+
+    try:
+        import numpy as np
+    except ImportError:
+        return  # set_param_array needs numpy
+
+    camera = tg.node_by_path('Render Camera')
+    original = camera.get_param_as_string('position')
+    group = tg.create_child(tg.root(), 'group')
+    tg.delete(group)
+    try:
+        a = np.ma.MaskedArray([[0.1 + 0.2, 1e-7, -30], [1, 2, 3], [4, 5, 6]],
+            mask = [[False] * 3, [True, False, False], [False] * 3])
+        errors = tg.set_param_array([camera, camera, group], 'position', a)
+        assert errors[0] is None and errors[1] is None
+        assert isinstance(errors[2], tg.StaleNodeError)
+        assert camera.get_param_as_tuple('position') == (0.1 + 0.2, 1e-7, -30)
+
+        caught = False
+        try:
+            tg.set_param_array([camera], 'position', a)
+        except ValueError:
+            caught = True
+        assert caught
+    finally:
+        camera.set_param_from_string('position', original)
+
+def test_set_param_array_formats_by_dtype():
+
+    try:
+        import numpy as np
+    except ImportError:
+        return  # set_param_array needs numpy
+
+    class RecordingClient(tg.Client):
+        def call_batch(self, calls):
+            self.values = [params[2] for method, params in calls]
+            return [tg.jsonrpc.Reply(b'{"jsonrpc":"2.0","result":"","id":null}', m, p) for m, p in calls]
+
+    with RecordingClient() as client:
+        nodes = [tg.Node('1', client), tg.Node('2', client)]
+        tg.set_param_array(nodes, 'position', np.array([[1.1, 0.1, 1e-7], [2, 3, -4.5]], dtype = np.float32))
+        assert client.values == ['1.1 0.1 1e-07', '2.0 3.0 -4.5']
+        tg.set_param_array(nodes, 'enable', np.array([True, False]))
+        assert client.values == ['1', '0']
+        for bad in [np.nan, np.inf]:
+            caught = False
+            try:
+                tg.set_param_array(nodes, 'position', np.array([[0, 0, 0], [1, bad, 2]]))
+            except ValueError:
+                caught = True
+            assert caught
+        a = np.ma.MaskedArray([[np.nan], [1.5]], mask = [[True], [False]])
+        assert tg.set_param_array(nodes, 'height', a) == [None, None]
+        assert client.values == ['1.5']
+
+def test_set_param_array_sends_chunks():
+
+    try:
+        import numpy as np
+    except ImportError:
+        return  # set_param_array needs numpy
+
+    class RecordingClient(tg.Client):
+        def call_batch(self, calls):
+            self.values.append([params[2] for method, params in calls])
+            return [tg.jsonrpc.Reply(b'{"jsonrpc":"2.0","result":"","id":null}', m, p) for m, p in calls]
+
+    chunk_size = tg.high.BATCH_CHUNK_SIZE
+    tg.high.BATCH_CHUNK_SIZE = 2
+    try:
+        with RecordingClient() as client:
+            client.values = []
+            nodes = [tg.Node(str(i), client) for i in range(1, 4)]
+            errors = tg.set_param_array(nodes, 'enable', np.array([1, 0, 1]))
+            assert client.values == [['1', '0'], ['1']]
+            assert errors == [None, None, None]
+    finally:
+        tg.high.BATCH_CHUNK_SIZE = chunk_size
+
 def test_set_param_from_string_and_name():
 
     node = tg.node_by_path('/Render Camera')
@@ -416,6 +1150,71 @@ def test_set_param_with_list():
     node.set_param('position', [0, 10, -30])
     assert node.get_param_as_string('position') == '0 10 -30'
 
+def test_deferred():
+
+    camera = tg.node_by_path('Render Camera')
+    original = camera.get_param_as_string('horizontal_fov')
+    try:
+        with tg.deferred() as writes:
+            for v in ['10', '20', '30']:
+                camera.set_param_from_string('horizontal_fov', v)
+            assert writes.pending == 1
+            assert writes.coalesced == 2
+            assert camera.get_param_as_string('horizontal_fov') == '30'  # flushes first
+            assert writes.pending == 0
+
+            camera.set_param('horizontal_fov', 40)
+            tg.select_just(camera)
+            tg.select_none()
+            assert writes.pending == 2
+            with tg.deferred() as inner:
+                assert inner is writes
+        assert writes.pending == 0
+        assert camera.get_param_as_string('horizontal_fov') == '40'
+        assert tg.current_selection() == []
+
+        caught = False
+        try:
+            with tg.deferred():
+                camera.set_param('horizontal_fov', 50)
+                raise KeyError
+        except KeyError:
+            caught = True
+        assert caught
+        assert camera.get_param_as_string('horizontal_fov') == '40'    # discarded
+
+        caught = False
+        try:
+            with tg.deferred():
+                tg.jsonrpc.default_client().write('set_param_from_string', [camera.id])
+        except tg.jsonrpc.ApiInvalidParams:
+            caught = True
+        assert caught
+    finally:
+        camera.set_param_from_string('horizontal_fov', original)
+
+def test_deferred_discards_writes_on_exception():
+
+    import socket
+
+    # Nothing listens on the port, so a flush would raise ConnectionError
+    # and hide the KeyError.
+    s = socket.socket()
+    s.bind(('localhost', 0))
+    host, port = s.getsockname()
+    s.close()
+    with tg.Client(host, port, timeout = 1) as client:
+        caught = False
+        try:
+            with client.deferred() as writes:
+                client.write('set_param_from_string', ['1', 'name', 'x'])
+                assert writes.pending == 1
+                raise KeyError
+        except KeyError:
+            caught = True
+        assert caught
+        assert writes.pending == 0 and writes.flushed == 0
+
 def test_current_selection_is_list():
 
     v = tg.current_selection()
@@ -499,6 +1298,114 @@ def test_new_project():
 
     assert tg.project_filepath() == ''
 
+def test_stale_nodes():
+
+    group = tg.create_child(tg.root(), 'group')
+    tg.delete(group)
+    caught = False
+    try:
+        group.name()
+    except tg.StaleNodeError as e:
+        caught = True
+        assert e.reply is None
+        assert e.node_id == group.id
+    assert caught
+
+    # A failed call doesn't make nodes stale.
+    group = tg.create_child(tg.root(), 'group')
+    caught = False
+    try:
+        tg.jsonrpc.call('delete', [group.id, 'bad_param'])
+    except tg.jsonrpc.ApiInvalidParams:
+        caught = True
+    assert caught
+    assert group.name() != ''
+    project = tg.root()
+    missing = os.path.join(unittest_dir, 'temp_saved_by_automated_test_missing.tgd')
+    assert tg.open_project(missing) == False
+    assert project.children() is not None
+    tg.delete(group)
+
+    tg.new_project()
+    caught = False
+    try:
+        project.children()
+    except tg.StaleNodeError as e:
+        caught = True
+    assert caught
+    assert tg.root().children() is not None
+
+def test_hashable_nodes():
+
+    root = tg.root()
+    assert tg.root() == root
+    assert tg.Node(root.id) == root
+    children = root.children()
+    assert len(children) > 0
+    assert root.children() == children
+    assert children[0].parent() == root
+
+    assert len({root, tg.Node(root.id), children[0]}) == 2
+    by_node = {child: child.name() for child in children}
+    assert by_node[tg.Node(children[0].id)] == children[0].name()
+
+    caught = False
+    try:
+        root.foo = 1
+    except AttributeError:
+        caught = True
+    assert caught
+
+    tg.new_project()
+    new_root = tg.root()
+    assert new_root == root
+    assert new_root.children() is not None
+
+def test_nodes_pickle_their_id_and_can_be_weakly_referenced():
+
+    import pickle
+    import weakref
+
+    with tg.Client() as client:
+        node = tg.Node('123', client)
+        copy = pickle.loads(pickle.dumps(node))
+        assert copy.id == '123' and copy.client is None
+        assert copy == tg.Node('123')
+        assert tg.high._nodes_from_ids(['123'], client) == [node]
+        node_ref = weakref.ref(node)
+        del node
+        assert node_ref() is None
+
+def test_deleted_ids_are_live_when_returned_again():
+
+    import json
+
+    # A client whose server gives a new child the id of a deleted node.
+    class FakeClient(tg.Client):
+        results = {'create_child': '5', 'delete': None, 'name': 'n', 'children': ['5']}
+
+        def _send(self, method, params):
+            self._observe(method, params)
+            return json.dumps({'jsonrpc': '2.0', 'result': self.results[method], 'id': None}).encode(), None
+
+    with FakeClient() as client:
+        parent = tg.Node('1', client)
+        child = tg.create_child(parent, 'group')
+        tg.delete(child)
+        caught = False
+        try:
+            child.name()
+        except tg.StaleNodeError:
+            caught = True
+        assert caught
+
+        again = tg.create_child(parent, 'group')
+        assert again.id == '5' and again.name() == 'n'
+
+        tg.delete(again)
+        assert parent.children() == [tg.Node('5', client)]
+        assert parent.children()[0].name() == 'n'
+
 def test_save_project():
 
     test_filepath_1 = os.path.join(unittest_dir, 'temp_saved_by_automated_test_1.tgd')
@@ -676,3 +1583,211 @@ def test_insert_clip_file_before_with_bad_link():
     # Clean up
     if expected_node:
         tg.delete(expected_node)
+
+
+# Test Asyncio API
+
+def test_aio_matches_high_level_api():
+
+    import asyncio
+
+    async def _read_hierarchy():
+        root = await tga.root()
+        children = await root.children()
+        paths = await asyncio.gather(*(c.path() for c in children))
+        camera = await tga.node_by_path('/Render Camera')
+        position = await camera.get_param_as_tuple('position')
+        return root, children, paths, position
+
+    root, children, paths, position = asyncio.run(_read_hierarchy())
+
+    assert root.id == tg.root().id
+    assert [c.id for c in children] == [c.id for c in tg.root().children()]
+    assert paths == [c.path() for c in tg.root().children()]
+    assert position == tg.node_by_path('/Render Camera').get_param_as_tuple('position')
+    assert set(children) == {tga.Node(c.id) for c in tg.root().children()}
+
+def test_aio_uses_the_client_and_loop():
+
+    import asyncio
+    import concurrent.futures
+    import json
+    import socket
+    import threading
+
+    # Servers which keep connections alive and reply with their own name.
+    def start_server(name):
+        listener = socket.socket()
+        listener.bind(('localhost', 0))
+        listener.listen(16)
+
+        def serve_connection(conn):
+            with conn:
+                while True:
+                    header = conn.recv(4, socket.MSG_WAITALL)
+                    if len(header) < 4:
+                        return
+                    request = json.loads(conn.recv(int.from_bytes(header, 'little'), socket.MSG_WAITALL))
+                    reply = json.dumps({'jsonrpc': '2.0', 'result': name, 'id': request['id']}).encode()
+                    conn.sendall(len(reply).to_bytes(4, 'little') + reply)
+
+        def serve():
+            while True:
+                try:
+                    conn, _ = listener.accept()
+                except OSError:
+                    return
+                threading.Thread(target = serve_connection, args = (conn,), daemon = True).start()
+
+        threading.Thread(target = serve, daemon = True).start()
+        return listener
+
+    listeners = [start_server('a'), start_server('b')]
+    clients = [tg.Client(*l.getsockname(), timeout = 5) for l in listeners]
+    try:
+        async def names(client):
+            node = tga.Node('1', client)
+            return await asyncio.gather(*(node.name() for i in range(20)))
+
+        # Each thread runs its own event loop, with its own connections.
+        with concurrent.futures.ThreadPoolExecutor(max_workers = 4) as executor:
+            results = list(executor.map(lambda i: asyncio.run(names(clients[i % 2])), range(8)))
+        assert results == [['a'] * 20, ['b'] * 20] * 4
+
+        assert asyncio.run(tga.project_filepath(clients[1])) == 'b'
+        assert asyncio.run(tga.root(clients[0])).client is clients[0]
+    finally:
+        for l in listeners:
+            l.close()
+
+def test_aio_checks_nodes_and_uses_caches():
+
+    import asyncio
+    import json
+    import socket
+    import threading
+
+    # A server which replies 'x' to every call, and records the methods.
+    listener = socket.socket()
+    listener.bind(('localhost', 0))
+    listener.listen(16)
+    methods = []
+
+    def serve():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            with conn:
+                header = conn.recv(4, socket.MSG_WAITALL)
+                request = json.loads(conn.recv(int.from_bytes(header, 'little'), socket.MSG_WAITALL))
+                methods.append(request['method'])
+                reply = json.dumps({'jsonrpc': '2.0', 'result': 'x', 'id': request['id']}).encode()
+                conn.sendall(len(reply).to_bytes(4, 'little') + reply)
+
+    threading.Thread(target = serve, daemon = True).start()
+    try:
+        with tg.Client(*listener.getsockname(), timeout = 5) as client:
+            client.set_metadata_cache(True)
+            client.set_param_cache(True)
+            node = tga.Node('1', client)
+            other = tga.Node('2', client)
+
+            async def use_nodes():
+                assert await node.name() == 'x'
+                assert await node.name() == 'x'
+                assert await node.get_param_as_string('a') == 'x'
+                await node.set_param_from_string('a', 'y')
+                assert await node.get_param_as_string('a') == 'y'
+                await tga.delete(node)
+                caught = False
+                try:
+                    await node.name()
+                except tg.StaleNodeError:
+                    caught = True
+                assert caught
+                await tga.new_project(client)
+                caught = False
+                try:
+                    await other.path()
+                except tg.StaleNodeError:
+                    caught = True
+                assert caught
+
+            asyncio.run(use_nodes())
+            assert methods == ['name', 'get_param_as_string', 'set_param_from_string', 'delete', 'new_project']
+    finally:
+        listener.close()
+
+def test_aio_connections_follow_the_client():
+
+    import asyncio
+    import json
+    import socket
+    import threading
+    import time
+
+    # A server which keeps connections alive, and counts them.
+    listener = socket.socket()
+    listener.bind(('localhost', 0))
+    listener.listen(16)
+    counts = {'accepted': 0, 'open': 0}
+
+    def serve_connection(conn):
+        with conn:
+            while True:
+                header = conn.recv(4, socket.MSG_WAITALL)
+                if len(header) < 4:
+                    break
+                request = json.loads(conn.recv(int.from_bytes(header, 'little'), socket.MSG_WAITALL))
+                reply = json.dumps({'jsonrpc': '2.0', 'result': 'x', 'id': request['id']}).encode()
+                conn.sendall(len(reply).to_bytes(4, 'little') + reply)
+        counts['open'] -= 1
+
+    def serve():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            counts['accepted'] += 1
+            counts['open'] += 1
+            threading.Thread(target = serve_connection, args = (conn,), daemon = True).start()
+
+    def wait_for_closed():
+        deadline = time.monotonic() + 5
+        while counts['open'] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return counts['open'] == 0
+
+    threading.Thread(target = serve, daemon = True).start()
+    try:
+        with tg.Client(*listener.getsockname(), timeout = 5) as client:
+            node = tga.Node('1', client)
+
+            async def names(count):
+                return await asyncio.gather(*(node.name() for i in range(count)))
+
+            # Not persistent: a connection for each call, closed after it.
+            assert asyncio.run(names(3)) == ['x'] * 3
+            assert counts['accepted'] == 3
+            assert wait_for_closed()
+
+            # Persistent: at most max_size idle connections are kept, and
+            # closing the client closes them.
+            client.set_persistent_connection(True)
+            client.configure_connection_pool(max_size = 2)
+
+            async def names_then_close():
+                await names(8)
+                await names(2)
+                client.close()
+                await asyncio.sleep(0.1)
+
+            counts['accepted'] = 0
+            asyncio.run(names_then_close())
+            assert counts['accepted'] == 8
+            assert wait_for_closed()
+    finally:
+        listener.close()